@@ -0,0 +1,122 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from peft import PeftModel
+
+# What peft's mixed-batch forward calls "no adapter" for a row
+BASE_MODEL_ADAPTER = "__base__"
+
+
+class LoRAAdapters:
+    """
+    Named LoRA adapters on top of one shared base model. An adapter is loaded
+    the first time a request asks for it, and past max_loaded the least
+    recently used ones no request is running with are unloaded again, so
+    memory grows with the adapters held rather than with a model copy per
+    persona. Every row of a forward pass names its own adapter (peft's mixed
+    batch inference), so chats on different adapters still share a batch.
+    """
+
+    def __init__(
+        self,
+        model: Any,
+        paths: Dict[str, str],
+        max_loaded: int,
+        token: Optional[str] = None,
+    ) -> None:
+        self.paths = paths
+        self.max_loaded = max(1, max_loaded)
+        self.token = token
+
+        # Requests without an adapter get the model as it was loaded: a
+        # LORA_WEIGHTS adapter that stayed unmerged (quantized models) is
+        # still applied to them
+        if isinstance(model, PeftModel):
+            self.model = model
+            self.default_adapter: str = model.active_adapter
+        else:
+            self.model = None
+            self.default_adapter = BASE_MODEL_ADAPTER
+
+        reserved = {BASE_MODEL_ADAPTER, self.default_adapter}
+        for name in paths:
+            if name in reserved:
+                raise ValueError(f"LoRA adapter name {name!r} is reserved")
+
+        # Loaded adapters, least recently used first, with the number of
+        # running requests using each
+        self._loaded: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.loads: int = 0
+        self.unloads: int = 0
+
+        if self.model is None:
+            # peft can only add adapters to a model it already wraps
+            first = next(iter(paths))
+            print(f"Loading LoRA adapter {first} from: {paths[first]}")
+            self.model = PeftModel.from_pretrained(
+                model, paths[first], adapter_name=first, token=token
+            )
+            self._loaded[first] = 0
+            self.loads += 1
+
+    def names(self) -> List[str]:
+        return sorted(self.paths)
+
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return list(self._loaded)
+
+    def acquire(self, name: str) -> None:
+        # Called on the scheduler thread between forward passes: loading and
+        # unloading swap modules inside the model
+        if not name:
+            return
+        if name not in self.paths:
+            raise ValueError(f"unknown LoRA adapter {name!r}")
+
+        if name not in self._loaded:
+            print(f"Loading LoRA adapter {name} from: {self.paths[name]}")
+            self.model.load_adapter(
+                self.paths[name], adapter_name=name, token=self.token
+            )
+            self.loads += 1
+
+        with self._lock:
+            self._loaded[name] = self._loaded.get(name, 0) + 1
+            self._loaded.move_to_end(name)
+        self._unload_idle()
+
+    def release(self, name: str) -> None:
+        if not name:
+            return
+
+        with self._lock:
+            self._loaded[name] -= 1
+        self._unload_idle()
+
+    def adapter_names(self, names: List[str]) -> List[str]:
+        # Per row, as peft's forward(adapter_names=...) takes them
+        return [name or self.default_adapter for name in names]
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "loaded": len(self._loaded),
+                "loads": self.loads,
+                "unloads": self.unloads,
+            }
+
+    def _unload_idle(self) -> None:
+        # Adapters in use stay, even if that means holding more than
+        # max_loaded until their requests finish
+        with self._lock:
+            idle = [name for name, users in self._loaded.items() if users == 0]
+            unload = idle[: max(0, len(self._loaded) - self.max_loaded)]
+            for name in unload:
+                del self._loaded[name]
+
+        for name in unload:
+            self.model.delete_adapter(name)
+            self.unloads += 1
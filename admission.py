@@ -0,0 +1,336 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import time
+from collections import deque
+from typing import AsyncIterator, Collection, Deque, Dict, List, Optional, Set, Tuple
+
+# Why a message was turned away
+REJECT_RATE_LIMITED = "rate_limited"
+REJECT_CHAT_QUEUE_FULL = "chat_queue_full"
+REJECT_BUSY = "busy"
+
+# Seconds of model time a chat used count half as much this much later
+DEFAULT_USAGE_HALF_LIFE = 60.0
+# Below this many seconds of recent model time a chat is as good as new
+FORGET_USAGE = 0.01
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Turn:
+    """A chat's go at the model: the texts of its messages, oldest first."""
+
+    def __init__(self, texts: List[str], waited: float) -> None:
+        # Empty for a message that went along with an earlier one's turn
+        self.texts = texts
+        # Seconds the oldest message waited
+        self.waited = waited
+
+
+class TokenBucket:
+    """Allows burst messages at once and rate per second after that."""
+
+    def __init__(self, rate: float, burst: int, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens: float = burst
+        self.updated: float = now
+
+    def take(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class _Chat:
+    def __init__(self, bucket: TokenBucket, now: float) -> None:
+        self.bucket = bucket
+        # A future and the text of every waiting message; the future gets
+        # the texts of the turn it leads, or None when it went along with an
+        # earlier message
+        self.pending: Deque[Tuple[asyncio.Future, str]] = deque()
+        self.active: bool = False
+        # Set while the chat's first messages wait for more to come along
+        self.hold: Optional[asyncio.TimerHandle] = None
+        # Seconds of model time used, decaying, as of usage_at
+        self.usage: float = 0.0
+        self.usage_at: float = now
+
+    def recent_usage(self, now: float, half_life: float) -> float:
+        return self.usage * 0.5 ** ((now - self.usage_at) / half_life)
+
+
+class ChatAdmission:
+    """
+    Decides which chat's message gets to the model next, so a chat sending
+    messages as fast as it can doesn't starve everybody else. Every chat has
+    one turn at the model at a time, at most max_active chats together; the
+    others wait in their chat's queue (chat_queue_size messages at most).
+    Whenever a slot frees up it goes to the waiting chat that used the least
+    model time lately (halving every usage_half_life seconds), with
+    priority_chat_ids (the superuser) ahead of everybody, so a chat that
+    writes now and then is answered before one that keeps the model busy.
+    With coalesce, a chat's turn takes all of its waiting messages at once,
+    and a chat's first message waits coalesce_window seconds for the rest of
+    a burst to come along; messages sent during a reply wait for it anyway.
+    A message is turned away when its chat exceeds the token bucket (rate per
+    second after a burst, rate 0 for no limit) or its chat's queue is full.
+    With max_queued messages waiting across all chats, a newcomer pushes out
+    the latest waiting message of the chat that used the most model time, or
+    is turned away itself if that's its own. Priority chats are never rate
+    limited and never turned away as busy.
+    All of it runs on the event loop's thread, so nothing is locked.
+    """
+
+    def __init__(
+        self,
+        max_active: int,
+        max_queued: int,
+        chat_queue_size: int,
+        rate: float = 0.0,
+        burst: int = 1,
+        priority_chat_ids: Collection[str] = (),
+        usage_half_life: float = DEFAULT_USAGE_HALF_LIFE,
+        coalesce: bool = False,
+        coalesce_window: float = 0.0,
+    ) -> None:
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.chat_queue_size = chat_queue_size
+        self.rate = rate
+        self.burst = burst
+        self.priority_chat_ids = set(priority_chat_ids)
+        self.usage_half_life = usage_half_life
+        self.coalesce = coalesce
+        self.coalesce_window = coalesce_window
+
+        self._chats: Dict[str, _Chat] = {}
+        # Chats with a message waiting, none at the model and no hold
+        self._ready: Set[str] = set()
+        # Chats are swept for idle ones once there are this many
+        self._sweep_at: int = 1024
+
+        self.active: int = 0
+        self.queued: int = 0
+        self.admitted: int = 0
+        self.merged: int = 0
+        self.rejected: Dict[str, int] = {
+            REJECT_RATE_LIMITED: 0,
+            REJECT_CHAT_QUEUE_FULL: 0,
+            REJECT_BUSY: 0,
+        }
+
+    @contextlib.asynccontextmanager
+    async def slot(self, chat_id: str, text: str) -> AsyncIterator[Turn]:
+        # Waits for the turn of chat_id's message and holds it for the body;
+        # raises AdmissionRejected when turned away, before waiting or when
+        # pushed out while waiting
+        turn = self._enter(chat_id, text)
+        queued_at = time.monotonic()
+        try:
+            texts = await turn
+        except AdmissionRejected:
+            raise
+        except BaseException:
+            self._abandon(chat_id, turn)
+            raise
+
+        started = time.monotonic()
+        if texts is None:
+            yield Turn([], started - queued_at)
+            return
+        try:
+            yield Turn(texts, started - queued_at)
+        finally:
+            self._leave(chat_id, time.monotonic() - started)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "waiting_chats": len(self._ready),
+            "admitted": self.admitted,
+            "merged": self.merged,
+            **{f"rejected_{reason}": count for reason, count in self.rejected.items()},
+        }
+
+    def _enter(self, chat_id: str, text: str) -> asyncio.Future:
+        now = time.monotonic()
+        priority = chat_id in self.priority_chat_ids
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) >= self._sweep_at:
+                self._sweep(now)
+            chat = self._chats[chat_id] = _Chat(
+                TokenBucket(self.rate, self.burst, now), now
+            )
+
+        if self.rate > 0 and not priority and not chat.bucket.take(now):
+            self._reject(chat_id, REJECT_RATE_LIMITED)
+        if len(chat.pending) >= self.chat_queue_size:
+            self._reject(chat_id, REJECT_CHAT_QUEUE_FULL)
+        waits = chat.active or self.active >= self.max_active
+        if waits and not priority and self.queued >= self.max_queued:
+            victim = self._heaviest_waiting(now)
+            usage = chat.recent_usage(now, self.usage_half_life)
+            if (
+                victim is None
+                or victim == chat_id
+                or usage >= self._chats[victim].recent_usage(now, self.usage_half_life)
+            ):
+                self._reject(chat_id, REJECT_BUSY)
+            self._push_out(victim)
+
+        loop = asyncio.get_running_loop()
+        if not chat.pending and not chat.active and chat.hold is None:
+            if self.coalesce and self.coalesce_window > 0:
+                chat.hold = loop.call_later(
+                    self.coalesce_window, self._release, chat_id
+                )
+            else:
+                self._ready.add(chat_id)
+        turn: asyncio.Future = loop.create_future()
+        chat.pending.append((turn, text))
+        self.queued += 1
+        self.admitted += 1
+        self._dispatch()
+        return turn
+
+    def _release(self, chat_id: str) -> None:
+        # The chat's coalesce window is over
+        chat = self._chats[chat_id]
+        chat.hold = None
+        if chat.pending and not chat.active:
+            self._ready.add(chat_id)
+        self._forget_idle(chat_id)
+        self._dispatch()
+
+    def _reject(self, chat_id: str, reason: str) -> None:
+        self.rejected[reason] += 1
+        self._forget_idle(chat_id)
+        raise AdmissionRejected(reason)
+
+    def _heaviest_waiting(self, now: float) -> Optional[str]:
+        # The chat with a message waiting that used the most model time
+        # lately; only looked for with the queue full
+        return max(
+            (
+                chat_id
+                for chat_id, chat in self._chats.items()
+                if chat.pending and chat_id not in self.priority_chat_ids
+            ),
+            key=lambda chat_id: self._chats[chat_id].recent_usage(
+                now, self.usage_half_life
+            ),
+            default=None,
+        )
+
+    def _push_out(self, chat_id: str) -> None:
+        # Its latest waiting message is turned away as busy
+        chat = self._chats[chat_id]
+        turn, _ = chat.pending.pop()
+        self.queued -= 1
+        self.rejected[REJECT_BUSY] += 1
+        if not chat.pending:
+            self._ready.discard(chat_id)
+        if not turn.cancelled():
+            turn.set_exception(AdmissionRejected(REJECT_BUSY))
+
+    def _dispatch(self) -> None:
+        now = time.monotonic()
+        while self.active < self.max_active and self._ready:
+            chat_id = min(
+                self._ready,
+                key=lambda c: (
+                    c not in self.priority_chat_ids,
+                    self._chats[c].recent_usage(now, self.usage_half_life),
+                ),
+            )
+            chat = self._chats[chat_id]
+            count = len(chat.pending) if self.coalesce else 1
+            taken = [chat.pending.popleft() for _ in range(count)]
+            self.queued -= count
+            if not chat.pending:
+                self._ready.discard(chat_id)
+            # Cancelled handlers are on their way out, see _abandon
+            taken = [(turn, text) for turn, text in taken if not turn.cancelled()]
+            if not taken:
+                continue
+
+            self._ready.discard(chat_id)
+            chat.active = True
+            self.active += 1
+            leader, _ = taken[0]
+            leader.set_result([text for _, text in taken])
+            for turn, _ in taken[1:]:
+                turn.set_result(None)
+            self.merged += len(taken) - 1
+
+    def _leave(self, chat_id: str, held: float) -> None:
+        now = time.monotonic()
+        chat = self._chats[chat_id]
+        chat.active = False
+        chat.usage = chat.recent_usage(now, self.usage_half_life) + held
+        chat.usage_at = now
+        self.active -= 1
+        if chat.pending:
+            self._ready.add(chat_id)
+        self._forget_idle(chat_id)
+        self._dispatch()
+
+    def _abandon(self, chat_id: str, turn: asyncio.Future) -> None:
+        # The waiting handler was cancelled
+        if turn.done() and not turn.cancelled():
+            # Its turn had already come, unless it was pushed out or went
+            # along with an earlier message
+            if turn.exception() is None and turn.result() is not None:
+                self._leave(chat_id, 0.0)
+            return
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            return
+        for item in chat.pending:
+            if item[0] is turn:
+                chat.pending.remove(item)
+                break
+        else:
+            return
+        self.queued -= 1
+        if not chat.pending:
+            self._ready.discard(chat_id)
+        self._forget_idle(chat_id)
+
+    def _forget_idle(self, chat_id: str) -> None:
+        # A chat with nothing waiting, nothing at the model, a full bucket and
+        # next to no recent model time is no different from one never seen
+        chat = self._chats[chat_id]
+        now = time.monotonic()
+        if (
+            not chat.pending
+            and not chat.active
+            and chat.hold is None
+            and chat.bucket.full(now)
+            and chat.recent_usage(now, self.usage_half_life) < FORGET_USAGE
+        ):
+            del self._chats[chat_id]
+
+    def _sweep(self, now: float) -> None:
+        for chat_id in list(self._chats):
+            self._forget_idle(chat_id)
+        self._sweep_at = max(1024, 2 * len(self._chats))
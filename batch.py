@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import json
+import os
+import queue
+import time
+from dataclasses import replace
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Set,
+    TextIO,
+    Tuple,
+)
+
+from config import DEFAULT_BATCH_SORT_WINDOW
+from scheduler import GenerationRequest, SamplingParams
+from streaming import cut_at_stop_string
+
+if TYPE_CHECKING:
+    from chat import Chatbot
+
+
+def _stop_strings(value: Any) -> Tuple[str, ...]:
+    if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+        raise ValueError("stop_strings must be a list of strings")
+    return tuple(value)
+
+
+def _int(name: str) -> Callable[[Any], int]:
+    def read(value: Any) -> int:
+        # int() would cut 3.7 down to 3 and take true for 1
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{name} must be an integer")
+        if isinstance(value, float) and not value.is_integer():
+            raise ValueError(f"{name} must be an integer, not {value}")
+        return int(value)
+
+    return read
+
+
+def _bool(value: Any) -> bool:
+    # bool() would take "false" for True
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    raise ValueError("do_sample must be true or false")
+
+
+# Per-row "params" a batch row may override, and how to read them
+BATCH_SAMPLING_PARAMS: Dict[str, Callable[[Any], Any]] = {
+    "temperature": float,
+    "top_p": float,
+    "top_k": _int("top_k"),
+    "max_new_tokens": _int("max_new_tokens"),
+    "repetition_penalty": float,
+    "do_sample": _bool,
+    "stop_strings": _stop_strings,
+}
+
+
+def run_batch(
+    chatbot: Chatbot,
+    input_path: str,
+    output_path: str,
+    sort_window: int = DEFAULT_BATCH_SORT_WINDOW,
+    max_in_flight: int = 0,
+) -> Dict[str, float]:
+    # Answers every conversation of a JSONL file, appending one result per row
+    # to output_path in completion order. Rows whose id is already in the
+    # output are skipped, so rerunning the same command resumes an interrupted
+    # run. Only sort_window rows are read ahead; within a window prompts go
+    # in shortest first, so rows sharing the batch need little left padding.
+    completed = _completed_ids(output_path)
+    max_in_flight = max_in_flight or 2 * chatbot.max_batch_size
+    finished: "queue.Queue[Tuple[Any, GenerationRequest]]" = queue.Queue()
+    stats: Dict[str, float] = {
+        "rows": 0,
+        "skipped": 0,
+        "errors": 0,
+        "prompt_tokens": 0,
+        "output_tokens": 0,
+    }
+    started = time.perf_counter()
+
+    def write(sink: TextIO, result: Dict[str, Any]) -> None:
+        stats["rows"] += 1
+        if "error" in result:
+            stats["errors"] += 1
+        else:
+            stats["prompt_tokens"] += result["prompt_tokens"]
+            stats["output_tokens"] += result["output_tokens"]
+        sink.write(json.dumps(result, ensure_ascii=False) + "\n")
+        # A crash loses at most the rows still being generated
+        sink.flush()
+
+    def collect(sink: TextIO) -> None:
+        row_id, request = finished.get()
+        write(sink, _result(chatbot, row_id, request))
+
+    in_flight = 0
+    with open(input_path, "r") as source, open(output_path, "a") as sink:
+        rows = _read_rows(source, completed, stats)
+        for window in _windows(rows, sort_window):
+            prepared: List[Tuple[Any, List[int], SamplingParams, str]] = []
+            for row_id, row in window:
+                try:
+                    input_ids, params, adapter = prepare_row(chatbot, row)
+                except (KeyError, TypeError, ValueError) as e:
+                    write(sink, {"id": row_id, "error": str(e)})
+                    continue
+                prepared.append((row_id, input_ids, params, adapter))
+
+            prepared.sort(key=lambda item: len(item[1]))
+            for row_id, input_ids, params, adapter in prepared:
+                while in_flight >= max_in_flight:
+                    collect(sink)
+                    in_flight -= 1
+
+                chatbot.submit_generation(
+                    GenerationRequest(
+                        input_ids=input_ids,
+                        params=params,
+                        streamer=None,
+                        adapter=adapter,
+                        timeout=chatbot.generation_timeout,
+                        callback=lambda request, row_id=row_id: finished.put(
+                            (row_id, request)
+                        ),
+                    )
+                )
+                in_flight += 1
+
+        while in_flight > 0:
+            collect(sink)
+            in_flight -= 1
+
+    stats["seconds"] = time.perf_counter() - started
+    stats["tokens_per_second"] = (
+        stats["output_tokens"] / stats["seconds"] if stats["seconds"] else 0.0
+    )
+    return stats
+
+
+def _completed_ids(output_path: str) -> Set[str]:
+    completed: Set[str] = set()
+    if not os.path.exists(output_path):
+        return completed
+
+    with open(output_path, "rb+") as f:
+        end = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            end += len(line)
+            completed.add(json.dumps(json.loads(line)["id"]))
+        # Drop a line cut short by whatever stopped the previous run
+        f.truncate(end)
+    return completed
+
+
+def _read_rows(
+    source: TextIO, completed: Set[str], stats: Dict[str, float]
+) -> Iterator[Tuple[Any, Dict[str, Any]]]:
+    for line_number, line in enumerate(source, 1):
+        if not line.strip():
+            continue
+
+        try:
+            row: Dict[str, Any] = json.loads(line)
+        except json.JSONDecodeError as e:
+            row = {"id": line_number, "invalid": f"invalid JSON: {e}"}
+        if not isinstance(row, dict):
+            row = {"id": line_number, "invalid": "a row must be a JSON object"}
+
+        # Rows without an id are known by their line number
+        row_id = row.get("id", line_number)
+        if json.dumps(row_id) in completed:
+            stats["skipped"] += 1
+            continue
+        yield row_id, row
+
+
+def _windows(
+    rows: Iterator[Tuple[Any, Dict[str, Any]]], size: int
+) -> Iterator[List[Tuple[Any, Dict[str, Any]]]]:
+    window: List[Tuple[Any, Dict[str, Any]]] = []
+    for row in rows:
+        window.append(row)
+        if len(window) >= size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def prepare_row(
+    chatbot: Chatbot, row: Dict[str, Any]
+) -> Tuple[List[int], SamplingParams, str]:
+    # Prompt ids, sampling parameters and adapter of one conversation; the
+    # HTTP server (server.py) prepares its requests the same way
+    if "invalid" in row:
+        raise ValueError(row["invalid"])
+
+    if "messages" in row:
+        messages: List[Dict[str, str]] = row["messages"]
+    elif "prompt" in row:
+        messages = [{"role": "user", "content": row["prompt"]}]
+    else:
+        raise ValueError('a row needs "messages" or "prompt"')
+
+    # A conversation that brings its own system message gets no other one
+    system_message = row.get("system")
+    if any(message["role"] == "system" for message in messages):
+        system_message = ""
+
+    params = SamplingParams(
+        max_new_tokens=chatbot.max_new_tokens,
+        temperature=chatbot.temperature,
+        top_p=chatbot.top_p,
+        top_k=chatbot.top_k,
+        repetition_penalty=chatbot.repetition_penalty,
+        stop_strings=chatbot.stop_strings,
+    )
+    overrides: Dict[str, Any] = row.get("params", {})
+    for name, value in overrides.items():
+        if name not in BATCH_SAMPLING_PARAMS:
+            raise ValueError(
+                f"unknown param {name!r}, expected one of: "
+                f"{', '.join(BATCH_SAMPLING_PARAMS)}"
+            )
+        params = replace(params, **{name: BATCH_SAMPLING_PARAMS[name](value)})
+
+    adapter: str = row.get("adapter", "")
+    if adapter and (chatbot.adapters is None or adapter not in chatbot.adapters.paths):
+        raise ValueError(f"unknown LoRA adapter {adapter!r}")
+
+    _, input_ids = chatbot.build_prompt(messages, system_message)
+    budget = chatbot.context_token_budget - params.max_new_tokens
+    if len(input_ids) > budget:
+        raise ValueError(
+            f"prompt is {len(input_ids)} tokens, over the {budget} tokens left "
+            f"of the context budget after max_new_tokens"
+        )
+
+    return input_ids, params, adapter
+
+
+def _result(
+    chatbot: Chatbot, row_id: Any, request: GenerationRequest
+) -> Dict[str, Any]:
+    if request.error is not None:
+        return {"id": row_id, "error": str(request.error)}
+
+    response, _ = cut_at_stop_string(
+        chatbot.tokenizer.decode(request.output_ids, skip_special_tokens=True),
+        request.params.stop_strings,
+    )
+    return {
+        "id": row_id,
+        "response": response.strip(),
+        "prompt_tokens": len(request.input_ids),
+        "output_tokens": len(request.output_ids),
+        "finish_reason": request.finish_reason,
+    }
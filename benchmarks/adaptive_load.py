@@ -0,0 +1,220 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.tiny_model import CORPUS, build_tiny_model  # noqa: E402
+
+WORDS: List[str] = " ".join(CORPUS).split()
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(fraction: float) -> float:
+        return values[min(int(fraction * len(values)), len(values) - 1)]
+
+    return {
+        "mean": sum(values) / len(values),
+        "p50": at(0.5),
+        "p95": at(0.95),
+        "max": values[-1],
+    }
+
+
+def _phases(spec: str) -> List[Tuple[float, float]]:
+    # "20:0.5,30:4" -> 20s at 0.5 requests/s, then 30s at 4
+    phases: List[Tuple[float, float]] = []
+    for item in spec.split(","):
+        duration, rate = item.split(":")
+        phases.append((float(duration), float(rate)))
+    return phases
+
+
+def run(args: argparse.Namespace, model_dir: str, target: float) -> Dict[str, Any]:
+    os.environ.update(
+        {
+            "MODEL_NAME": model_dir,
+            "CHAT_TEMPLATE": os.environ.get("CHAT_TEMPLATE", "chatml"),
+            "DEVICE": os.environ.get("DEVICE", "cpu"),
+            "MAX_NEW_TOKENS": str(args.max_new_tokens),
+            "MAX_BATCH_SIZE": str(args.batch_size),
+            "ADAPTIVE_TARGET_P95": str(target),
+            "ADAPTIVE_INTERVAL": str(args.interval),
+        }
+    )
+    os.environ.update(item.split("=", 1) for item in args.env)
+
+    from chat import Chatbot
+
+    chatbot = Chatbot()
+    rng = random.Random(args.seed)
+    # Its own, so both modes get the same arrivals
+    user_rng = random.Random(args.seed + 1)
+    phases = _phases(args.phases)
+
+    # Open loop: requests arrive on schedule whether or not earlier ones are
+    # done, each from one of args.users chats with a growing history. A chat
+    # with a request in flight doesn't send another, that would cancel the
+    # reply to its previous one; with all of them busy a new chat comes along
+    results: List[Dict[str, Any]] = []
+    timeline: List[Dict[str, Any]] = []
+    lock = threading.Lock()
+    stop = threading.Event()
+    idle = set(range(args.users))
+
+    def request(phase: int, user: int, prompt: str) -> None:
+        started = time.perf_counter()
+        reply = chatbot.generate_response(
+            prompt, user_id=f"user-{user}", print_response=False
+        )
+        with lock:
+            idle.add(user)
+            results.append(
+                {
+                    "phase": phase,
+                    "latency": time.perf_counter() - started,
+                    "tokens": len(chatbot.tokenizer.encode(reply)),
+                }
+            )
+
+    def sample(started: float) -> None:
+        # What the limits were, once a second
+        while not stop.wait(1.0):
+            limits = chatbot.load_policy.limits
+            timeline.append(
+                {
+                    "t": round(time.perf_counter() - started, 1),
+                    "queue_depth": chatbot.scheduler.queue_depth(),
+                    **(
+                        {
+                            "max_new_tokens": limits.max_new_tokens,
+                            "prompt_tokens": limits.prompt_tokens,
+                            "batch_size": limits.batch_size,
+                        }
+                        if limits is not None
+                        else {}
+                    ),
+                }
+            )
+
+    threads: List[threading.Thread] = []
+    started = time.perf_counter()
+    sampler = threading.Thread(target=sample, args=(started,), daemon=True)
+    sampler.start()
+    phase_start = 0.0
+    for index, (duration, rate) in enumerate(phases):
+        at = phase_start + rng.expovariate(rate)
+        while at < phase_start + duration:
+            delay = started + at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            prompt = " ".join(rng.choices(WORDS, k=rng.randint(8, args.prompt_words)))
+            with lock:
+                user = (
+                    user_rng.choice(sorted(idle)) if idle else args.users + len(threads)
+                )
+                idle.discard(user)
+            thread = threading.Thread(target=request, args=(index, user, prompt))
+            thread.start()
+            threads.append(thread)
+            at += rng.expovariate(rate)
+        phase_start += duration
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - started
+    stop.set()
+    sampler.join()
+
+    summary: List[Dict[str, Any]] = []
+    for index, (duration, rate) in enumerate(phases):
+        done = [r for r in results if r["phase"] == index]
+        summary.append(
+            {
+                "seconds": duration,
+                "requests_per_second": rate,
+                "requests": len(done),
+                "latency_s": _percentiles([r["latency"] for r in done]),
+                "reply_tokens": _percentiles([r["tokens"] for r in done]),
+            }
+        )
+    result = {
+        "target_p95": target,
+        "env": args.env,
+        "wall_s": wall_time,
+        "phases": summary,
+        "adjustments": chatbot.load_policy.adjustments,
+        "policy": chatbot.format_policy(),
+        "timeline": timeline,
+    }
+    chatbot.close()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Drive a Chatbot with phases of open-loop load (quiet, "
+        "peak, quiet) against a tiny random model, with fixed limits and with "
+        "the load policy, and compare latency per phase"
+    )
+    parser.add_argument(
+        "--phases",
+        default="20:0.5,40:6,30:0.5",
+        help="comma separated seconds:requests per second",
+    )
+    parser.add_argument("--target", type=float, default=2.0, help="p95 seconds")
+    parser.add_argument("--interval", type=float, default=2.0)
+    parser.add_argument("--users", type=int, default=32)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--prompt-words", type=int, default=64)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument(
+        "--modes", default="fixed,adaptive", help="comma separated: fixed, adaptive"
+    )
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="extra environment, e.g. ADAPTIVE_MAX_BATCH_SIZE=16",
+    )
+    parser.add_argument("--model-dir", help="reuse/keep the tiny model here")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    model_dir = args.model_dir or os.path.join(
+        tempfile.gettempdir(), f"cli-llm-chat-tiny-{args.hidden_size}x{args.layers}"
+    )
+    # Tokenizer training and the load policy report on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        build_tiny_model(
+            model_dir, hidden_size=args.hidden_size, num_layers=args.layers
+        )
+        results = [
+            run(args, model_dir, args.target if mode == "adaptive" else 0.0)
+            for mode in args.modes.split(",")
+        ]
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
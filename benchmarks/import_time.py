@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List
+
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What the entry points must not import until a model is loaded
+HEAVY_MODULES: List[str] = ["torch", "transformers", "peft"]
+MODULES: List[str] = ["config", "chat", "telegram_chatbot"]
+
+_PROBE: str = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"seconds": elapsed, "heavy_modules": heavy}}))
+"""
+
+
+def measure(module: str, repeat: int) -> Dict[str, Any]:
+    env = {
+        **os.environ,
+        "TELEGRAM_BOT_USER_DATA_FILE": os.path.join(tempfile.gettempdir(), "u.db"),
+    }
+    runs: List[Dict[str, Any]] = []
+    # A fresh interpreter every time, or the second import would be free
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=ROOT,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    return {
+        "module": module,
+        "seconds": min(run["seconds"] for run in runs),
+        "heavy_modules": runs[0]["heavy_modules"],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Import time of the entry points, in fresh interpreters"
+    )
+    parser.add_argument("--modules", default=",".join(MODULES))
+    parser.add_argument("--repeat", type=int, default=3, help="best of N")
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=0.0,
+        help="fail when an import takes longer than this (0: no limit)",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help=f"fail when an import pulls in any of: {', '.join(HEAVY_MODULES)}",
+    )
+    args = parser.parse_args()
+
+    results = [measure(module, args.repeat) for module in args.modules.split(",")]
+    print(json.dumps(results, indent=2))
+
+    failures: List[str] = []
+    for result in results:
+        if args.check and result["heavy_modules"]:
+            failures.append(
+                f"importing {result['module']} imports "
+                f"{', '.join(result['heavy_modules'])}"
+            )
+        if args.max_seconds and result["seconds"] > args.max_seconds:
+            failures.append(
+                f"importing {result['module']} took {result['seconds']:.3f}s"
+            )
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+import argparse
+import asyncio
+import contextlib
+import gc
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch  # noqa: E402
+
+from benchmarks.tiny_model import CORPUS, build_tiny_model  # noqa: E402
+from config import (  # noqa: E402
+    ENV_VAR_COMPILE_DECODE,
+    ENV_VAR_CPU_IO_CORES,
+    ENV_VAR_CPU_QUANTIZATION,
+    ENV_VAR_DRAFT_MODEL_NAME,
+    ENV_VAR_PROMPT_LOOKUP,
+)
+from common import CHAT_TEMPLATES  # noqa: E402
+from cpu import CPU_QUANTIZATIONS  # noqa: E402
+from scheduler import GenerationRequest  # noqa: E402
+
+WORDS: List[str] = " ".join(CORPUS).split()
+
+
+def _rss() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class _PeakRSS:
+    # ru_maxrss never goes down, so a per-scenario peak needs sampling
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.peak: int = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self) -> "_PeakRSS":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self) -> None:
+        while True:
+            self.peak = max(self.peak, _rss())
+            if self._stop.wait(self.interval):
+                return
+
+
+class _Recorder:
+    """Keeps every request the scheduler sees and times prompt building."""
+
+    def __init__(self, chatbot: Any) -> None:
+        self.requests: List[GenerationRequest] = []
+        self.prompt_build_times: List[float] = []
+
+        submit: Callable = chatbot.scheduler.submit
+        build_history_prompt: Callable = chatbot.build_history_prompt
+
+        def recording_submit(request: GenerationRequest) -> GenerationRequest:
+            if request.streamer is not None:
+                self.requests.append(request)
+            return submit(request)
+
+        def timed_build_history_prompt(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            result = build_history_prompt(*args, **kwargs)
+            self.prompt_build_times.append(time.perf_counter() - started)
+            return result
+
+        chatbot.scheduler.submit = recording_submit
+        chatbot.build_history_prompt = timed_build_history_prompt
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(fraction: float) -> float:
+        return values[min(int(fraction * len(values)), len(values) - 1)]
+
+    return {
+        "mean": sum(values) / len(values),
+        "p50": at(0.5),
+        "p95": at(0.95),
+        "max": values[-1],
+    }
+
+
+def _trace(users: int, turns: int, seed: int) -> List[List[str]]:
+    rng = random.Random(seed)
+    return [
+        [" ".join(rng.choices(WORDS, k=rng.randint(4, 24))) for _ in range(turns)]
+        for _ in range(users)
+    ]
+
+
+def _summarize(recorder: _Recorder, wall_time: float, peak_rss: int) -> Dict[str, Any]:
+    ttft = [r.first_token_at - r.submitted_at for r in recorder.requests]
+    inter_token = [
+        (r.finished_at - r.first_token_at) / (len(r.output_ids) - 1)
+        for r in recorder.requests
+        if len(r.output_ids) > 1
+    ]
+    output_tokens = sum(len(r.output_ids) for r in recorder.requests)
+
+    result: Dict[str, Any] = {
+        "requests": len(recorder.requests),
+        "output_tokens": output_tokens,
+        "prompt_tokens": _percentiles([len(r.input_ids) for r in recorder.requests]),
+        "wall_time_s": wall_time,
+        "tokens_per_sec": output_tokens / wall_time if wall_time else 0.0,
+        "ttft_s": _percentiles(ttft),
+        "inter_token_latency_s": _percentiles(inter_token),
+        "prompt_build_s": _percentiles(recorder.prompt_build_times),
+        "peak_rss_mb": peak_rss / 1024 / 1024,
+    }
+    if torch.cuda.is_available():
+        result["peak_cuda_allocated_mb"] = torch.cuda.max_memory_allocated() / 2**20
+    return result
+
+
+async def _run_chatbot(chatbot: Any, trace: List[List[str]]) -> None:
+    async def conversation(user: int, messages: List[str]) -> None:
+        for message in messages:
+            async for _ in chatbot.astream_response(message, user_id=f"user-{user}"):
+                pass
+
+    await asyncio.gather(*[conversation(u, m) for u, m in enumerate(trace)])
+
+
+def _run_sync_chatbot(chatbot: Any, trace: List[List[str]]) -> None:
+    # generate_response is synchronous, so concurrency means threads
+    def conversation(user: int, messages: List[str]) -> None:
+        for message in messages:
+            chatbot.generate_response(
+                message, user_id=f"user-{user}", print_response=False
+            )
+
+    threads = [
+        threading.Thread(target=conversation, args=(u, m)) for u, m in enumerate(trace)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+async def _run_telegram(telegram_chatbot: Any, trace: List[List[str]]) -> List[float]:
+    reply_latencies: List[float] = []
+
+    def update_for(chat_id: int, text: str) -> Any:
+        started = time.perf_counter()
+        replied: List[bool] = []
+
+        async def edit_text(reply: str, **kwargs: Any) -> None:
+            pass
+
+        async def reply_text(reply: str, **kwargs: Any) -> Any:
+            # Time until the user sees something, the first message of a
+            # streamed or split reply included
+            if not replied:
+                reply_latencies.append(time.perf_counter() - started)
+                replied.append(True)
+            return SimpleNamespace(edit_text=edit_text)
+
+        return SimpleNamespace(
+            effective_chat=SimpleNamespace(id=chat_id),
+            message=SimpleNamespace(text=text, reply_text=reply_text),
+        )
+
+    async def send_chat_action(**kwargs: Any) -> None:
+        pass
+
+    context = SimpleNamespace(bot=SimpleNamespace(send_chat_action=send_chat_action))
+
+    async def conversation(user: int, messages: List[str]) -> None:
+        # The first message of a new chat registers the user's name
+        await telegram_chatbot.handle_message(update_for(user, f"user-{user}"), context)
+        for message in messages:
+            await telegram_chatbot.handle_message(update_for(user, message), context)
+
+    await asyncio.gather(*[conversation(u, m) for u, m in enumerate(trace)])
+    return reply_latencies
+
+
+def _load_chatbot(model_dir: str, template: str, env: Dict[str, str]) -> Any:
+    os.environ.update(
+        {
+            "MODEL_NAME": model_dir,
+            "CHAT_TEMPLATE": template,
+            "DEVICE": os.environ.get("DEVICE", "cpu"),
+        }
+    )
+    os.environ.update(env)
+
+    from chat import Chatbot
+
+    return Chatbot()
+
+
+def run_scenario(
+    model_dir: str,
+    template: str,
+    driver: str,
+    users: int,
+    turns: int,
+    env: Dict[str, str],
+    seed: int,
+) -> Dict[str, Any]:
+    # What loading took, rather than the peak: an earlier scenario's model
+    # may not be all handed back to the OS yet
+    gc.collect()
+    rss_before_load = _rss()
+    chatbot = _load_chatbot(model_dir, template, env)
+    load_rss = _rss() - rss_before_load
+    recorder = _Recorder(chatbot)
+    trace = _trace(users, turns, seed)
+
+    reply_latencies: Optional[List[float]] = None
+    with _PeakRSS() as peak_rss:
+        started = time.perf_counter()
+        if driver == "async":
+            asyncio.run(_run_chatbot(chatbot, trace))
+        elif driver == "sync":
+            _run_sync_chatbot(chatbot, trace)
+        else:
+            import telegram_chatbot
+            from user_registry import UserRegistry
+
+            logging.getLogger("telegram_chatbot").setLevel(logging.WARNING)
+
+            telegram_chatbot.chatbot = chatbot
+            telegram_chatbot.user_registry = UserRegistry(
+                os.path.join(tempfile.mkdtemp(), "users.db")
+            )
+            reply_latencies = asyncio.run(_run_telegram(telegram_chatbot, trace))
+            telegram_chatbot.user_registry.close()
+        wall_time = time.perf_counter() - started
+
+    chatbot.close()
+
+    result = {
+        "template": template,
+        "driver": driver,
+        "concurrency": users,
+        "turns": turns,
+        "env": env,
+        "startup_s": chatbot.startup_time,
+        "load_rss_mb": load_rss / 1024 / 1024,
+        **_summarize(recorder, wall_time, peak_rss.peak),
+    }
+    if reply_latencies is not None:
+        result["telegram_reply_latency_s"] = _percentiles(reply_latencies)
+    if chatbot.proposer is not None:
+        result["speculative"] = chatbot.scheduler.speculation_stats()
+    if chatbot.compiled_decoder is not None:
+        result["compiled"] = chatbot.compiled_decoder.stats()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Offline Chatbot benchmark against a tiny random local model"
+    )
+    parser.add_argument(
+        "--templates", default=",".join(CHAT_TEMPLATES), help="comma separated"
+    )
+    parser.add_argument(
+        "--drivers",
+        default="async,sync,telegram",
+        help="comma separated: async (astream_response), sync "
+        "(generate_response from threads), telegram (handle_message)",
+    )
+    parser.add_argument("--concurrency", default="1,4,8", help="comma separated")
+    parser.add_argument(
+        "--turns",
+        default="2,8",
+        help="comma separated turns per conversation, i.e. how deep history gets",
+    )
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="extra Chatbot environment, e.g. PREFIX_CACHE_MAX_TOKENS=0",
+    )
+    parser.add_argument("--model-dir", help="reuse/keep the tiny model here")
+    parser.add_argument(
+        "--model",
+        help="benchmark this model instead of the tiny random one, e.g. to see "
+        "real speculative acceptance rates (random weights accept almost nothing)",
+    )
+    parser.add_argument(
+        "--draft",
+        action="store_true",
+        help="build an even tinier draft model and use it via DRAFT_MODEL_NAME",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="decode through torch.compile on a static cache (COMPILE_DECODE)",
+    )
+    parser.add_argument(
+        "--cpu-quantization",
+        choices=CPU_QUANTIZATIONS,
+        help="run on CPU with int8 or bf16 weights (CPU_QUANTIZATION)",
+    )
+    parser.add_argument(
+        "--cpu-io-cores",
+        type=int,
+        default=0,
+        help="cores kept off generation for tokenization and I/O (CPU_IO_CORES)",
+    )
+    parser.add_argument(
+        "--baseline",
+        action="store_true",
+        help="rerun every scenario without speculative decoding, compiled "
+        "decode and the CPU settings, and report the tokens/sec gain and "
+        "memory ratio",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    model_dir = args.model_dir or os.path.join(
+        tempfile.gettempdir(), f"cli-llm-chat-tiny-{args.hidden_size}x{args.layers}"
+    )
+    if args.model:
+        model_dir = args.model
+    else:
+        # Tokenizer training reports progress on stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            build_tiny_model(
+                model_dir, hidden_size=args.hidden_size, num_layers=args.layers
+            )
+
+    env = dict(item.split("=", 1) for item in args.env)
+    env.setdefault("MAX_NEW_TOKENS", str(args.max_new_tokens))
+    if args.draft:
+        # Same tokenizer (it is trained deterministically), fewer weights
+        with contextlib.redirect_stdout(sys.stderr):
+            env[ENV_VAR_DRAFT_MODEL_NAME] = build_tiny_model(
+                f"{model_dir}-draft", hidden_size=32, num_layers=1
+            )
+    if args.compile:
+        env[ENV_VAR_COMPILE_DECODE] = "true"
+    if args.cpu_quantization:
+        env[ENV_VAR_CPU_QUANTIZATION] = args.cpu_quantization
+    if args.cpu_io_cores:
+        env[ENV_VAR_CPU_IO_CORES] = str(args.cpu_io_cores)
+
+    # Everything that turns speculative decoding, compiling or the CPU
+    # settings on, turned off: full precision weights, torch's threads
+    baseline_env = {
+        **env,
+        ENV_VAR_DRAFT_MODEL_NAME: "",
+        ENV_VAR_PROMPT_LOOKUP: "false",
+        ENV_VAR_COMPILE_DECODE: "false",
+        ENV_VAR_CPU_QUANTIZATION: "",
+        ENV_VAR_CPU_IO_CORES: "0",
+    }
+    os.environ.setdefault(
+        "TELEGRAM_BOT_USER_DATA_FILE", os.path.join(tempfile.mkdtemp(), "users.db")
+    )
+
+    drivers = args.drivers.split(",")
+    if "telegram" in drivers:
+        try:
+            import telegram  # noqa: F401
+        except ImportError:
+            print("python-telegram-bot not installed, skipping telegram driver")
+            drivers.remove("telegram")
+
+    combinations = itertools.product(
+        args.templates.split(","),
+        drivers,
+        [int(c) for c in args.concurrency.split(",")],
+        [int(t) for t in args.turns.split(",")],
+    )
+
+    scenarios = []
+    # Chatbot reports progress with print(), keep stdout for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        for template, driver, users, turns in combinations:
+            scenario = run_scenario(
+                model_dir, template, driver, users, turns, env, args.seed
+            )
+            if args.baseline:
+                baseline = run_scenario(
+                    model_dir, template, driver, users, turns, baseline_env, args.seed
+                )
+                scenario["baseline_tokens_per_sec"] = baseline["tokens_per_sec"]
+                scenario["tokens_per_sec_gain"] = (
+                    scenario["tokens_per_sec"] / baseline["tokens_per_sec"]
+                    if baseline["tokens_per_sec"]
+                    else 0.0
+                )
+                scenario["baseline_load_rss_mb"] = baseline["load_rss_mb"]
+                scenario["baseline_peak_rss_mb"] = baseline["peak_rss_mb"]
+                scenario["load_rss_ratio"] = (
+                    scenario["load_rss_mb"] / baseline["load_rss_mb"]
+                    if baseline["load_rss_mb"] > 0
+                    else 0.0
+                )
+            scenarios.append(scenario)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "device": os.environ.get("DEVICE", "cpu"),
+        "model": args.model or {"hidden_size": args.hidden_size, "layers": args.layers},
+        "scenarios": scenarios,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
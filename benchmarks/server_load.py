@@ -0,0 +1,247 @@
+import argparse
+import contextlib
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.tiny_model import CORPUS, build_tiny_model  # noqa: E402
+
+WORDS: List[str] = " ".join(CORPUS).split()
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(fraction: float) -> float:
+        return values[min(int(fraction * len(values)), len(values) - 1)]
+
+    return {
+        "mean": sum(values) / len(values),
+        "p50": at(0.5),
+        "p95": at(0.95),
+        "max": values[-1],
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def _server(args: argparse.Namespace, env: Dict[str, str]) -> Any:
+    # `chat.py serve` in a process of its own, so clients and model don't
+    # share a GIL; yields its URL once it answers
+    port = _free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(ROOT, "chat.py"),
+            "serve",
+            "--port",
+            str(port),
+            "--max-concurrent",
+            str(args.max_concurrent),
+            "--max-queued",
+            str(args.max_queued),
+        ],
+        env={**os.environ, **env},
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        for line in process.stdout:
+            print(line, end="", file=sys.stderr)
+            if line.startswith("Serving chat completions"):
+                break
+        else:
+            raise RuntimeError("the server exited before it was ready")
+        threading.Thread(
+            target=lambda: [print(l, end="", file=sys.stderr) for l in process.stdout],
+            daemon=True,
+        ).start()
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        # Like Ctrl-C: the server closes the chatbot on its way out
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def _request(
+    connection: http.client.HTTPConnection,
+    rng: random.Random,
+    args: argparse.Namespace,
+) -> Dict[str, Any]:
+    prompt = " ".join(rng.choices(WORDS, k=rng.randint(8, args.prompt_words)))
+    body: Dict[str, Any] = {
+        "model": "benchmark",
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": args.max_tokens,
+        "temperature": args.temperature,
+        "stream": not args.no_stream,
+        "stream_options": {"include_usage": True},
+    }
+    result: Dict[str, Any] = {"status": 0, "tokens": 0}
+    started = time.perf_counter()
+    connection.request(
+        "POST",
+        "/v1/chat/completions",
+        json.dumps(body),
+        {"Content-Type": "application/json"},
+    )
+    response = connection.getresponse()
+    result["status"] = response.status
+    if response.status != 200 or args.no_stream:
+        payload = json.loads(response.read())
+        if response.status == 200:
+            result["tokens"] = payload["usage"]["completion_tokens"]
+    else:
+        for line in response:
+            if not line.startswith(b"data: ") or line.startswith(b"data: [DONE]"):
+                continue
+            event = json.loads(line[len(b"data: ") :])
+            if event.get("usage"):
+                result["tokens"] = event["usage"]["completion_tokens"]
+            for choice in event.get("choices", []):
+                if "ttft" not in result and choice["delta"].get("content"):
+                    result["ttft"] = time.perf_counter() - started
+    result["latency"] = time.perf_counter() - started
+    return result
+
+
+def run_level(url: str, clients: int, args: argparse.Namespace) -> Dict[str, Any]:
+    # clients threads, each sending requests_per_client requests back to back
+    # over one keep-alive connection
+    address = urlsplit(url)
+    results: List[Dict[str, Any]] = []
+    connections: List[int] = []
+    lock = threading.Lock()
+
+    def client(index: int) -> None:
+        rng = random.Random(args.seed * 1000 + index)
+        connection = http.client.HTTPConnection(address.hostname, address.port)
+        opened = 0
+        for _ in range(args.requests_per_client):
+            if connection.sock is None:
+                opened += 1
+            try:
+                result = _request(connection, rng, args)
+            except (OSError, http.client.HTTPException) as e:
+                result = {"status": 0, "tokens": 0, "error": str(e)}
+                connection.close()
+            with lock:
+                results.append(result)
+        connection.close()
+        with lock:
+            connections.append(opened)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - started
+
+    ok = [r for r in results if r["status"] == 200]
+    tokens = sum(r["tokens"] for r in ok)
+    return {
+        "clients": clients,
+        "requests": len(results),
+        "ok": len(ok),
+        "rejected": sum(1 for r in results if r["status"] == 429),
+        "failed": sum(1 for r in results if r["status"] not in [200, 429]),
+        "errors": sorted({r["error"] for r in results if "error" in r})[:5],
+        "connections_opened": sum(connections),
+        "wall_seconds": wall_time,
+        "requests_per_second": len(ok) / wall_time,
+        "tokens_per_second": tokens / wall_time,
+        "ttft_seconds": _percentiles([r["ttft"] for r in ok if "ttft" in r]),
+        "latency_seconds": _percentiles([r["latency"] for r in ok]),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Throughput and latency of `chat.py serve` under concurrent "
+        "clients, against a tiny random local model unless --url is given"
+    )
+    parser.add_argument("--url", help="benchmark this running server instead")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated")
+    parser.add_argument("--requests-per-client", type=int, default=8)
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--prompt-words", type=int, default=64)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument(
+        "--no-stream", action="store_true", help="ask for whole replies, not SSE"
+    )
+    parser.add_argument("--max-concurrent", type=int, default=0)
+    parser.add_argument("--max-queued", type=int, default=64)
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="extra server environment, e.g. MAX_BATCH_SIZE=16",
+    )
+    parser.add_argument("--model-dir", help="reuse/keep the tiny model here")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    levels = [int(clients) for clients in args.concurrency.split(",")]
+    if args.url:
+        results = [run_level(args.url, clients, args) for clients in levels]
+    else:
+        model_dir = args.model_dir or os.path.join(
+            tempfile.gettempdir(),
+            f"cli-llm-chat-tiny-{args.hidden_size}x{args.layers}",
+        )
+        # Tokenizer training reports progress on stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            build_tiny_model(
+                model_dir, hidden_size=args.hidden_size, num_layers=args.layers
+            )
+        env = {
+            "MODEL_NAME": model_dir,
+            "CHAT_TEMPLATE": os.environ.get("CHAT_TEMPLATE", "chatml"),
+            "DEVICE": os.environ.get("DEVICE", "cpu"),
+        }
+        env.update(item.split("=", 1) for item in args.env)
+        with _server(args, env) as url:
+            results = [run_level(url, clients, args) for clients in levels]
+
+    output = json.dumps(
+        {"max_tokens": args.max_tokens, "stream": not args.no_stream, "runs": results},
+        indent=2,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_store import (  # noqa: E402
+    SESSION_STORE_MEMORY,
+    SESSION_STORE_SQLITE,
+    SessionStore,
+    SQLiteSessionStore,
+)
+
+
+def run(
+    backend: str, sessions: int, messages: int, max_sessions: int, reads: int
+) -> Dict[str, float]:
+    directory = tempfile.mkdtemp()
+    if backend == SESSION_STORE_SQLITE:
+        store: SessionStore = SQLiteSessionStore(
+            os.path.join(directory, "sessions.db"), max_sessions
+        )
+    else:
+        store = SessionStore(max_sessions)
+
+    tracemalloc.start()
+
+    started = time.perf_counter()
+    for user in range(sessions):
+        for message in range(messages):
+            role = "user" if message % 2 == 0 else "assistant"
+            content = f"{user}:{message}:" + "x" * 200
+            store.append(str(user), {"role": role, "content": content})
+    store.flush()
+    write_time = time.perf_counter() - started
+
+    rng = random.Random(0)
+    started = time.perf_counter()
+    found = 0
+    for _ in range(reads):
+        found += len(store.messages(str(rng.randrange(sessions)))) > 0
+    read_time = time.perf_counter() - started
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    store.close()
+
+    return {
+        "backend": backend,
+        "sessions": sessions,
+        "messages_per_session": messages,
+        "max_hot_sessions": max_sessions,
+        "appends_per_sec": sessions * messages / write_time,
+        "random_reads_per_sec": reads / read_time,
+        # Cold sessions are forgotten by the in-memory store and reloaded by
+        # the persistent one
+        "random_read_hit_ratio": found / reads,
+        "hot_sessions": store.hot_sessions(),
+        "peak_traced_memory_mb": peak / 1024 / 1024,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Session store benchmark")
+    parser.add_argument("--sessions", type=int, default=100_000)
+    parser.add_argument("--messages", type=int, default=4)
+    parser.add_argument("--max-sessions", type=int, default=10_000)
+    parser.add_argument("--reads", type=int, default=20_000)
+    parser.add_argument(
+        "--backend",
+        choices=[SESSION_STORE_MEMORY, SESSION_STORE_SQLITE],
+        action="append",
+    )
+    args = parser.parse_args()
+
+    results = [
+        run(backend, args.sessions, args.messages, args.max_sessions, args.reads)
+        for backend in args.backend or [SESSION_STORE_MEMORY, SESSION_STORE_SQLITE]
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch  # noqa: E402
+from transformers import (  # noqa: E402
+    AsyncTextIteratorStreamer,
+    AutoTokenizer,
+    TextIteratorStreamer,
+)
+
+from benchmarks.tiny_model import CORPUS, build_tiny_model  # noqa: E402
+from streaming import TokenStream  # noqa: E402
+
+# What Chatbot streamed through before TokenStream, and TokenStream itself
+STREAMERS = ["transformers", "token_stream"]
+
+
+def _streamer(kind: str, driver: str, tokenizer: Any, chunk_tokens: int) -> Any:
+    if kind == "token_stream":
+        return TokenStream(tokenizer, chunk_tokens=chunk_tokens)
+    if driver == "async":
+        return AsyncTextIteratorStreamer(
+            tokenizer, skip_prompt=False, skip_special_tokens=True
+        )
+    return TextIteratorStreamer(tokenizer, skip_prompt=False, skip_special_tokens=True)
+
+
+def _produce(streamers: List[Any], token_ids: List[int]) -> float:
+    # Like the scheduler: one token for every stream per decode step. Returns
+    # the time spent inside put/end, which is time the decode loop is not
+    # running the model.
+    spent = 0.0
+    for token_id in token_ids:
+        for streamer in streamers:
+            value = torch.tensor([token_id])
+            started = time.perf_counter()
+            streamer.put(value)
+            spent += time.perf_counter() - started
+    started = time.perf_counter()
+    for streamer in streamers:
+        streamer.end()
+    return spent + time.perf_counter() - started
+
+
+def _consume_sync(kind: str, streamer: Any, chunks: List[int]) -> str:
+    response = ""
+    count = 0
+    for text in streamer:
+        # The reply as Chatbot used to build it, and as it does now
+        if kind == "transformers":
+            response += text
+        count += 1
+    chunks.append(count)
+    return response if kind == "transformers" else streamer.text()
+
+
+async def _consume_async(kind: str, streamer: Any, chunks: List[int]) -> str:
+    response = ""
+    count = 0
+    async for text in streamer:
+        if kind == "transformers":
+            response += text
+        count += 1
+    chunks.append(count)
+    return response if kind == "transformers" else await streamer.atext()
+
+
+def run(
+    kind: str,
+    driver: str,
+    tokenizer: Any,
+    streams: int,
+    token_ids: List[int],
+    chunk_tokens: int,
+) -> Dict[str, Any]:
+    chunks: List[int] = []
+    replies: List[str] = []
+    producer_time: List[float] = []
+
+    started = time.perf_counter()
+    if driver == "async":
+
+        async def main() -> None:
+            # The async streamers hand text over through the running loop
+            streamers = [
+                _streamer(kind, driver, tokenizer, chunk_tokens) for _ in range(streams)
+            ]
+            readers = [
+                asyncio.ensure_future(_consume_async(kind, s, chunks))
+                for s in streamers
+            ]
+            producer_time.append(
+                await asyncio.to_thread(_produce, streamers, token_ids)
+            )
+            replies.extend(await asyncio.gather(*readers))
+
+        asyncio.run(main())
+    else:
+        streamers = [
+            _streamer(kind, driver, tokenizer, chunk_tokens) for _ in range(streams)
+        ]
+        results: List[str] = [""] * streams
+
+        def reader(index: int) -> Callable[[], None]:
+            def read() -> None:
+                results[index] = _consume_sync(kind, streamers[index], chunks)
+
+            return read
+
+        threads = [threading.Thread(target=reader(i)) for i in range(streams)]
+        for thread in threads:
+            thread.start()
+        producer_time.append(_produce(streamers, token_ids))
+        for thread in threads:
+            thread.join()
+        replies.extend(results)
+    wall_time = time.perf_counter() - started
+
+    tokens = streams * len(token_ids)
+    expected = tokenizer.decode(token_ids, skip_special_tokens=True)
+    return {
+        "streamer": kind,
+        "driver": driver,
+        "streams": streams,
+        "tokens_per_stream": len(token_ids),
+        "chunk_tokens": chunk_tokens if kind == "token_stream" else 1,
+        # Per token streamed: on the scheduler thread, and end to end
+        "producer_us_per_token": producer_time[0] / tokens * 1e6,
+        "wall_us_per_token": wall_time / tokens * 1e6,
+        "chunks_per_stream": sum(chunks) / len(chunks),
+        "replies_match_decode": all(
+            reply.strip() == expected.strip() for reply in replies
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Per-token overhead of streaming replies to many readers"
+    )
+    parser.add_argument("--streams", default="1,16,64", help="comma separated")
+    parser.add_argument("--tokens", type=int, default=256)
+    parser.add_argument("--drivers", default="sync,async", help="comma separated")
+    parser.add_argument("--chunk-tokens", type=int, default=1)
+    parser.add_argument(
+        "--tokenizer", help="tokenizer to decode with instead of the tiny one"
+    )
+    args = parser.parse_args()
+
+    tokenizer_dir = args.tokenizer
+    if not tokenizer_dir:
+        tokenizer_dir = os.path.join(tempfile.gettempdir(), "cli-llm-chat-tiny-64x2")
+        with contextlib.redirect_stdout(sys.stderr):
+            build_tiny_model(tokenizer_dir)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir)
+
+    # Real text, so decoding costs what it costs on replies
+    token_ids: List[int] = []
+    while len(token_ids) < args.tokens:
+        token_ids += tokenizer.encode(" ".join(CORPUS), add_special_tokens=False)
+    token_ids = token_ids[: args.tokens]
+
+    results = [
+        run(kind, driver, tokenizer, int(streams), token_ids, args.chunk_tokens)
+        for driver in args.drivers.split(",")
+        for streams in args.streams.split(",")
+        for kind in STREAMERS
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
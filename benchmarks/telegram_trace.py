@@ -0,0 +1,273 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.tiny_model import CORPUS, build_tiny_model  # noqa: E402
+
+WORDS: List[str] = " ".join(CORPUS).split()
+
+# Chat ids of the well-behaved users start here, the abusive ones after them
+FIRST_CHAT_ID = 1000
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(fraction: float) -> float:
+        return values[min(int(fraction * len(values)), len(values) - 1)]
+
+    return {
+        "mean": sum(values) / len(values),
+        "p50": at(0.5),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": values[-1],
+    }
+
+
+def build_trace(args: argparse.Namespace) -> List[Tuple[float, int, str]]:
+    # (seconds from the start, chat id, text): users write a burst of 1 to
+    # user_burst messages, a second or so apart, every user_interval seconds
+    # on average, abusers a message every abuser_interval
+    rng = random.Random(args.seed)
+    trace: List[Tuple[float, int, str]] = []
+    senders = [
+        (FIRST_CHAT_ID + i, args.user_interval, args.user_burst)
+        for i in range(args.users)
+    ]
+    senders += [
+        (FIRST_CHAT_ID + args.users + i, args.abuser_interval, 1)
+        for i in range(args.abusers)
+    ]
+    for chat_id, interval, burst in senders:
+        at = rng.uniform(0, interval)
+        while at < args.duration:
+            sent = at
+            for _ in range(rng.randint(1, burst)):
+                text = " ".join(rng.choices(WORDS, k=rng.randint(3, 20)))
+                trace.append((sent, chat_id, text))
+                sent += rng.uniform(0.3, 1.5)
+            at += rng.expovariate(1 / interval)
+    trace.sort()
+    return trace
+
+
+async def replay(
+    telegram_chatbot: Any, trace: List[Tuple[float, int, str]]
+) -> Dict[int, List[Dict[str, Any]]]:
+    # Every message becomes its own handler task, like Telegram updates with
+    # concurrent_updates; returns what happened to each, by chat
+    outcomes: Dict[int, List[Dict[str, Any]]] = {}
+    rejections = set(telegram_chatbot.REJECTION_MESSAGES.values())
+
+    def update_for(chat_id: int, text: str) -> Any:
+        outcome: Dict[str, Any] = {"sent": time.perf_counter()}
+        outcomes.setdefault(chat_id, []).append(outcome)
+
+        async def edit_text(reply: str, **kwargs: Any) -> None:
+            pass
+
+        async def reply_text(reply: str, **kwargs: Any) -> Any:
+            if "replied" not in outcome:
+                outcome["replied"] = time.perf_counter() - outcome["sent"]
+                outcome["rejected"] = reply in rejections
+            return SimpleNamespace(edit_text=edit_text)
+
+        return SimpleNamespace(
+            effective_chat=SimpleNamespace(id=chat_id),
+            message=SimpleNamespace(text=text, reply_text=reply_text),
+        )
+
+    async def send_chat_action(**kwargs: Any) -> None:
+        pass
+
+    context = SimpleNamespace(bot=SimpleNamespace(send_chat_action=send_chat_action))
+
+    # Everybody is registered up front
+    for chat_id in {chat_id for _, chat_id, _ in trace}:
+        telegram_chatbot.user_registry.register(str(chat_id), f"user-{chat_id}")
+
+    tasks: List[asyncio.Task] = []
+    started = time.perf_counter()
+    for at, chat_id, text in trace:
+        delay = started + at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(
+            asyncio.ensure_future(
+                telegram_chatbot.handle_message(update_for(chat_id, text), context)
+            )
+        )
+    await asyncio.gather(*tasks)
+    return outcomes
+
+
+def summarize(
+    outcomes: Dict[int, List[Dict[str, Any]]],
+    generations: Dict[str, int],
+    chat_ids: List[int],
+) -> Dict[str, Any]:
+    messages = [
+        outcome for chat_id in chat_ids for outcome in outcomes.get(chat_id, [])
+    ]
+    answered = [m for m in messages if "replied" in m and not m["rejected"]]
+    started = sum(generations.get(str(chat_id), 0) for chat_id in chat_ids)
+    active = sum(1 for chat_id in chat_ids if outcomes.get(chat_id))
+    return {
+        "chats": len(chat_ids),
+        "messages": len(messages),
+        "answered": len(answered),
+        "rejected": sum(1 for m in messages if m.get("rejected")),
+        # Superseded by a newer message of the same chat, answered along with
+        # an earlier one, or never answered
+        "unanswered": sum(1 for m in messages if "replied" not in m),
+        "generations": started,
+        "generations_per_chat": started / active if active else 0.0,
+        # From the message a reply answers; with coalescing the first of them
+        "reply_latency_s": _percentiles([m["replied"] for m in answered]),
+    }
+
+
+def run(args: argparse.Namespace, model_dir: str, mode: str) -> Dict[str, Any]:
+    os.environ.update(
+        {
+            "MODEL_NAME": model_dir,
+            "CHAT_TEMPLATE": os.environ.get("CHAT_TEMPLATE", "chatml"),
+            "DEVICE": os.environ.get("DEVICE", "cpu"),
+            "MAX_NEW_TOKENS": str(args.max_new_tokens),
+            "TELEGRAM_BOT_USER_DATA_FILE": os.path.join(tempfile.mkdtemp(), "users.db"),
+        }
+    )
+    os.environ.update(item.split("=", 1) for item in args.env)
+
+    import telegram_chatbot
+    from admission import ChatAdmission
+    from chat import Chatbot
+    from config import TelegramConfig
+    from user_registry import UserRegistry
+
+    logging.getLogger("telegram_chatbot").setLevel(logging.WARNING)
+
+    chatbot = Chatbot()
+    config = TelegramConfig.from_env()
+    telegram_chatbot.telegram_config = config
+    telegram_chatbot.chatbot = chatbot
+    telegram_chatbot.user_registry = UserRegistry(config.user_data_file)
+    telegram_chatbot.admission = None
+    if mode != "none":
+        # As main() sets it up
+        telegram_chatbot.admission = ChatAdmission(
+            max_active=config.max_active_chats or chatbot.max_batch_size,
+            max_queued=config.max_queued_messages,
+            chat_queue_size=config.chat_queue_size,
+            rate=config.rate_limit,
+            burst=config.rate_burst,
+            coalesce=mode == "coalesce" and config.coalesce_messages,
+            coalesce_window=config.coalesce_window,
+        )
+
+    # Generations started per chat, whether or not they got to reply
+    generations: Dict[str, int] = {}
+    for name in ["agenerate_response", "astream_response"]:
+
+        def counted(text: str, user_id: str, original: Any = getattr(chatbot, name)):
+            generations[user_id] = generations.get(user_id, 0) + 1
+            return original(text, user_id=user_id)
+
+        setattr(chatbot, name, counted)
+
+    trace = build_trace(args)
+    started = time.perf_counter()
+    outcomes = asyncio.run(replay(telegram_chatbot, trace))
+    wall_time = time.perf_counter() - started
+    requests = chatbot.metrics.requests.value
+
+    telegram_chatbot.user_registry.close()
+    chatbot.close()
+
+    users = [FIRST_CHAT_ID + i for i in range(args.users)]
+    abusers = [FIRST_CHAT_ID + args.users + i for i in range(args.abusers)]
+    result: Dict[str, Any] = {
+        "mode": mode,
+        "env": args.env,
+        "wall_s": wall_time,
+        "requests": requests,
+        "users": summarize(outcomes, generations, users),
+        "abusers": summarize(outcomes, generations, abusers),
+    }
+    if telegram_chatbot.admission is not None:
+        result["admission_stats"] = telegram_chatbot.admission.stats()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Replay a Telegram message trace of well-behaved and abusive "
+        "chats through the bot's message handler, against a tiny random model"
+    )
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument(
+        "--user-interval", type=float, default=12.0, help="mean seconds between bursts"
+    )
+    parser.add_argument(
+        "--user-burst", type=int, default=3, help="most messages in a row per user"
+    )
+    parser.add_argument("--abusers", type=int, default=16)
+    parser.add_argument("--abuser-interval", type=float, default=0.1)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument(
+        "--modes",
+        default="none,admission,coalesce",
+        help="comma separated: none (every message goes straight to the model), "
+        "admission (ChatAdmission with the TELEGRAM_BOT_* settings, one "
+        "generation per message), coalesce (admission answering a chat's "
+        "waiting messages together, as the bot does)",
+    )
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="extra environment, e.g. TELEGRAM_BOT_RATE_LIMIT=1",
+    )
+    parser.add_argument("--model-dir", help="reuse/keep the tiny model here")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    model_dir = args.model_dir or os.path.join(
+        tempfile.gettempdir(), f"cli-llm-chat-tiny-{args.hidden_size}x{args.layers}"
+    )
+    # Tokenizer training reports progress on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        build_tiny_model(
+            model_dir, hidden_size=args.hidden_size, num_layers=args.layers
+        )
+        results = [run(args, model_dir, mode) for mode in args.modes.split(",")]
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import os
+from typing import List
+
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+SPECIAL_TOKENS: List[str] = ["<unk>", "<s>", "</s>", "<|im_start|>", "<|im_end|>"]
+
+CORPUS: List[str] = [
+    "hello there, how are you doing today?",
+    "the quick brown fox jumps over the lazy dog",
+    "tell me a joke about tokenizers and language models",
+    "USER: ASSISTANT: [INST] [/INST] system user assistant",
+    "what is the meaning of life, the universe and everything?",
+    "I am fine, thanks. And you? Nothing much, just benchmarking.",
+]
+
+
+def build_tiny_model(
+    directory: str,
+    vocab_size: int = 512,
+    hidden_size: int = 64,
+    num_layers: int = 2,
+    num_heads: int = 4,
+    max_position_embeddings: int = 4096,
+) -> str:
+    """
+    Save a randomly initialized Llama-style causal LM and a byte-level BPE
+    tokenizer trained on a toy corpus to `directory`, so Chatbot can load it
+    through MODEL_NAME without touching the network. Outputs are gibberish;
+    only the shapes and the code paths matter.
+    """
+    if os.path.exists(os.path.join(directory, "config.json")):
+        return directory
+
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(
+        CORPUS * 20,
+        trainers.BpeTrainer(
+            vocab_size=vocab_size,
+            special_tokens=SPECIAL_TOKENS,
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        ),
+    )
+
+    fast_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<s>",
+        eos_token="</s>",
+        unk_token="<unk>",
+    )
+    fast_tokenizer.save_pretrained(directory)
+
+    model = LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=len(fast_tokenizer),
+            hidden_size=hidden_size,
+            intermediate_size=hidden_size * 2,
+            num_hidden_layers=num_layers,
+            num_attention_heads=num_heads,
+            num_key_value_heads=max(num_heads // 2, 1),
+            max_position_embeddings=max_position_embeddings,
+            bos_token_id=fast_tokenizer.bos_token_id,
+            eos_token_id=fast_tokenizer.eos_token_id,
+        )
+    )
+    model.save_pretrained(directory)
+
+    return directory
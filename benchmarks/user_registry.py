@@ -0,0 +1,89 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from user_registry import UserRegistry  # noqa: E402
+
+
+def run_registry(directory: str, users: int) -> Dict[str, float]:
+    path = os.path.join(directory, "users.db")
+
+    registry = UserRegistry(path)
+    started = time.perf_counter()
+    for chat_id in range(users):
+        registry.register(str(chat_id), f"user-{chat_id}")
+    enqueued = time.perf_counter() - started
+    registry.flush()
+    committed = time.perf_counter() - started
+    registry.close()
+
+    started = time.perf_counter()
+    registry = UserRegistry(path)
+    startup = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for chat_id in range(0, users, max(users // 10_000, 1)):
+        registry.get(str(chat_id))
+    lookups = len(range(0, users, max(users // 10_000, 1)))
+    lookup_time = time.perf_counter() - started
+    registry.close()
+
+    return {
+        "backend": "sqlite",
+        "users": users,
+        # What the bot's event loop sees
+        "registrations_per_sec": users / enqueued,
+        "committed_registrations_per_sec": users / committed,
+        "startup_seconds": startup,
+        "cold_lookups_per_sec": lookups / lookup_time,
+    }
+
+
+def run_legacy_json(directory: str, users: int, samples: int) -> Dict[str, float]:
+    # The old save_user_data: rewrite the whole file on every registration.
+    # Timed on a registry that already holds `users` entries.
+    path = os.path.join(directory, "users.json")
+    user_data = {str(chat_id): f"user-{chat_id}" for chat_id in range(users)}
+
+    started = time.perf_counter()
+    for sample in range(samples):
+        user_data[f"new-{sample}"] = "new"
+        with open(path, "w") as f:
+            json.dump(user_data, f)
+    per_registration = (time.perf_counter() - started) / samples
+
+    started = time.perf_counter()
+    with open(path, "r") as f:
+        json.load(f)
+    startup = time.perf_counter() - started
+
+    return {
+        "backend": "json",
+        "users": users,
+        "registrations_per_sec": 1 / per_registration,
+        "startup_seconds": startup,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="User registry benchmark")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--legacy-samples", type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    results = [
+        run_registry(directory, args.users),
+        run_legacy_json(directory, args.users, args.legacy_samples),
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
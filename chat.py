@@ -1,116 +1,126 @@
-import os
-from typing import List, Dict, Optional, Union
-import torch
+from __future__ import annotations
+
+import argparse
+import time
+import threading
+import asyncio
 import logging
-from transformers import (
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    TextIteratorStreamer,
-    BitsAndBytesConfig,
+from dataclasses import asdict, fields
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Hashable,
+    Iterator,
+    List,
+    Dict,
+    Optional,
+    Tuple,
+    Union,
 )
-from peft import PeftModel
-from threading import Thread
 from common import CHAT_TEMPLATES, SKELETON_KEY_JAILBREAK_PROMPT
+from config import (
+    DEFAULT_BATCH_SORT_WINDOW,
+    DEFAULT_SERVER_HOST,
+    DEFAULT_SERVER_MAX_QUEUED_REQUESTS,
+    DEFAULT_SERVER_PORT,
+    ENV_VAR_CHAT_TEMPLATE,
+    ENV_VAR_DRAFT_MODEL_NAME,
+    ChatbotConfig,
+    ConfigError,
+)
+from cpu import (
+    load_dtype,
+    pin_process,
+    quantize_for_cpu,
+    set_threads,
+    split_cores,
+)
+from load_policy import Limits, LoadPolicy
+from prompt import PromptTokenizer
+from session_store import SESSION_STORE_SQLITE, SessionStore, SQLiteSessionStore
+from metrics import Metrics
+from response_cache import ResponseCache, response_cache_key
+from streaming import TokenStream
+
+# torch, transformers and peft take seconds to import; they are imported by
+# Chatbot when it loads the model, so reading and validating the settings
+# (and the Telegram bot connecting) doesn't have to wait for them.
+if TYPE_CHECKING:
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from kv_cache import PrefixCache, SessionKVCache
+    from adapters import LoRAAdapters
+    from compiled_decode import CompiledDecoder
+    from scheduler import GenerationRequest, GenerationScheduler
+    from speculative import DraftModelProposer, PromptLookupProposer
 
 logging.getLogger("transformers").setLevel(logging.ERROR)
 
-# Constants for default values
-DEFAULT_MODEL_NAME = "mistralai/Mistral-7B-Instruct-v0.3"
-DEFAULT_ASSISTANT_NAME = "AI"
-DEFAULT_TEMPERATURE = "0.7"
-DEFAULT_MAX_NEW_TOKENS = "256"
-DEFAULT_TOP_P = "0.95"
-DEFAULT_TOP_K = "40"
-DEFAULT_REPETITION_PENALTY = "1.1"
-DEFAULT_HISTORY_LENGTH = "10"
-DEFAULT_ENABLE_SKELETON_KEY_JAILBREAK = "false"
-
-# Constants for environment variable names
-ENV_VAR_MODEL_NAME = "MODEL_NAME"
-ENV_VAR_ASSISTANT_NAME = "ASSISTANT_NAME"
-ENV_VAR_SYSTEM_MESSAGE = "SYSTEM_MESSAGE"
-ENV_VAR_TEMPERATURE = "TEMPERATURE"
-ENV_VAR_CHAT_TEMPLATE = "CHAT_TEMPLATE"
-ENV_VAR_MAX_NEW_TOKENS = "MAX_NEW_TOKENS"
-ENV_VAR_TOP_P = "TOP_P"
-ENV_VAR_TOP_K = "TOP_K"
-ENV_VAR_REPETITION_PENALTY = "REPETITION_PENALTY"
-ENV_VAR_HISTORY_LENGTH = "HISTORY_LENGTH"
-ENV_VAR_DEBUG = "DEBUG"
-ENV_VAR_DEVICE = "DEVICE"
-ENV_VAR_MODEL_LOAD_IN_4BIT = "MODEL_LOAD_IN_4BIT"
-ENV_VAR_MODEL_LOAD_IN_8BIT = "MODEL_LOAD_IN_8BIT"
-ENV_VAR_TOKENIZER_NAME = "TOKENIZER_NAME"
-ENV_VAR_LORA_WEIGHTS = "LORA_WEIGHTS"
-ENV_VAR_HF_TOKEN = "HF_TOKEN"
-ENV_VAR_ENABLE_SKELETON_KEY_JAILBREAK = "ENABLE_SKELETON_KEY_JAILBREAK"
+# Used when neither the model config nor the tokenizer knows its context size
+FALLBACK_CONTEXT_TOKEN_BUDGET = 4096
+HISTORY_SUMMARY_MAX_NEW_TOKENS = 128
 
 
 class Chatbot:
-    def __init__(self) -> None:
-        # Must be None, not "", when unset: huggingface_hub now sends the token
-        # verbatim, and an empty one becomes an illegal `Authorization: Bearer `
-        # header that the HTTP client rejects before the request leaves.
-        self.huggingface_token: Optional[str] = os.getenv(ENV_VAR_HF_TOKEN) or None
-
-        model_name: str = os.getenv(ENV_VAR_MODEL_NAME, "")
-        self.model_name: str = model_name if model_name else DEFAULT_MODEL_NAME
-
-        tokenizer_name: str = os.getenv(ENV_VAR_TOKENIZER_NAME, "")
-        self.tokenizer_name: str = tokenizer_name if tokenizer_name else self.model_name
-
-        self.chat_template: str = os.getenv(ENV_VAR_CHAT_TEMPLATE, "")
-
-        assistant_name: str = os.getenv(ENV_VAR_ASSISTANT_NAME, "")
-        self.assistant_name: str = (
-            assistant_name if assistant_name else DEFAULT_ASSISTANT_NAME
-        )
-
-        self.system_message: str = os.getenv(ENV_VAR_SYSTEM_MESSAGE, "")
-
-        self.temperature: float = float(
-            os.getenv(ENV_VAR_TEMPERATURE, DEFAULT_TEMPERATURE)
-        )
-
-        self.max_new_tokens: int = int(
-            os.getenv(ENV_VAR_MAX_NEW_TOKENS, DEFAULT_MAX_NEW_TOKENS)
-        )
-
-        self.top_p: float = float(os.getenv(ENV_VAR_TOP_P, DEFAULT_TOP_P))
-        self.top_k: int = int(os.getenv(ENV_VAR_TOP_K, DEFAULT_TOP_K))
+    def __init__(self, config: Optional[ChatbotConfig] = None) -> None:
+        started: float = time.perf_counter()
 
-        self.repetition_penalty: float = float(
-            os.getenv(ENV_VAR_REPETITION_PENALTY, DEFAULT_REPETITION_PENALTY)
-        )
+        if config is None:
+            config = ChatbotConfig.from_env()
+        self.config: ChatbotConfig = config
+        # Every setting becomes an attribute of the same name; commands like
+        # /temp change those, the config keeps what the process started with
+        for setting in fields(config):
+            setattr(self, setting.name, getattr(config, setting.name))
 
-        self.history: Dict[str | None, List[Dict[str, str]]] = {}
-        self.history_length: int = int(
-            os.getenv(ENV_VAR_HISTORY_LENGTH, DEFAULT_HISTORY_LENGTH)
+        import torch
+        from transformers import (
+            AutoModelForCausalLM,
+            AutoTokenizer,
+            BitsAndBytesConfig,
         )
+        from kv_cache import PrefixCache, SessionKVCache
+        from scheduler import GenerationScheduler
+        from speculative import DraftModelProposer, PromptLookupProposer
+        from model_cache import is_cached, model_cache_path, save_prepared_model
+        from compiled_decode import CompiledDecoder
+        from adapters import LoRAAdapters
 
-        self.debug: bool = os.getenv(ENV_VAR_DEBUG, "false").lower() == "true"
+        if self.cpu_quantization:
+            self.device = "cpu"
+        elif not self.device:
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
 
-        self.device: str = os.getenv(
-            ENV_VAR_DEVICE, "cuda" if torch.cuda.is_available() else "cpu"
-        )
-
-        self.load_in_4bit = (
-            os.getenv(ENV_VAR_MODEL_LOAD_IN_4BIT, "false").lower() == "true"
-        )
+        # Generation gets the compute cores to itself, whoever calls Chatbot
+        # (tokenization, the Telegram event loop) the I/O ones
+        self.io_cores: List[int] = []
+        self.compute_cores: List[int] = []
+        if self.device == "cpu":
+            self.io_cores, self.compute_cores = split_cores(self.cpu_io_cores)
+            if self.cpu_io_cores and not self.compute_cores:
+                print(
+                    f"Warning: can't keep {self.cpu_io_cores} cores for I/O, "
+                    "generation isn't pinned"
+                )
+            set_threads(
+                self.cpu_threads or len(self.compute_cores), self.cpu_interop_threads
+            )
 
-        self.load_in_8bit = (
-            os.getenv(ENV_VAR_MODEL_LOAD_IN_8BIT, "false").lower() == "true"
-        )
+        if self.session_store_backend == SESSION_STORE_SQLITE:
+            self.history: SessionStore = SQLiteSessionStore(
+                self.session_store_path, self.session_store_max_sessions
+            )
+        else:
+            self.history = SessionStore(self.session_store_max_sessions)
 
-        self.lora_weights: str = os.getenv(ENV_VAR_LORA_WEIGHTS, "")
+        # Evicted messages waiting for the summary generation currently
+        # running for their user; only users with one in flight have an entry
+        self.unsummarized_history: Dict[str | None, List[Dict[str, str]]] = {}
+        self.summary_lock: threading.Lock = threading.Lock()
 
-        self.enable_skeleton_key_jailbreak: bool = (
-            os.getenv(
-                ENV_VAR_ENABLE_SKELETON_KEY_JAILBREAK,
-                DEFAULT_ENABLE_SKELETON_KEY_JAILBREAK,
-            ).lower()
-            == "true"
-        )
+        # The reply each chat is waiting for, until it is recorded
+        self.in_flight: Dict[str | None, GenerationRequest] = {}
+        self.in_flight_lock: threading.Lock = threading.Lock()
 
         if self.enable_skeleton_key_jailbreak:
             print("WARNING! SKELETON KEY JAILBREAK ENABLED!")
@@ -128,20 +138,74 @@ class Chatbot:
             print("Loading in 8-bit precision")
             quantization_config = BitsAndBytesConfig(load_in_8bit=True)
 
-        print(f"Loading model: {self.model_name}")
-        self.model: AutoModelForCausalLM = AutoModelForCausalLM.from_pretrained(
-            self.model_name,
-            device_map=self.device,
-            quantization_config=quantization_config,
-            token=self.huggingface_token,
-        )
+        # LoRA weights can't be merged into quantized ones without losing
+        # precision, those stay a PeftModel wrapper
+        merge_lora: bool = bool(self.lora_weights) and quantization_config is None
 
-        print(f"Loading tokenizer: {self.tokenizer_name}")
-        self.tokenizer: AutoTokenizer = AutoTokenizer.from_pretrained(
-            self.tokenizer_name,
-            use_fast=True,
-            token=self.huggingface_token,
+        model_cache_key: Dict[str, Union[str, bool]] = {
+            "model": self.model_name,
+            "tokenizer": self.tokenizer_name,
+            "lora_weights": self.lora_weights if merge_lora else "",
+            "load_in_4bit": self.load_in_4bit,
+            "load_in_8bit": self.load_in_8bit,
+        }
+        # Only there when set, so models cached before stay valid. The
+        # prepared model is saved before int8 quantization, but in the dtype
+        # it was loaded as
+        load_kwargs: Dict[str, Any] = {}
+        if self.cpu_quantization:
+            model_cache_key["cpu_quantization"] = self.cpu_quantization
+            load_kwargs["dtype"] = load_dtype(self.cpu_quantization)
+        cached_model_path: str = ""
+        if self.model_cache_dir:
+            cached_model_path = model_cache_path(self.model_cache_dir, model_cache_key)
+
+        load_started: float = time.perf_counter()
+        loaded_from_cache: bool = bool(cached_model_path) and is_cached(
+            cached_model_path
         )
+        if loaded_from_cache:
+            # safetensors are memory-mapped, already quantized and merged
+            print(f"Loading prepared model from cache: {cached_model_path}")
+            self.model: AutoModelForCausalLM = AutoModelForCausalLM.from_pretrained(
+                cached_model_path, device_map=self.device, **load_kwargs
+            )
+            self.tokenizer: AutoTokenizer = AutoTokenizer.from_pretrained(
+                cached_model_path, use_fast=True
+            )
+        else:
+            print(f"Loading model: {self.model_name}")
+            self.model = AutoModelForCausalLM.from_pretrained(
+                self.model_name,
+                device_map=self.device,
+                quantization_config=quantization_config,
+                token=self.huggingface_token,
+                **load_kwargs,
+            )
+
+            print(f"Loading tokenizer: {self.tokenizer_name}")
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                self.tokenizer_name,
+                use_fast=True,
+                token=self.huggingface_token,
+            )
+
+            if merge_lora:
+                self.load_lora_weights()
+                print("Merging LoRA weights into the model")
+                self.model = self.model.merge_and_unload()
+
+            if cached_model_path:
+                print(f"Caching prepared model in: {cached_model_path}")
+                try:
+                    save_prepared_model(
+                        cached_model_path,
+                        self.model,
+                        self.tokenizer,
+                        model_cache_key,
+                    )
+                except Exception as e:
+                    print(f"Warning: failed to cache the prepared model: {e}")
 
         if self.chat_template:
             print(f"Setting chat template to: {self.chat_template}")
@@ -158,14 +222,41 @@ class Chatbot:
                 f"{', '.join(sorted(CHAT_TEMPLATES))}"
             )
 
-        if self.lora_weights:
-            print(f"Loading LoRA weights from: {self.lora_weights}")
-            self.model = PeftModel.from_pretrained(
+        if self.lora_weights and not merge_lora:
+            self.load_lora_weights()
+
+        if self.cpu_quantization:
+            print(f"Quantizing the model for CPU inference: {self.cpu_quantization}")
+            self.model = quantize_for_cpu(self.model, self.cpu_quantization)
+
+        self.adapters: Optional[LoRAAdapters] = None
+        if self.lora_adapters:
+            self.adapters = LoRAAdapters(
                 self.model,
-                self.lora_weights,
+                self.lora_adapters,
+                self.lora_max_loaded_adapters,
                 token=self.huggingface_token,
             )
-            print(f"Loaded LoRA weights from {self.lora_weights}")
+            self.model = self.adapters.model
+        # Adapter each chat picked with /adapter; the others get none
+        self.chat_adapters: Dict[str | None, str] = {}
+
+        # What, besides the prompt and sampling parameters, a cached reply
+        # depends on
+        self.model_identity: Dict[str, Union[str, bool]] = {
+            **model_cache_key,
+            "lora_weights": self.lora_weights,
+        }
+        self.response_cache: Optional[ResponseCache] = None
+        if self.response_cache_max_entries > 0 or self.response_cache_path:
+            self.response_cache = ResponseCache(
+                self.response_cache_max_entries,
+                ttl=self.response_cache_ttl,
+                path=self.response_cache_path,
+                disk_max_entries=self.response_cache_disk_max_entries,
+            )
+
+        self.model_load_time: float = time.perf_counter() - load_started
 
         print(f"Verifying vocab sizes for model and tokenizer")
         base_vocab_size = self.model.get_input_embeddings().weight.shape[0]
@@ -187,10 +278,228 @@ class Chatbot:
         # Set the padding side
         self.tokenizer.padding_side = "left"
 
+        if self.context_token_budget <= 0:
+            self.context_token_budget = self.detect_context_size()
+
+        self.prompt_tokenizer: PromptTokenizer = PromptTokenizer(self.tokenizer)
+        if not self.prompt_tokenizer.enabled:
+            print(
+                "Warning: incremental prompt tokenization unavailable for this "
+                "tokenizer, every prompt is tokenized in full"
+            )
+
+        self.session_cache: Optional[SessionKVCache] = None
+        if self.session_cache_max_tokens > 0:
+            self.session_cache = SessionKVCache(
+                self.session_cache_max_tokens,
+                offload_device="cpu" if self.session_cache_offload else None,
+            )
+
+        self.prefix_cache: Optional[PrefixCache] = None
+        if self.prefix_cache_max_tokens > 0:
+            self.prefix_cache = PrefixCache(self.prefix_cache_max_tokens, self.device)
+
+        self.proposer: Optional[Union[DraftModelProposer, PromptLookupProposer]] = None
+        if self.draft_model_name and self.speculative_tokens > 0:
+            print(f"Loading draft model: {self.draft_model_name}")
+            draft_model = AutoModelForCausalLM.from_pretrained(
+                self.draft_model_name,
+                device_map=self.device,
+                token=self.huggingface_token,
+                **load_kwargs,
+            )
+            if self.cpu_quantization:
+                draft_model = quantize_for_cpu(draft_model, self.cpu_quantization)
+            if draft_model.config.vocab_size > base_vocab_size:
+                raise ValueError(
+                    f"draft model vocab size ({draft_model.config.vocab_size}) "
+                    f"is larger than the model's ({base_vocab_size}); "
+                    f"{ENV_VAR_DRAFT_MODEL_NAME} must use the same tokenizer"
+                )
+            self.proposer = DraftModelProposer(draft_model, self.tokenizer, self.device)
+        elif self.prompt_lookup and self.speculative_tokens > 0:
+            self.proposer = PromptLookupProposer()
+
+        self.compiled_decoder: Optional[CompiledDecoder] = None
+        if self.compile_decode:
+            self.compiled_decoder = CompiledDecoder(
+                self.model,
+                self.device,
+                self.max_batch_size,
+                self.compile_max_tokens or self.context_token_budget,
+            )
+
+        self.metrics: Metrics = Metrics()
+        self.metrics.gauge(
+            "hot_sessions", "Sessions held in memory", self.history.hot_sessions
+        )
+        for name, cache in [
+            ("session_cache", self.session_cache),
+            ("prefix_cache", self.prefix_cache),
+        ]:
+            if cache is not None:
+                self.metrics.gauge(
+                    f"{name}_hit_rate",
+                    f"Share of lookups that reused {name.replace('_', ' ')} KV",
+                    lambda cache=cache: cache.stats()["hit_rate"],
+                )
+                self.metrics.gauge(
+                    f"{name}_tokens",
+                    f"Tokens held in the {name.replace('_', ' ')}",
+                    lambda cache=cache: cache.stats()["cached_tokens"],
+                )
+
+        self.load_policy: LoadPolicy = LoadPolicy(
+            self.adaptive_interval,
+            self.adaptive_min_new_tokens,
+            self.adaptive_min_prompt_tokens,
+            self.adaptive_max_batch_size,
+        )
+        if self.adaptive_target_p95 > 0:
+            for name, help in [
+                ("max_new_tokens", "Tokens a reply may have under the load policy"),
+                ("prompt_tokens", "Tokens a prompt may have under the load policy"),
+                ("batch_size", "Rows the batch may have under the load policy"),
+            ]:
+                self.metrics.gauge(
+                    f"adaptive_{name}",
+                    help,
+                    lambda name=name: getattr(self.load_policy.limits, name, 0),
+                )
+
+        # One decode loop shared by every user_id, instead of a model.generate
+        # thread per request fighting the others for the device
+        self.scheduler: GenerationScheduler = GenerationScheduler(
+            self.model,
+            self.tokenizer,
+            self.device,
+            max_batch_size=self.max_batch_size,
+            session_cache=self.session_cache,
+            prefix_cache=self.prefix_cache,
+            metrics=self.metrics,
+            proposer=self.proposer,
+            num_speculative_tokens=self.speculative_tokens,
+            compiled_decoder=self.compiled_decoder,
+            adapters=self.adapters,
+            on_finish=self.observe_load,
+            cores=self.compute_cores or None,
+        )
+        if self.io_cores:
+            # The scheduler thread pins itself to the compute cores once it
+            # starts; threads started later inherit the I/O ones
+            pin_process(self.io_cores)
+        if self.response_cache is not None:
+            self.metrics.gauge(
+                "response_cache_hit_rate",
+                "Share of cacheable requests answered from the response cache",
+                lambda: self.response_cache.stats()["hit_rate"],
+            )
+            self.metrics.gauge(
+                "response_cache_hits",
+                "Requests answered from the response cache",
+                lambda: self.response_cache.stats()["hits"],
+            )
+            self.metrics.gauge(
+                "response_cache_misses",
+                "Cacheable requests the response cache had no reply for",
+                lambda: self.response_cache.stats()["misses"],
+            )
+            self.metrics.gauge(
+                "response_cache_entries",
+                "Replies held in the in-memory response cache",
+                lambda: self.response_cache.stats()["entries"],
+            )
+        if self.adapters is not None:
+            self.metrics.gauge(
+                "lora_adapters_loaded",
+                "LoRA adapters currently loaded",
+                lambda: self.adapters.stats()["loaded"],
+            )
+        if self.proposer is not None:
+            self.metrics.gauge(
+                "speculative_acceptance_rate",
+                "Share of proposed tokens the model accepted",
+                lambda: self.scheduler.speculation_stats()["acceptance_rate"],
+            )
+            self.metrics.gauge(
+                "speculative_tokens_per_step",
+                "Tokens produced per speculative verification pass",
+                lambda: self.scheduler.speculation_stats()["tokens_per_step"],
+            )
+
+        if self.metrics_port > 0:
+            self.metrics.serve(self.metrics_port, self.metrics_host)
+            print(
+                "Serving metrics on "
+                f"http://{self.metrics_host}:{self.metrics_port}/metrics"
+            )
+
+        self.warm_prefix_cache()
+        self.warmup()
+
+        self.startup_time: float = time.perf_counter() - started
+        self.metrics.gauge(
+            "startup_seconds",
+            "Time Chatbot took to load, warm up and get ready",
+            lambda: self.startup_time,
+        )
+        print(
+            f"Ready in {self.startup_time:.2f}s (model loaded in "
+            f"{self.model_load_time:.2f}s"
+            f"{' from cache' if loaded_from_cache else ''})"
+        )
+
+    def load_lora_weights(self) -> None:
+        from peft import PeftModel
+
+        print(f"Loading LoRA weights from: {self.lora_weights}")
+        self.model = PeftModel.from_pretrained(
+            self.model,
+            self.lora_weights,
+            token=self.huggingface_token,
+        )
+        print(f"Loaded LoRA weights from {self.lora_weights}")
+
+    def warmup(self) -> None:
+        # Pays for lazy initialization (kernel selection, allocator growth,
+        # the scheduler thread, compiling) before the first user does
+        if self.compiled_decoder is not None:
+            self.compiled_decoder.warmup(self.tokenizer)
+
+        if self.warmup_tokens <= 0:
+            return
+
+        from scheduler import GenerationRequest, SamplingParams
+
+        _, input_ids = self.build_prompt([{"role": "user", "content": "Hello!"}])
+        request: GenerationRequest = self.scheduler.submit(
+            GenerationRequest(
+                input_ids=input_ids,
+                params=SamplingParams(
+                    max_new_tokens=self.warmup_tokens,
+                    temperature=self.temperature,
+                    top_p=self.top_p,
+                    top_k=self.top_k,
+                    repetition_penalty=self.repetition_penalty,
+                ),
+                streamer=None,
+            )
+        )
+        request.wait()
+        print(
+            f"Warmup: first token after "
+            f"{request.first_token_at - request.submitted_at:.3f}s, "
+            f"{len(request.output_ids)} tokens in "
+            f"{request.finished_at - request.submitted_at:.3f}s"
+        )
+
     def print_debug_info(self):
         print("\n--- Chat Debug Information ---")
         print("Model Name:", self.model_name)
         print("Tokenizer Name:", self.tokenizer_name)
+        print("Draft Model Name:", self.draft_model_name)
+        print("Prompt Lookup:", self.prompt_lookup)
+        print("Speculative Tokens:", self.speculative_tokens)
         print("Assistant Name:", self.assistant_name)
         print("System Message:", self.system_message)
         print("Temperature:", self.temperature)
@@ -198,129 +507,588 @@ class Chatbot:
         print("Top P:", self.top_p)
         print("Top K:", self.top_k)
         print("Repetition Penalty:", self.repetition_penalty)
+        print("Stop Strings:", self.stop_strings)
+        print("Generation Timeout:", self.generation_timeout)
         print("History Length:", self.history_length)
+        print("Context Token Budget:", self.context_token_budget)
+        print("History Summary:", self.history_summary)
+        print("Session Store:", self.session_store_backend)
+        print("Session Store Path:", self.session_store_path)
+        print("Session Store Max Sessions:", self.session_store_max_sessions)
         print("Debug:", self.debug)
         print("Device:", self.device)
         print("Load in 4-bit:", self.load_in_4bit)
         print("Load in 8-bit:", self.load_in_8bit)
+        print("CPU Quantization:", self.cpu_quantization)
+        print("CPU Threads:", self.cpu_threads)
+        print("CPU Inter-op Threads:", self.cpu_interop_threads)
+        print("CPU I/O Cores:", self.cpu_io_cores)
         print("Lora Weights:", self.lora_weights)
+        print("LoRA Adapters:", self.lora_adapters)
+        print("LoRA Max Loaded Adapters:", self.lora_max_loaded_adapters)
+        print("Model Cache Dir:", self.model_cache_dir)
+        print("Warmup Tokens:", self.warmup_tokens)
         print("Enable Skeleton Key Jailbreak:", self.enable_skeleton_key_jailbreak)
+        print("Max Batch Size:", self.max_batch_size)
+        print("Session Cache Max Tokens:", self.session_cache_max_tokens)
+        print("Session Cache Offload:", self.session_cache_offload)
+        print("Prefix Cache Max Tokens:", self.prefix_cache_max_tokens)
+        print("Metrics Port:", self.metrics_port)
+        print("Metrics Host:", self.metrics_host)
+        print("Compile Decode:", self.compile_decode)
+        print("Compile Max Tokens:", self.compile_max_tokens)
+        print("Response Cache Max Entries:", self.response_cache_max_entries)
+        print("Response Cache Path:", self.response_cache_path)
+        print("Response Cache Disk Max Entries:", self.response_cache_disk_max_entries)
+        print("Response Cache TTL:", self.response_cache_ttl)
+        print("Response Cache Sampled:", self.response_cache_sampled)
+        print("Adaptive Target P95:", self.adaptive_target_p95)
+        print("Adaptive Interval:", self.adaptive_interval)
+        print("Adaptive Min New Tokens:", self.adaptive_min_new_tokens)
+        print("Adaptive Min Prompt Tokens:", self.adaptive_min_prompt_tokens)
+        print("Adaptive Max Batch Size:", self.adaptive_max_batch_size)
         print("--- End Chat Debug Information ---\n")
 
     def print_prompt_debug_info(
         self,
         prompt: str,
-        generation_kwargs: Dict[
-            str, Union[torch.Tensor, TextIteratorStreamer, int, bool, float]
-        ],
+        generation_kwargs: Dict[str, Union[int, bool, float]],
     ) -> None:
         print("\n--- Debug Information ---")
         print("Prompt:")
         print(prompt)
         print("\nGeneration Parameters:")
         for key, value in generation_kwargs.items():
-            if key != "inputs" and key != "streamer":
+            print(f"{key}: {value}")
+        for name, cache in [
+            ("Session Cache", self.session_cache),
+            ("Prefix Cache", self.prefix_cache),
+        ]:
+            if cache is not None:
+                print(f"\n{name}:")
+                for key, value in cache.stats().items():
+                    print(f"{key}: {value}")
+        if self.response_cache is not None:
+            print("\nResponse Cache:")
+            for key, value in self.response_cache.stats().items():
+                print(f"{key}: {value}")
+        if self.proposer is not None:
+            print("\nSpeculative Decoding:")
+            for key, value in self.scheduler.speculation_stats().items():
                 print(f"{key}: {value}")
         print("--- End Debug Information ---\n")
 
-    def generate_response(
+    def detect_context_size(self) -> int:
+        context_size: Optional[int] = getattr(
+            self.model.config, "max_position_embeddings", None
+        )
+        if context_size:
+            return context_size
+
+        # Tokenizers without a known limit report a huge sentinel value
+        if self.tokenizer.model_max_length < 1_000_000:
+            return self.tokenizer.model_max_length
+
+        return FALLBACK_CONTEXT_TOKEN_BUDGET
+
+    def build_prompt(
         self,
-        user_input: str,
-        user_id: str | None = None,
-        print_response: bool = True,
-    ) -> str:
-        if user_id not in self.history.keys():
-            self.history[user_id] = []
+        messages: List[Dict[str, str]],
+        system_message: Optional[str] = None,
+    ) -> Tuple[str, List[int]]:
+        if system_message is None:
+            system_message = self.system_message
+
+        if system_message:
+            messages = [{"role": "system", "content": system_message}] + messages
+
+        prompt: str = self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=False
+        )
+
+        return prompt, self.prompt_tokenizer.encode(prompt)
+
+    def build_history_prompt(
+        self, user_id: str | None, prompt_tokens: Optional[int] = None
+    ) -> Tuple[str, List[int]]:
+        # History that doesn't fit the context is dropped (and summarized);
+        # the load policy's shorter prompt_tokens only leave it out this time
+        history: List[Dict[str, str]] = self.history.messages(user_id)
+
+        system_message: str = self.system_message
+        summary: str = self.history.summary(user_id)
+        if summary:
+            system_message = (
+                f"{system_message}\n\nSummary of the earlier conversation: {summary}"
+            ).strip()
+
+        def fit(start: int, budget: int) -> Tuple[int, str, List[int]]:
+            # Leaves out the oldest messages until the prompt fits the budget
+            prompt, input_ids = self.build_prompt(history[start:], system_message)
+            while len(input_ids) > budget and start < len(history) - 1:
+                start += 1
+                # Don't open the conversation with the assistant talking
+                while start < len(history) - 1 and history[start]["role"] != "user":
+                    start += 1
+                prompt, input_ids = self.build_prompt(history[start:], system_message)
+            return start, prompt, input_ids
+
+        # Room for the reply has to be left in the context as well
+        budget: int = max(self.context_token_budget - self.max_new_tokens, 1)
+        start, prompt, input_ids = fit(0, budget)
+
+        if start > 0:
+            if self.history_summary:
+                self.summarize_history(user_id, history[:start])
+            self.history.drop_oldest(user_id, start)
+
+        if prompt_tokens is not None and prompt_tokens < budget:
+            budget = prompt_tokens
+            if len(input_ids) > budget:
+                start, prompt, input_ids = fit(start, budget)
+
+        if len(input_ids) > budget:
+            print(
+                f"Warning: prompt is {len(input_ids)} tokens even with only the "
+                f"last message, keeping its last {budget}"
+            )
+            input_ids = input_ids[-budget:]
+
+        return prompt, input_ids
+
+    def summarize_history(
+        self, user_id: str | None, evicted: List[Dict[str, str]]
+    ) -> None:
+        # Summaries are produced in the background and picked up by a later
+        # turn, so evicting history never delays the reply. While one is being
+        # written, newly evicted messages queue up for the next one.
+        with self.summary_lock:
+            if user_id in self.unsummarized_history:
+                self.unsummarized_history[user_id].extend(evicted)
+                return
+            self.unsummarized_history[user_id] = []
+
+        from scheduler import GenerationRequest, SamplingParams
+
+        transcript: str = "\n".join(
+            f"{'User' if entry['role'] == 'user' else self.assistant_name}: "
+            f"{entry['content']}"
+            for entry in evicted
+        )
+        instruction: str = (
+            "Summarize the conversation below in a few sentences, keeping every "
+            "fact worth remembering.\n\n"
+        )
+        summary: str = self.history.summary(user_id)
+        if summary:
+            instruction += f"Summary so far: {summary}\n\n"
+
+        _, input_ids = self.build_prompt(
+            [{"role": "user", "content": f"{instruction}Conversation:\n{transcript}"}],
+            system_message="",
+        )
+
+        def on_done(request: GenerationRequest) -> None:
+            from scheduler import FINISH_CANCELLED
+
+            if request.finish_reason == FINISH_CANCELLED:
+                # Shutting down: keep the summary there was, write no more
+                return
+            if request.error is None:
+                self.history.set_summary(
+                    user_id,
+                    self.tokenizer.decode(
+                        request.output_ids, skip_special_tokens=True
+                    ).strip(),
+                )
+            else:
+                print(f"Warning: history summary failed: {request.error}")
+
+            with self.summary_lock:
+                queued = self.unsummarized_history.pop(user_id, [])
+            if queued:
+                self.summarize_history(user_id, queued)
+
+        self.scheduler.submit(
+            GenerationRequest(
+                input_ids=input_ids[-self.context_token_budget :],
+                params=SamplingParams(
+                    max_new_tokens=HISTORY_SUMMARY_MAX_NEW_TOKENS,
+                    temperature=0,
+                    top_p=1.0,
+                    top_k=0,
+                    repetition_penalty=self.repetition_penalty,
+                    do_sample=False,
+                ),
+                streamer=None,
+                callback=on_done,
+            )
+        )
+
+    def warm_prefix_cache(self) -> None:
+        if self.prefix_cache is None:
+            return
+
+        from kv_cache import common_prefix_length
+        from scheduler import GenerationRequest, SamplingParams
+
+        # Whatever two unrelated first messages have in common is the part of
+        # the prompt every conversation starts with: template header, system
+        # message and, when enabled, the jailbreak preamble.
+        probes: List[List[int]] = []
+        for content in ["A", "Z"]:
+            if self.enable_skeleton_key_jailbreak:
+                content = SKELETON_KEY_JAILBREAK_PROMPT + content
+            probes.append(self.build_prompt([{"role": "user", "content": content}])[1])
+
+        shared_prefix = probes[0][: common_prefix_length(probes[0], probes[1])]
+        if len(shared_prefix) < 2:
+            return
+
+        if self.debug:
+            print(f"Warming prefix cache with {len(shared_prefix)} shared tokens")
+
+        self.scheduler.submit(
+            GenerationRequest(
+                input_ids=shared_prefix,
+                params=SamplingParams(
+                    max_new_tokens=1,
+                    temperature=0,
+                    top_p=1.0,
+                    top_k=0,
+                    repetition_penalty=1.0,
+                    do_sample=False,
+                ),
+                streamer=None,
+                pin_prefix=True,
+            )
+        )
+
+    def submit_request(self, user_input: str, user_id: str | None) -> GenerationRequest:
+        # The reply streams through request.streamer, a TokenStream any number
+        # of readers can follow
+        from scheduler import GenerationRequest, SamplingParams
 
         if self.enable_skeleton_key_jailbreak:
             print(f"Applying skeleton key jailbreak...")
             user_input = SKELETON_KEY_JAILBREAK_PROMPT + user_input
 
-        self.history[user_id].append({"role": "user", "content": user_input})
-        self.history[user_id] = self.history[user_id][
-            -self.history_length :
-        ]  # Keep only the last n messages
+        # A newer message makes the reply to the previous one moot; it stops
+        # at its next token and is left out of the history
+        with self.in_flight_lock:
+            previous: Optional[GenerationRequest] = self.in_flight.get(user_id)
+            if previous is not None and not previous.done.is_set():
+                previous.cancel()
+                del self.in_flight[user_id]
+                if self.debug:
+                    print("Cancelled the reply to the previous message")
 
-        messages = self.history[user_id]
-        if self.system_message:
-            messages = [{"role": "system", "content": self.system_message}] + messages[
-                -self.history_length - 1 :
-            ]
+        self.history.append(user_id, {"role": "user", "content": user_input})
+        if self.history_length > 0:
+            # Keep only the last n messages
+            self.history.drop_oldest(
+                user_id, len(self.history.messages(user_id)) - self.history_length
+            )
 
-        prompt: str = self.tokenizer.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=False
+        limits: Limits = self.current_limits()
+        build_started: float = time.perf_counter()
+        prompt, input_ids = self.build_history_prompt(user_id, limits.prompt_tokens)
+        build_time: float = time.perf_counter() - build_started
+        self.metrics.prompt_build_time.observe(build_time)
+
+        params: SamplingParams = SamplingParams(
+            max_new_tokens=limits.max_new_tokens,
+            do_sample=True,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            top_k=self.top_k,
+            repetition_penalty=self.repetition_penalty,
+            stop_strings=self.stop_strings,
         )
 
-        inputs: Dict[str, torch.Tensor] = self.tokenizer(
-            prompt,
-            return_tensors="pt",
-            padding=True,
-            # truncation=True,
-            # max_length=self.tokenizer.model_max_length,
-        ).to(self.device)
+        if self.debug:
+            self.print_prompt_debug_info(prompt, asdict(params))
+            print(f"Prompt tokens: {len(input_ids)} (built in {build_time:.4f}s)")
 
-        streamer: TextIteratorStreamer = TextIteratorStreamer(
-            self.tokenizer, skip_prompt=True, skip_special_tokens=True
+        request: GenerationRequest = GenerationRequest(
+            input_ids=input_ids,
+            params=params,
+            streamer=TokenStream(
+                self.tokenizer,
+                chunk_tokens=self.stream_chunk_tokens,
+                chunk_interval=self.stream_chunk_interval,
+                stop_strings=params.stop_strings,
+            ),
+            session_id=self.session_key(user_id),
+            adapter=self.chat_adapters.get(user_id, ""),
+            timeout=self.generation_timeout,
         )
+        with self.in_flight_lock:
+            self.in_flight[user_id] = request
+        return self.submit_generation(request)
 
-        generation_kwargs: Dict[
-            str, Union[torch.Tensor, TextIteratorStreamer, int, bool, float]
-        ] = {
-            "inputs": inputs["input_ids"],
-            "attention_mask": inputs["attention_mask"],
-            "streamer": streamer,
-            "max_new_tokens": self.max_new_tokens,
-            "do_sample": True,
-            "temperature": self.temperature,
-            "top_p": self.top_p,
-            "top_k": self.top_k,
-            "repetition_penalty": self.repetition_penalty,
-        }
+    def submit_generation(self, request: GenerationRequest) -> GenerationRequest:
+        # Hands the request to the scheduler unless the response cache already
+        # has its reply. Greedy replies only depend on the prompt and are always
+        # cached; sampled ones only with RESPONSE_CACHE_SAMPLED, since a cached
+        # reply is the same every time.
+        from scheduler import FINISH_LENGTH, FINISH_STOP
+
+        # Requests coming in are what makes the load policy look again
+        self.current_limits()
+
+        params = request.params
+        greedy: bool = not params.do_sample or params.temperature <= 0
+        if self.response_cache is None or not (greedy or self.response_cache_sampled):
+            return self.scheduler.submit(request)
+
+        sampling: Dict[str, Union[int, float, bool]] = asdict(params)
+        if greedy:
+            # Settings that only shape sampling don't change a greedy reply
+            sampling = {
+                "max_new_tokens": params.max_new_tokens,
+                "repetition_penalty": params.repetition_penalty,
+                "stop_strings": params.stop_strings,
+            }
+        key: str = response_cache_key(
+            {
+                **self.model_identity,
+                "adapter": self.lora_adapters.get(request.adapter, ""),
+                "sampling": sampling,
+            },
+            request.input_ids,
+        )
+
+        output_ids: Optional[List[int]] = self.response_cache.get(key)
+        if output_ids is not None:
+            if self.debug:
+                print(f"Response cache hit: {len(output_ids)} tokens")
+            self.scheduler.complete(request, output_ids)
+            return request
+
+        callback = request.callback
+
+        def store(request: GenerationRequest) -> None:
+            # A reply cut short by /stop or a timeout is no reply to cache
+            if request.finish_reason in [FINISH_STOP, FINISH_LENGTH]:
+                self.response_cache.put(key, request.output_ids)
+            if callback is not None:
+                callback(request)
+
+        request.callback = store
+        return self.scheduler.submit(request)
+
+    def current_limits(self) -> Limits:
+        # The load policy's limits, bounded by the settings; also sizes the
+        # batch the scheduler admits
+        limits: Limits = self.load_policy.update(
+            time.perf_counter(),
+            self.adaptive_target_p95,
+            self.scheduler.queue_depth(),
+            Limits(
+                max_new_tokens=self.max_new_tokens,
+                prompt_tokens=max(self.context_token_budget - self.max_new_tokens, 1),
+                batch_size=self.max_batch_size,
+            ),
+        )
+        self.scheduler.max_batch_size = limits.batch_size
+        return limits
+
+    def observe_load(self, request: GenerationRequest) -> None:
+        # Called by the scheduler thread as requests finish
+        if request.error is None:
+            self.load_policy.observe(
+                request.finished_at,
+                request.finished_at - request.submitted_at,
+                len(request.output_ids),
+            )
+
+    def format_policy(self) -> str:
+        return self.load_policy.format(self.adaptive_target_p95)
+
+    def session_key(self, user_id: str | None) -> Hashable:
+        # The CLI conversation has no user_id, but still is a session
+        key: Hashable = user_id if user_id is not None else ""
+        # KV computed with one adapter is no use to another; keyed apart, a
+        # chat switching back finds its old entry still valid
+        adapter: str = self.chat_adapters.get(user_id, "")
+        return (key, adapter) if adapter else key
+
+    def record_response(
+        self, user_id: str | None, request: GenerationRequest, response: str
+    ) -> str:
+        from scheduler import FINISH_CANCELLED, FINISH_TIMEOUT
+
+        # Surfaces a failed prefill/decode instead of a silently empty reply
+        request.wait()
+
+        with self.in_flight_lock:
+            current: bool = self.in_flight.get(user_id) is request
+            if current:
+                del self.in_flight[user_id]
+        if request.finish_reason == FINISH_CANCELLED and not current:
+            # Superseded by a newer message or cleared away
+            return ""
+        if self.debug and request.finish_reason in [
+            FINISH_CANCELLED,
+            FINISH_TIMEOUT,
+        ]:
+            print(f"Reply cut short: {request.finish_reason}")
 
         if self.debug:
-            self.print_prompt_debug_info(prompt, generation_kwargs)
+            print(
+                "Time to first token: "
+                f"{request.first_token_at - request.submitted_at:.3f}s"
+            )
+            decode_time: float = request.finished_at - request.first_token_at
+            if len(request.output_ids) > 1 and decode_time > 0:
+                print(
+                    "Tokens/sec: " f"{(len(request.output_ids) - 1) / decode_time:.1f}"
+                )
 
-        Thread(target=self.model.generate, kwargs=generation_kwargs).start()
+        response = response.strip()
+        self.history.append(user_id, {"role": "assistant", "content": response})
 
-        if print_response:
-            print(f"\n{self.assistant_name}: ", end="", flush=True)
+        return response
 
-        assistant_response: str = ""
-        for text in streamer:
-            if print_response:
-                print(text, end="", flush=True)
+    def stream_response(
+        self, user_input: str, user_id: str | None = None
+    ) -> Iterator[str]:
+        request: GenerationRequest = self.submit_request(user_input, user_id)
+        yield from request.streamer
+        self.record_response(user_id, request, request.streamer.text())
 
-            assistant_response += text
+    def generate_response(
+        self,
+        user_input: str,
+        user_id: str | None = None,
+        print_response: bool = True,
+    ) -> str:
+        if print_response:
+            print(f"\n{self.assistant_name}: ", end="", flush=True)
 
+        request: GenerationRequest = self.submit_request(user_input, user_id)
         if print_response:
+            try:
+                for text in request.streamer:
+                    print(text, end="", flush=True)
+            except KeyboardInterrupt:
+                # Ctrl-C stops the reply, not the program
+                request.cancel()
+                print(" [stopped]", end="")
             print("\n")
 
-        assistant_response = assistant_response.strip()
-        self.history[user_id].append(
-            {"role": "assistant", "content": assistant_response}
+        # Nobody reading along means nothing is decoded until the end
+        return self.record_response(user_id, request, request.streamer.text())
+
+    async def astream_response(
+        self, user_input: str, user_id: str | None = None
+    ) -> AsyncIterator[str]:
+        # Template rendering and tokenization of a long history are not free,
+        # keep them off the event loop too.
+        request: GenerationRequest = await asyncio.to_thread(
+            self.submit_request, user_input, user_id
         )
+        async for text in request.streamer:
+            yield text
 
-        return assistant_response
+        # Waits for the request and appends to the session store, which may
+        # be SQLite
+        await asyncio.to_thread(
+            self.record_response, user_id, request, await request.streamer.atext()
+        )
+
+    async def agenerate_response(
+        self, user_input: str, user_id: str | None = None
+    ) -> str:
+        request: GenerationRequest = await asyncio.to_thread(
+            self.submit_request, user_input, user_id
+        )
+        return await asyncio.to_thread(
+            self.record_response, user_id, request, await request.streamer.atext()
+        )
 
     def set_parameter(self, param: str, value: Union[float, int, str]) -> None:
-        if param in ["temperature", "top_p", "repetition_penalty"]:
+        if param in [
+            "temperature",
+            "top_p",
+            "repetition_penalty",
+            "adaptive_target_p95",
+        ]:
             setattr(self, param, float(value))
         elif param in ["max_new_tokens", "top_k"]:
             setattr(self, param, int(value))
         elif param == "system_message":
             setattr(self, param, str(value))
+            # Every cached session starts with the old system message
+            if self.session_cache is not None:
+                self.session_cache.clear()
+            self.warm_prefix_cache()
         elif param == "debug":
             setattr(self, param, value.lower() == "true")
         print(f"{param.capitalize()} set to: {getattr(self, param)}")
 
-    def clear_history(self) -> None:
-        self.history.clear()
+    def stop_generation(self, user_id: str | None = None) -> bool:
+        # Stops the reply the chat is waiting for; what it got so far stays
+        with self.in_flight_lock:
+            request: Optional[GenerationRequest] = self.in_flight.get(user_id)
+        if request is None or request.done.is_set():
+            return False
+        request.cancel()
+        return True
+
+    def clear_history(self, user_id: str | None = None) -> None:
+        with self.in_flight_lock:
+            request: Optional[GenerationRequest] = self.in_flight.pop(user_id, None)
+        if request is not None:
+            request.cancel()
+        self.history.clear(user_id)
+        if self.session_cache is not None:
+            self.session_cache.invalidate(self.session_key(user_id))
         print("Chat history cleared")
 
-    def show_history(self) -> None:
-        for entry in self.history:
+    def set_adapter(self, user_id: str | None, name: str) -> None:
+        if name.lower() in ["", "none"]:
+            self.chat_adapters.pop(user_id, None)
+        elif self.adapters is None or name not in self.adapters.paths:
+            raise ValueError(
+                f"Unknown adapter: {name} (available: "
+                f"{', '.join(self.adapters.names()) if self.adapters else 'none'})"
+            )
+        else:
+            self.chat_adapters[user_id] = name
+        print(f"Adapter set to: {self.chat_adapters.get(user_id, 'none')}")
+
+    def format_adapters(self, user_id: str | None = None) -> str:
+        if self.adapters is None:
+            return "No LoRA adapters configured"
+        return "\n".join(
+            [
+                f"Adapters: {', '.join(self.adapters.names())}",
+                f"Loaded: {', '.join(self.adapters.loaded()) or 'none'}",
+                f"Current: {self.chat_adapters.get(user_id, 'none')}",
+            ]
+        )
+
+    def show_history(self, user_id: str | None = None) -> None:
+        for entry in self.history.messages(user_id):
             print(f"{entry['role'].capitalize()}: {entry['content']}")
 
+    def format_stats(self) -> str:
+        return self.metrics.format()
+
+    def close(self) -> None:
+        # Generation first: nothing may be running on the device at exit, or
+        # writing (a history summary) to the stores closed next
+        self.scheduler.close()
+        # Queued session store and response cache writes would otherwise be
+        # lost
+        self.history.close()
+        if self.response_cache is not None:
+            self.response_cache.close()
+        if self.io_cores:
+            pin_process(self.io_cores + self.compute_cores)
+
     def exec_command(self, user_input: str) -> Optional[str]:
         if user_input.startswith("/"):
             cmd_parts: List[str] = user_input[1:].split(None, 1)
@@ -341,10 +1109,26 @@ class Chatbot:
                 self.set_parameter(param, args)
             elif cmd == "system":
                 self.set_parameter("system_message", args)
+            elif cmd == "stop":
+                print("Stopped" if self.stop_generation() else "Nothing to stop")
             elif cmd == "clear":
                 self.clear_history()
             elif cmd == "history":
                 self.show_history()
+            elif cmd == "stats":
+                print(self.format_stats())
+            elif cmd == "policy":
+                if args:
+                    self.set_parameter("adaptive_target_p95", args)
+                print(self.format_policy())
+            elif cmd == "adapter":
+                if not args:
+                    print(self.format_adapters())
+                else:
+                    try:
+                        self.set_adapter(None, args.strip())
+                    except ValueError as e:
+                        print(e)
             elif cmd in ["help", "?"]:
                 print("Available commands:")
                 print("/temp <value>: Set temperature")
@@ -354,8 +1138,12 @@ class Chatbot:
                 print("/repetition_penalty <value>: Set repetition penalty")
                 print("/system <message>: Set system message")
                 print("/debug true|false: Enable or disable debug mode")
+                print("/stop: Stop the reply being generated (or press Ctrl-C)")
                 print("/clear: Clear chat history")
                 print("/history: Show chat history")
+                print("/stats: Show runtime metrics")
+                print("/policy [target_p95]: Show the load policy, or set its target")
+                print("/adapter [name|none]: Show or switch the LoRA adapter")
                 print("/help or /?: Show this help message")
             else:
                 print(f"Unknown command: {cmd}")
@@ -365,7 +1153,102 @@ class Chatbot:
 
 
 def main() -> None:
-    chatbot: Chatbot = Chatbot()
+    parser = argparse.ArgumentParser(
+        description="Chat with a local LLM; settings come from the environment"
+    )
+    subcommands = parser.add_subparsers(dest="command")
+    batch_parser = subcommands.add_parser(
+        "batch",
+        help="answer every conversation of a JSONL file",
+        description="Answer every conversation of a JSONL file, one per line: "
+        '{"id": ..., "messages": [...] or "prompt": "...", "system": "...", '
+        '"params": {"temperature": ..., "max_new_tokens": ...}}. Results are '
+        "appended to the output JSONL as they finish; rerunning resumes.",
+    )
+    batch_parser.add_argument("input", help="JSONL file of conversations")
+    batch_parser.add_argument("output", help="JSONL file results are appended to")
+    batch_parser.add_argument(
+        "--sort-window",
+        type=int,
+        default=DEFAULT_BATCH_SORT_WINDOW,
+        help="rows read ahead and sorted by prompt length",
+    )
+    batch_parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=0,
+        help="requests submitted but not finished (default: 2 * MAX_BATCH_SIZE)",
+    )
+    serve_parser = subcommands.add_parser(
+        "serve",
+        help="answer OpenAI-style chat completion requests over HTTP",
+        description="Serve POST /v1/chat/completions (streamed as server-sent "
+        'events with "stream": true) and GET /v1/models. A model named after a '
+        "LORA_ADAPTERS entry picks that adapter.",
+    )
+    serve_parser.add_argument("--host", default=DEFAULT_SERVER_HOST)
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_SERVER_PORT)
+    serve_parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=0,
+        help="requests generating at once (default: 2 * MAX_BATCH_SIZE)",
+    )
+    serve_parser.add_argument(
+        "--max-queued",
+        type=int,
+        default=DEFAULT_SERVER_MAX_QUEUED_REQUESTS,
+        help="requests waiting for a slot before new ones get a 429",
+    )
+    args = parser.parse_args()
+
+    # Checked before the model stack is even imported
+    try:
+        config: ChatbotConfig = ChatbotConfig.from_env()
+    except ConfigError as e:
+        raise SystemExit(str(e))
+
+    chatbot: Chatbot = Chatbot(config)
+
+    if args.command == "batch":
+        from batch import run_batch
+
+        stats = run_batch(
+            chatbot,
+            args.input,
+            args.output,
+            sort_window=args.sort_window,
+            max_in_flight=args.max_in_flight,
+        )
+        print(
+            f"Batch done: {stats['rows']:g} rows ({stats['errors']:g} failed, "
+            f"{stats['skipped']:g} already done), {stats['output_tokens']:g} "
+            f"tokens in {stats['seconds']:.1f}s "
+            f"({stats['tokens_per_second']:.1f} tokens/sec)"
+        )
+        chatbot.close()
+        return
+
+    if args.command == "serve":
+        from server import ChatCompletionServer
+
+        server = ChatCompletionServer(
+            chatbot,
+            args.host,
+            args.port,
+            max_concurrent=args.max_concurrent,
+            max_queued=args.max_queued,
+        )
+        host, port = server.server_address[:2]
+        print(f"Serving chat completions on http://{host}:{port}/v1", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        chatbot.close()
+        return
+
     print(f"Chatbot initialized. Type '/help' for available commands.")
 
     while True:
@@ -375,6 +1258,8 @@ def main() -> None:
         if user_input:
             chatbot.exec_command(user_input)
 
+    chatbot.close()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,184 @@
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+import torch._dynamo
+from transformers import DynamicCache, StaticCache
+
+# Static cache lengths double from here up to the configured maximum
+COMPILED_MIN_LENGTH = 256
+
+
+class CompiledDecoder:
+    """
+    Runs the scheduler's single-token decode steps through torch.compile on a
+    static, preallocated KV cache. Batch size and cache length are rounded up
+    to buckets (powers of two), so the same few graphs serve every request
+    and every user; warmup() compiles all of them up front.
+
+    The scheduler keeps owning a DynamicCache: after each step its layers are
+    views into the static buffers, and whenever the scheduler replaced them
+    (a prefill, an eviction, a speculative step) the next step copies them
+    into fresh static buffers of the right bucket.
+    """
+
+    def __init__(
+        self, model: Any, device: str, max_batch_size: int, max_length: int
+    ) -> None:
+        self.model = model
+        self.device = device
+        self.batch_buckets: List[int] = _buckets(1, max_batch_size)
+        self.length_buckets: List[int] = _buckets(COMPILED_MIN_LENGTH, max_length)
+
+        # Dynamo keeps one graph per shape it has seen; without room for all
+        # buckets it would quietly fall back to eager for the rest
+        torch._dynamo.config.recompile_limit = max(
+            torch._dynamo.config.recompile_limit,
+            len(self.batch_buckets) * len(self.length_buckets),
+        )
+        self._forward = torch.compile(model.forward, dynamic=False)
+
+        self._cache: Optional[StaticCache] = None
+        self._bucket: Tuple[int, int] = (0, 0)
+        # Keys of the first layer as last handed to the scheduler's cache
+        self._handed_out: Optional[torch.Tensor] = None
+
+        self.compiled_steps: int = 0
+        # Steps that had to copy the scheduler's cache into static buffers
+        self.loads: int = 0
+
+    def fits(self, rows: int, columns: int) -> bool:
+        return rows <= self.batch_buckets[-1] and columns <= self.length_buckets[-1]
+
+    def decode(
+        self,
+        cache: DynamicCache,
+        attention_mask: torch.Tensor,
+        input_ids: torch.Tensor,
+        position_ids: torch.Tensor,
+    ) -> torch.Tensor:
+        # attention_mask already has the column of the token being fed
+        rows, columns = attention_mask.shape
+        if (
+            self._handed_out is None
+            or cache.layers[0].keys is not self._handed_out
+            or columns > self._bucket[1]
+        ):
+            self._load(cache, self._bucket_for(rows, columns))
+
+        return self._step(cache, attention_mask, input_ids, position_ids)
+
+    def warmup(self, tokenizer: Any) -> None:
+        # A one-token prefill tells the shapes and dtype of the cache
+        input_ids = torch.tensor([[tokenizer.pad_token_id]], device=self.device)
+        started = time.perf_counter()
+        with torch.inference_mode():
+            template = self.model(
+                input_ids=input_ids, past_key_values=DynamicCache(), use_cache=True
+            ).past_key_values
+            for batch_size in self.batch_buckets:
+                for length in self.length_buckets:
+                    cache = DynamicCache()
+                    for layer_idx, layer in enumerate(template.layers):
+                        cache.update(
+                            layer.keys.expand(batch_size, -1, -1, -1),
+                            layer.values.expand(batch_size, -1, -1, -1),
+                            layer_idx,
+                        )
+                    self._load(cache, (batch_size, length))
+                    self._step(
+                        cache,
+                        torch.ones(
+                            (batch_size, 2), dtype=torch.long, device=self.device
+                        ),
+                        input_ids.expand(batch_size, -1),
+                        torch.ones(
+                            (batch_size, 1), dtype=torch.long, device=self.device
+                        ),
+                    )
+
+        self._cache = None
+        self._handed_out = None
+        self.compiled_steps = 0
+        self.loads = 0
+        print(
+            f"Compiled {len(self.batch_buckets) * len(self.length_buckets)} decode "
+            f"graphs in {time.perf_counter() - started:.2f}s "
+            f"(batch {self.batch_buckets}, length {self.length_buckets})"
+        )
+
+    def stats(self) -> Dict[str, float]:
+        return {"compiled_steps": self.compiled_steps, "loads": self.loads}
+
+    def _bucket_for(self, rows: int, columns: int) -> Tuple[int, int]:
+        return (
+            next(size for size in self.batch_buckets if size >= rows),
+            next(size for size in self.length_buckets if size >= columns),
+        )
+
+    def _load(self, cache: DynamicCache, bucket: Tuple[int, int]) -> None:
+        batch_size, length = bucket
+        static = StaticCache(config=self.model.config, max_cache_len=length)
+        for layer, static_layer in zip(cache.layers, static.layers):
+            rows, _, past, _ = layer.keys.shape
+            # Allocates [batch_size, heads, length, head_dim] buffers
+            static_layer.lazy_initialization(
+                layer.keys[:1, :, :1].expand(batch_size, -1, -1, -1),
+                layer.values[:1, :, :1].expand(batch_size, -1, -1, -1),
+            )
+            static_layer.keys[:rows, :, :past] = layer.keys
+            static_layer.values[:rows, :, :past] = layer.values
+
+        self._cache = static
+        self._bucket = bucket
+        self.loads += 1
+
+    def _step(
+        self,
+        cache: DynamicCache,
+        attention_mask: torch.Tensor,
+        input_ids: torch.Tensor,
+        position_ids: torch.Tensor,
+    ) -> torch.Tensor:
+        rows, columns = attention_mask.shape
+        batch_size, length = self._bucket
+
+        # The token is written at the column after the past, the same one
+        # for every row since the batch is left-padded
+        for layer in self._cache.layers:
+            layer.cumulative_length.fill_(columns - 1)
+
+        static_mask = attention_mask.new_zeros((batch_size, length))
+        static_mask[:rows, :columns] = attention_mask
+        # Filler rows attend to their own token, a fully masked row is NaN
+        static_mask[rows:, columns - 1] = 1
+        static_input_ids = input_ids.new_zeros((batch_size, 1))
+        static_input_ids[:rows] = input_ids
+        static_position_ids = position_ids.new_zeros((batch_size, 1))
+        static_position_ids[:rows] = position_ids
+
+        outputs = self._forward(
+            input_ids=static_input_ids,
+            attention_mask=static_mask,
+            position_ids=static_position_ids,
+            past_key_values=self._cache,
+            use_cache=True,
+        )
+
+        for layer, static_layer in zip(cache.layers, self._cache.layers):
+            layer.keys = static_layer.keys[:rows, :, :columns]
+            layer.values = static_layer.values[:rows, :, :columns]
+        self._handed_out = cache.layers[0].keys
+        self.compiled_steps += 1
+
+        return outputs.logits[:rows, -1, :]
+
+
+def _buckets(smallest: int, largest: int) -> List[int]:
+    buckets: List[int] = []
+    size = smallest
+    while size < largest:
+        buckets.append(size)
+        size *= 2
+    buckets.append(largest)
+    return buckets
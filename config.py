@@ -0,0 +1,656 @@
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from common import CHAT_TEMPLATES
+from cpu import CPU_QUANTIZATION_INT8, CPU_QUANTIZATIONS
+from session_store import SESSION_STORE_MEMORY, SESSION_STORE_SQLITE
+
+# Only the standard library and the other lightweight modules may be imported
+# here: settings are read and validated before torch and transformers load.
+
+# Constants for default values
+DEFAULT_MODEL_NAME = "mistralai/Mistral-7B-Instruct-v0.3"
+DEFAULT_ASSISTANT_NAME = "AI"
+DEFAULT_TEMPERATURE = "0.7"
+DEFAULT_MAX_NEW_TOKENS = "256"
+DEFAULT_TOP_P = "0.95"
+DEFAULT_TOP_K = "40"
+DEFAULT_REPETITION_PENALTY = "1.1"
+DEFAULT_HISTORY_LENGTH = "10"
+DEFAULT_ENABLE_SKELETON_KEY_JAILBREAK = "false"
+DEFAULT_MAX_BATCH_SIZE = "8"
+DEFAULT_SESSION_CACHE_MAX_TOKENS = "8192"
+DEFAULT_SESSION_CACHE_OFFLOAD = "false"
+DEFAULT_PREFIX_CACHE_MAX_TOKENS = "4096"
+DEFAULT_CONTEXT_TOKEN_BUDGET = "0"
+DEFAULT_HISTORY_SUMMARY = "false"
+DEFAULT_SESSION_STORE = SESSION_STORE_MEMORY
+DEFAULT_SESSION_STORE_PATH = "sessions.db"
+DEFAULT_SESSION_STORE_MAX_SESSIONS = "10000"
+DEFAULT_METRICS_PORT = "0"
+DEFAULT_PROMPT_LOOKUP = "false"
+DEFAULT_SPECULATIVE_TOKENS = "4"
+DEFAULT_WARMUP_TOKENS = "8"
+DEFAULT_METRICS_HOST = "127.0.0.1"
+DEFAULT_COMPILE_DECODE = "false"
+DEFAULT_COMPILE_MAX_TOKENS = "0"
+DEFAULT_LORA_MAX_LOADED_ADAPTERS = "4"
+DEFAULT_RESPONSE_CACHE_MAX_ENTRIES = "1024"
+DEFAULT_RESPONSE_CACHE_DISK_MAX_ENTRIES = "100000"
+DEFAULT_RESPONSE_CACHE_TTL = "0"
+DEFAULT_RESPONSE_CACHE_SAMPLED = "false"
+DEFAULT_STREAM_CHUNK_TOKENS = "1"
+DEFAULT_STREAM_CHUNK_INTERVAL = "0"
+DEFAULT_GENERATION_TIMEOUT = "0"
+# Seconds of p95 request latency the load policy aims for; 0 turns it off
+DEFAULT_ADAPTIVE_TARGET_P95 = "0"
+DEFAULT_ADAPTIVE_INTERVAL = "5"
+DEFAULT_ADAPTIVE_MIN_NEW_TOKENS = "64"
+DEFAULT_ADAPTIVE_MIN_PROMPT_TOKENS = "512"
+# 0 means MAX_BATCH_SIZE, i.e. the batch size isn't adapted
+DEFAULT_ADAPTIVE_MAX_BATCH_SIZE = "0"
+# 0 leaves the thread counts to torch: a thread per core, or per compute core
+# with CPU_IO_CORES
+DEFAULT_CPU_THREADS = "0"
+DEFAULT_CPU_INTEROP_THREADS = "0"
+DEFAULT_CPU_IO_CORES = "0"
+DEFAULT_TELEGRAM_BOT_SPLIT_RESPONSE_NEWLINES = "false"
+DEFAULT_TELEGRAM_BOT_STREAM_RESPONSES = "false"
+# Telegram tolerates about one edit per second per chat before flood waits
+DEFAULT_TELEGRAM_BOT_STREAM_EDIT_INTERVAL = "1.0"
+DEFAULT_TELEGRAM_BOT_WORKERS = "0"
+# 0 means MAX_BATCH_SIZE chats per model worker
+DEFAULT_TELEGRAM_BOT_MAX_ACTIVE_CHATS = "0"
+DEFAULT_TELEGRAM_BOT_MAX_QUEUED_MESSAGES = "64"
+DEFAULT_TELEGRAM_BOT_CHAT_QUEUE_SIZE = "5"
+# Messages per second a chat may send once its burst is used up; off unless
+# set, since coalescing already answers a burst with one generation
+DEFAULT_TELEGRAM_BOT_RATE_LIMIT = "0"
+DEFAULT_TELEGRAM_BOT_RATE_BURST = "5"
+DEFAULT_TELEGRAM_BOT_COALESCE_MESSAGES = "true"
+# Seconds a chat's first message waits for the rest of a burst
+DEFAULT_TELEGRAM_BOT_COALESCE_WINDOW = "1.0"
+# Rows `chat.py batch` reads ahead and sorts by prompt length
+DEFAULT_BATCH_SORT_WINDOW = 1024
+# Where `chat.py serve` listens, and requests it queues before answering 429
+DEFAULT_SERVER_HOST = "127.0.0.1"
+DEFAULT_SERVER_PORT = 8000
+DEFAULT_SERVER_MAX_QUEUED_REQUESTS = 64
+
+# Constants for environment variable names
+ENV_VAR_MODEL_NAME = "MODEL_NAME"
+ENV_VAR_ASSISTANT_NAME = "ASSISTANT_NAME"
+ENV_VAR_SYSTEM_MESSAGE = "SYSTEM_MESSAGE"
+ENV_VAR_TEMPERATURE = "TEMPERATURE"
+ENV_VAR_CHAT_TEMPLATE = "CHAT_TEMPLATE"
+ENV_VAR_MAX_NEW_TOKENS = "MAX_NEW_TOKENS"
+ENV_VAR_TOP_P = "TOP_P"
+ENV_VAR_TOP_K = "TOP_K"
+ENV_VAR_REPETITION_PENALTY = "REPETITION_PENALTY"
+ENV_VAR_HISTORY_LENGTH = "HISTORY_LENGTH"
+ENV_VAR_DEBUG = "DEBUG"
+ENV_VAR_DEVICE = "DEVICE"
+ENV_VAR_MODEL_LOAD_IN_4BIT = "MODEL_LOAD_IN_4BIT"
+ENV_VAR_MODEL_LOAD_IN_8BIT = "MODEL_LOAD_IN_8BIT"
+ENV_VAR_TOKENIZER_NAME = "TOKENIZER_NAME"
+ENV_VAR_DRAFT_MODEL_NAME = "DRAFT_MODEL_NAME"
+ENV_VAR_PROMPT_LOOKUP = "PROMPT_LOOKUP"
+ENV_VAR_SPECULATIVE_TOKENS = "SPECULATIVE_TOKENS"
+ENV_VAR_LORA_WEIGHTS = "LORA_WEIGHTS"
+ENV_VAR_LORA_ADAPTERS = "LORA_ADAPTERS"
+ENV_VAR_LORA_MAX_LOADED_ADAPTERS = "LORA_MAX_LOADED_ADAPTERS"
+ENV_VAR_MODEL_CACHE_DIR = "MODEL_CACHE_DIR"
+ENV_VAR_WARMUP_TOKENS = "WARMUP_TOKENS"
+ENV_VAR_HF_TOKEN = "HF_TOKEN"
+ENV_VAR_ENABLE_SKELETON_KEY_JAILBREAK = "ENABLE_SKELETON_KEY_JAILBREAK"
+ENV_VAR_MAX_BATCH_SIZE = "MAX_BATCH_SIZE"
+ENV_VAR_SESSION_CACHE_MAX_TOKENS = "SESSION_CACHE_MAX_TOKENS"
+ENV_VAR_SESSION_CACHE_OFFLOAD = "SESSION_CACHE_OFFLOAD"
+ENV_VAR_PREFIX_CACHE_MAX_TOKENS = "PREFIX_CACHE_MAX_TOKENS"
+ENV_VAR_CONTEXT_TOKEN_BUDGET = "CONTEXT_TOKEN_BUDGET"
+ENV_VAR_HISTORY_SUMMARY = "HISTORY_SUMMARY"
+ENV_VAR_SESSION_STORE = "SESSION_STORE"
+ENV_VAR_SESSION_STORE_PATH = "SESSION_STORE_PATH"
+ENV_VAR_SESSION_STORE_MAX_SESSIONS = "SESSION_STORE_MAX_SESSIONS"
+ENV_VAR_METRICS_PORT = "METRICS_PORT"
+ENV_VAR_METRICS_HOST = "METRICS_HOST"
+ENV_VAR_COMPILE_DECODE = "COMPILE_DECODE"
+ENV_VAR_COMPILE_MAX_TOKENS = "COMPILE_MAX_TOKENS"
+ENV_VAR_RESPONSE_CACHE_MAX_ENTRIES = "RESPONSE_CACHE_MAX_ENTRIES"
+ENV_VAR_RESPONSE_CACHE_PATH = "RESPONSE_CACHE_PATH"
+ENV_VAR_RESPONSE_CACHE_DISK_MAX_ENTRIES = "RESPONSE_CACHE_DISK_MAX_ENTRIES"
+ENV_VAR_RESPONSE_CACHE_TTL = "RESPONSE_CACHE_TTL"
+ENV_VAR_RESPONSE_CACHE_SAMPLED = "RESPONSE_CACHE_SAMPLED"
+ENV_VAR_STREAM_CHUNK_TOKENS = "STREAM_CHUNK_TOKENS"
+ENV_VAR_STREAM_CHUNK_INTERVAL = "STREAM_CHUNK_INTERVAL"
+ENV_VAR_STOP_STRINGS = "STOP_STRINGS"
+ENV_VAR_GENERATION_TIMEOUT = "GENERATION_TIMEOUT"
+ENV_VAR_ADAPTIVE_TARGET_P95 = "ADAPTIVE_TARGET_P95"
+ENV_VAR_ADAPTIVE_INTERVAL = "ADAPTIVE_INTERVAL"
+ENV_VAR_ADAPTIVE_MIN_NEW_TOKENS = "ADAPTIVE_MIN_NEW_TOKENS"
+ENV_VAR_ADAPTIVE_MIN_PROMPT_TOKENS = "ADAPTIVE_MIN_PROMPT_TOKENS"
+ENV_VAR_ADAPTIVE_MAX_BATCH_SIZE = "ADAPTIVE_MAX_BATCH_SIZE"
+ENV_VAR_CPU_QUANTIZATION = "CPU_QUANTIZATION"
+ENV_VAR_CPU_THREADS = "CPU_THREADS"
+ENV_VAR_CPU_INTEROP_THREADS = "CPU_INTEROP_THREADS"
+ENV_VAR_CPU_IO_CORES = "CPU_IO_CORES"
+ENV_VAR_TELEGRAM_BOT_TOKEN = "TELEGRAM_BOT_TOKEN"
+ENV_VAR_TELEGRAM_BOT_USER_DATA_FILE = "TELEGRAM_BOT_USER_DATA_FILE"
+ENV_VAR_TELEGRAM_BOT_SUPERUSER_CHAT_ID = "TELEGRAM_BOT_SUPERUSER_CHAT_ID"
+ENV_VAR_TELEGRAM_BOT_SPLIT_RESPONSE_NEWLINES = "TELEGRAM_BOT_SPLIT_RESPONSE_NEWLINES"
+ENV_VAR_TELEGRAM_BOT_STREAM_RESPONSES = "TELEGRAM_BOT_STREAM_RESPONSES"
+ENV_VAR_TELEGRAM_BOT_STREAM_EDIT_INTERVAL = "TELEGRAM_BOT_STREAM_EDIT_INTERVAL"
+ENV_VAR_TELEGRAM_BOT_WORKERS = "TELEGRAM_BOT_WORKERS"
+ENV_VAR_TELEGRAM_BOT_MAX_ACTIVE_CHATS = "TELEGRAM_BOT_MAX_ACTIVE_CHATS"
+ENV_VAR_TELEGRAM_BOT_MAX_QUEUED_MESSAGES = "TELEGRAM_BOT_MAX_QUEUED_MESSAGES"
+ENV_VAR_TELEGRAM_BOT_CHAT_QUEUE_SIZE = "TELEGRAM_BOT_CHAT_QUEUE_SIZE"
+ENV_VAR_TELEGRAM_BOT_RATE_LIMIT = "TELEGRAM_BOT_RATE_LIMIT"
+ENV_VAR_TELEGRAM_BOT_RATE_BURST = "TELEGRAM_BOT_RATE_BURST"
+ENV_VAR_TELEGRAM_BOT_COALESCE_MESSAGES = "TELEGRAM_BOT_COALESCE_MESSAGES"
+ENV_VAR_TELEGRAM_BOT_COALESCE_WINDOW = "TELEGRAM_BOT_COALESCE_WINDOW"
+
+
+class ConfigError(ValueError):
+    def __init__(self, errors: List[str]) -> None:
+        super().__init__(
+            "Invalid configuration:\n" + "\n".join(f"- {e}" for e in errors)
+        )
+        self.errors = errors
+
+
+@dataclass
+class ChatbotConfig:
+    """Every Chatbot setting, read from the environment by from_env()."""
+
+    # Must be None, not "", when unset: huggingface_hub now sends the token
+    # verbatim, and an empty one becomes an illegal `Authorization: Bearer `
+    # header that the HTTP client rejects before the request leaves.
+    huggingface_token: Optional[str]
+    model_name: str
+    tokenizer_name: str
+    # Must share the tokenizer of model_name
+    draft_model_name: str
+    prompt_lookup: bool
+    speculative_tokens: int
+    chat_template: str
+    assistant_name: str
+    system_message: str
+    temperature: float
+    max_new_tokens: int
+    top_p: float
+    top_k: int
+    repetition_penalty: float
+    # Replies end at the first of these
+    stop_strings: Tuple[str, ...]
+    # Seconds a reply may take, queueing included, before it is cut short;
+    # 0 for no limit
+    generation_timeout: float
+    session_store_backend: str
+    session_store_path: str
+    session_store_max_sessions: int
+    history_length: int
+    context_token_budget: int
+    history_summary: bool
+    debug: bool
+    # Empty picks cuda when available, which needs torch to find out
+    device: str
+    load_in_4bit: bool
+    load_in_8bit: bool
+    lora_weights: str
+    # Named adapters a chat can switch to, name -> local path or hub id
+    lora_adapters: Dict[str, str]
+    lora_max_loaded_adapters: int
+    # Where fully prepared (quantized, LoRA-merged) models are kept
+    model_cache_dir: str
+    warmup_tokens: int
+    enable_skeleton_key_jailbreak: bool
+    max_batch_size: int
+    session_cache_max_tokens: int
+    session_cache_offload: bool
+    prefix_cache_max_tokens: int
+    metrics_port: int
+    metrics_host: str
+    compile_decode: bool
+    # Longest static cache compiled for; 0 means the context token budget
+    compile_max_tokens: int
+    # Replies kept in memory; 0 with no path turns the response cache off
+    response_cache_max_entries: int
+    # SQLite file the response cache also keeps replies in, "" for none
+    response_cache_path: str
+    response_cache_disk_max_entries: int
+    # Seconds a cached reply stays valid, 0 for as long as it is kept
+    response_cache_ttl: float
+    # Also cache sampled replies, which then stop varying between requests
+    response_cache_sampled: bool
+    # Streamed replies wake their readers every this many tokens, or every
+    # interval seconds when that is set and comes first
+    stream_chunk_tokens: int
+    stream_chunk_interval: float
+    # Under load, replies and prompts are cut down towards these minimums
+    # (and the batch grows up to adaptive_max_batch_size) to keep the p95
+    # request latency under adaptive_target_p95; 0 for fixed limits
+    adaptive_target_p95: float
+    # Seconds between adjustments
+    adaptive_interval: float
+    adaptive_min_new_tokens: int
+    adaptive_min_prompt_tokens: int
+    adaptive_max_batch_size: int
+    # int8 or bf16 weights for CPU inference, "" for the full precision ones
+    cpu_quantization: str
+    # Intra-op and inter-op threads of torch on the CPU, 0 for its defaults
+    cpu_threads: int
+    cpu_interop_threads: int
+    # Cores kept for tokenization and I/O; generation is pinned to the rest.
+    # 0 pins nothing
+    cpu_io_cores: int
+
+    def __post_init__(self) -> None:
+        errors: List[str] = []
+        for env_var, value, minimum in [
+            (ENV_VAR_TEMPERATURE, self.temperature, 0),
+            (ENV_VAR_MAX_NEW_TOKENS, self.max_new_tokens, 1),
+            (ENV_VAR_TOP_K, self.top_k, 0),
+            (ENV_VAR_SPECULATIVE_TOKENS, self.speculative_tokens, 0),
+            (ENV_VAR_SESSION_STORE_MAX_SESSIONS, self.session_store_max_sessions, 1),
+            (ENV_VAR_HISTORY_LENGTH, self.history_length, 0),
+            (ENV_VAR_CONTEXT_TOKEN_BUDGET, self.context_token_budget, 0),
+            (ENV_VAR_WARMUP_TOKENS, self.warmup_tokens, 0),
+            (ENV_VAR_MAX_BATCH_SIZE, self.max_batch_size, 1),
+            (ENV_VAR_SESSION_CACHE_MAX_TOKENS, self.session_cache_max_tokens, 0),
+            (ENV_VAR_PREFIX_CACHE_MAX_TOKENS, self.prefix_cache_max_tokens, 0),
+            (ENV_VAR_METRICS_PORT, self.metrics_port, 0),
+            (ENV_VAR_COMPILE_MAX_TOKENS, self.compile_max_tokens, 0),
+            (ENV_VAR_LORA_MAX_LOADED_ADAPTERS, self.lora_max_loaded_adapters, 1),
+            (
+                ENV_VAR_RESPONSE_CACHE_MAX_ENTRIES,
+                self.response_cache_max_entries,
+                0,
+            ),
+            (
+                ENV_VAR_RESPONSE_CACHE_DISK_MAX_ENTRIES,
+                self.response_cache_disk_max_entries,
+                1,
+            ),
+            (ENV_VAR_RESPONSE_CACHE_TTL, self.response_cache_ttl, 0),
+            (ENV_VAR_STREAM_CHUNK_TOKENS, self.stream_chunk_tokens, 1),
+            (ENV_VAR_STREAM_CHUNK_INTERVAL, self.stream_chunk_interval, 0),
+            (ENV_VAR_GENERATION_TIMEOUT, self.generation_timeout, 0),
+            (ENV_VAR_ADAPTIVE_TARGET_P95, self.adaptive_target_p95, 0),
+            (ENV_VAR_ADAPTIVE_INTERVAL, self.adaptive_interval, 0.1),
+            (ENV_VAR_ADAPTIVE_MIN_NEW_TOKENS, self.adaptive_min_new_tokens, 1),
+            (ENV_VAR_ADAPTIVE_MIN_PROMPT_TOKENS, self.adaptive_min_prompt_tokens, 1),
+            (ENV_VAR_ADAPTIVE_MAX_BATCH_SIZE, self.adaptive_max_batch_size, 0),
+            (ENV_VAR_CPU_THREADS, self.cpu_threads, 0),
+            (ENV_VAR_CPU_INTEROP_THREADS, self.cpu_interop_threads, 0),
+            (ENV_VAR_CPU_IO_CORES, self.cpu_io_cores, 0),
+        ]:
+            if value < minimum:
+                errors.append(f"{env_var} must be at least {minimum}, got {value}")
+
+        if not 0 < self.top_p <= 1:
+            errors.append(f"{ENV_VAR_TOP_P} must be in (0, 1], got {self.top_p}")
+        if self.repetition_penalty <= 0:
+            errors.append(
+                f"{ENV_VAR_REPETITION_PENALTY} must be positive, "
+                f"got {self.repetition_penalty}"
+            )
+        if self.metrics_port > 65535:
+            errors.append(f"{ENV_VAR_METRICS_PORT} must be a port number")
+        if self.chat_template and self.chat_template not in CHAT_TEMPLATES:
+            errors.append(
+                f"{ENV_VAR_CHAT_TEMPLATE} must be one of: "
+                f"{', '.join(sorted(CHAT_TEMPLATES))}"
+            )
+        if self.session_store_backend not in [
+            SESSION_STORE_MEMORY,
+            SESSION_STORE_SQLITE,
+        ]:
+            errors.append(
+                f"{ENV_VAR_SESSION_STORE} must be one of: "
+                f"{SESSION_STORE_MEMORY}, {SESSION_STORE_SQLITE}"
+            )
+        if self.load_in_4bit and self.load_in_8bit:
+            errors.append(
+                f"{ENV_VAR_MODEL_LOAD_IN_4BIT} and {ENV_VAR_MODEL_LOAD_IN_8BIT} "
+                "can't both be enabled"
+            )
+        if self.cpu_quantization:
+            if self.cpu_quantization not in CPU_QUANTIZATIONS:
+                errors.append(
+                    f"{ENV_VAR_CPU_QUANTIZATION} must be one of: "
+                    f"{', '.join(CPU_QUANTIZATIONS)}"
+                )
+            if self.device not in ["", "cpu"]:
+                errors.append(
+                    f"{ENV_VAR_CPU_QUANTIZATION} needs {ENV_VAR_DEVICE} to be cpu, "
+                    f"got {self.device}"
+                )
+            if self.load_in_4bit or self.load_in_8bit:
+                errors.append(
+                    f"{ENV_VAR_CPU_QUANTIZATION} can't be combined with "
+                    f"{ENV_VAR_MODEL_LOAD_IN_4BIT} or {ENV_VAR_MODEL_LOAD_IN_8BIT}"
+                )
+        if self.cpu_quantization == CPU_QUANTIZATION_INT8:
+            # Quantizing swaps out every nn.Linear, the ones in LoRA layers
+            # too, and torch.compile has no use for the int8 kernels
+            for env_var, enabled in [
+                (ENV_VAR_LORA_ADAPTERS, bool(self.lora_adapters)),
+                (ENV_VAR_COMPILE_DECODE, self.compile_decode),
+            ]:
+                if enabled:
+                    errors.append(
+                        f"{ENV_VAR_CPU_QUANTIZATION}={CPU_QUANTIZATION_INT8} "
+                        f"can't be combined with {env_var}"
+                    )
+        if self.compile_decode and self.lora_adapters:
+            # The compiled graph would run whichever adapter was last active
+            # for every row
+            errors.append(
+                f"{ENV_VAR_COMPILE_DECODE} can't be combined with "
+                f"{ENV_VAR_LORA_ADAPTERS}"
+            )
+
+        if errors:
+            raise ConfigError(errors)
+
+    @classmethod
+    def from_env(cls) -> "ChatbotConfig":
+        env = _Environment()
+        model_name = env.text(ENV_VAR_MODEL_NAME, DEFAULT_MODEL_NAME)
+        config = dict(
+            huggingface_token=env.text(ENV_VAR_HF_TOKEN) or None,
+            model_name=model_name,
+            tokenizer_name=env.text(ENV_VAR_TOKENIZER_NAME, model_name),
+            draft_model_name=env.text(ENV_VAR_DRAFT_MODEL_NAME),
+            prompt_lookup=env.flag(ENV_VAR_PROMPT_LOOKUP, DEFAULT_PROMPT_LOOKUP),
+            speculative_tokens=env.integer(
+                ENV_VAR_SPECULATIVE_TOKENS, DEFAULT_SPECULATIVE_TOKENS
+            ),
+            chat_template=env.text(ENV_VAR_CHAT_TEMPLATE),
+            assistant_name=env.text(ENV_VAR_ASSISTANT_NAME, DEFAULT_ASSISTANT_NAME),
+            system_message=env.text(ENV_VAR_SYSTEM_MESSAGE),
+            temperature=env.number(ENV_VAR_TEMPERATURE, DEFAULT_TEMPERATURE),
+            max_new_tokens=env.integer(ENV_VAR_MAX_NEW_TOKENS, DEFAULT_MAX_NEW_TOKENS),
+            top_p=env.number(ENV_VAR_TOP_P, DEFAULT_TOP_P),
+            top_k=env.integer(ENV_VAR_TOP_K, DEFAULT_TOP_K),
+            repetition_penalty=env.number(
+                ENV_VAR_REPETITION_PENALTY, DEFAULT_REPETITION_PENALTY
+            ),
+            stop_strings=env.strings(ENV_VAR_STOP_STRINGS),
+            generation_timeout=env.number(
+                ENV_VAR_GENERATION_TIMEOUT, DEFAULT_GENERATION_TIMEOUT
+            ),
+            session_store_backend=env.text(
+                ENV_VAR_SESSION_STORE, DEFAULT_SESSION_STORE
+            ).lower(),
+            session_store_path=env.text(
+                ENV_VAR_SESSION_STORE_PATH, DEFAULT_SESSION_STORE_PATH
+            ),
+            session_store_max_sessions=env.integer(
+                ENV_VAR_SESSION_STORE_MAX_SESSIONS, DEFAULT_SESSION_STORE_MAX_SESSIONS
+            ),
+            history_length=env.integer(ENV_VAR_HISTORY_LENGTH, DEFAULT_HISTORY_LENGTH),
+            context_token_budget=env.integer(
+                ENV_VAR_CONTEXT_TOKEN_BUDGET, DEFAULT_CONTEXT_TOKEN_BUDGET
+            ),
+            history_summary=env.flag(ENV_VAR_HISTORY_SUMMARY, DEFAULT_HISTORY_SUMMARY),
+            debug=env.flag(ENV_VAR_DEBUG, "false"),
+            device=env.text(ENV_VAR_DEVICE),
+            load_in_4bit=env.flag(ENV_VAR_MODEL_LOAD_IN_4BIT, "false"),
+            load_in_8bit=env.flag(ENV_VAR_MODEL_LOAD_IN_8BIT, "false"),
+            lora_weights=env.text(ENV_VAR_LORA_WEIGHTS),
+            lora_adapters=env.mapping(ENV_VAR_LORA_ADAPTERS),
+            lora_max_loaded_adapters=env.integer(
+                ENV_VAR_LORA_MAX_LOADED_ADAPTERS, DEFAULT_LORA_MAX_LOADED_ADAPTERS
+            ),
+            model_cache_dir=env.text(ENV_VAR_MODEL_CACHE_DIR),
+            warmup_tokens=env.integer(ENV_VAR_WARMUP_TOKENS, DEFAULT_WARMUP_TOKENS),
+            enable_skeleton_key_jailbreak=env.flag(
+                ENV_VAR_ENABLE_SKELETON_KEY_JAILBREAK,
+                DEFAULT_ENABLE_SKELETON_KEY_JAILBREAK,
+            ),
+            max_batch_size=env.integer(ENV_VAR_MAX_BATCH_SIZE, DEFAULT_MAX_BATCH_SIZE),
+            session_cache_max_tokens=env.integer(
+                ENV_VAR_SESSION_CACHE_MAX_TOKENS, DEFAULT_SESSION_CACHE_MAX_TOKENS
+            ),
+            session_cache_offload=env.flag(
+                ENV_VAR_SESSION_CACHE_OFFLOAD, DEFAULT_SESSION_CACHE_OFFLOAD
+            ),
+            prefix_cache_max_tokens=env.integer(
+                ENV_VAR_PREFIX_CACHE_MAX_TOKENS, DEFAULT_PREFIX_CACHE_MAX_TOKENS
+            ),
+            metrics_port=env.integer(ENV_VAR_METRICS_PORT, DEFAULT_METRICS_PORT),
+            metrics_host=env.text(ENV_VAR_METRICS_HOST, DEFAULT_METRICS_HOST),
+            compile_decode=env.flag(ENV_VAR_COMPILE_DECODE, DEFAULT_COMPILE_DECODE),
+            compile_max_tokens=env.integer(
+                ENV_VAR_COMPILE_MAX_TOKENS, DEFAULT_COMPILE_MAX_TOKENS
+            ),
+            response_cache_max_entries=env.integer(
+                ENV_VAR_RESPONSE_CACHE_MAX_ENTRIES, DEFAULT_RESPONSE_CACHE_MAX_ENTRIES
+            ),
+            response_cache_path=env.text(ENV_VAR_RESPONSE_CACHE_PATH),
+            response_cache_disk_max_entries=env.integer(
+                ENV_VAR_RESPONSE_CACHE_DISK_MAX_ENTRIES,
+                DEFAULT_RESPONSE_CACHE_DISK_MAX_ENTRIES,
+            ),
+            response_cache_ttl=env.number(
+                ENV_VAR_RESPONSE_CACHE_TTL, DEFAULT_RESPONSE_CACHE_TTL
+            ),
+            response_cache_sampled=env.flag(
+                ENV_VAR_RESPONSE_CACHE_SAMPLED, DEFAULT_RESPONSE_CACHE_SAMPLED
+            ),
+            stream_chunk_tokens=env.integer(
+                ENV_VAR_STREAM_CHUNK_TOKENS, DEFAULT_STREAM_CHUNK_TOKENS
+            ),
+            stream_chunk_interval=env.number(
+                ENV_VAR_STREAM_CHUNK_INTERVAL, DEFAULT_STREAM_CHUNK_INTERVAL
+            ),
+            adaptive_target_p95=env.number(
+                ENV_VAR_ADAPTIVE_TARGET_P95, DEFAULT_ADAPTIVE_TARGET_P95
+            ),
+            adaptive_interval=env.number(
+                ENV_VAR_ADAPTIVE_INTERVAL, DEFAULT_ADAPTIVE_INTERVAL
+            ),
+            adaptive_min_new_tokens=env.integer(
+                ENV_VAR_ADAPTIVE_MIN_NEW_TOKENS, DEFAULT_ADAPTIVE_MIN_NEW_TOKENS
+            ),
+            adaptive_min_prompt_tokens=env.integer(
+                ENV_VAR_ADAPTIVE_MIN_PROMPT_TOKENS, DEFAULT_ADAPTIVE_MIN_PROMPT_TOKENS
+            ),
+            adaptive_max_batch_size=env.integer(
+                ENV_VAR_ADAPTIVE_MAX_BATCH_SIZE, DEFAULT_ADAPTIVE_MAX_BATCH_SIZE
+            ),
+            cpu_quantization=env.text(ENV_VAR_CPU_QUANTIZATION).lower(),
+            cpu_threads=env.integer(ENV_VAR_CPU_THREADS, DEFAULT_CPU_THREADS),
+            cpu_interop_threads=env.integer(
+                ENV_VAR_CPU_INTEROP_THREADS, DEFAULT_CPU_INTEROP_THREADS
+            ),
+            cpu_io_cores=env.integer(ENV_VAR_CPU_IO_CORES, DEFAULT_CPU_IO_CORES),
+        )
+        env.check()
+        return cls(**config)
+
+
+@dataclass
+class TelegramConfig:
+    """Settings of the Telegram bot itself, read by from_env()."""
+
+    token: str
+    user_data_file: str
+    superuser_chat_id: str
+    split_response_newlines: bool
+    # Stream replies by editing the message as tokens come in
+    stream_responses: bool
+    stream_edit_interval: float
+    # Model worker processes; 0 runs the model inside the bot process
+    workers: int
+    # Chats generating at once, 0 for MAX_BATCH_SIZE per worker; the rest
+    # wait their turn, fairly, up to max_queued_messages
+    max_active_chats: int
+    max_queued_messages: int
+    # Messages a chat may have waiting
+    chat_queue_size: int
+    # Messages per second a chat may send after a burst of rate_burst; 0
+    # for no limit
+    rate_limit: float
+    rate_burst: int
+    # Answer the messages a chat sent while waiting for its turn as one
+    coalesce_messages: bool
+    coalesce_window: float
+
+    def __post_init__(self) -> None:
+        errors: List[str] = []
+        if not self.user_data_file:
+            errors.append(f"{ENV_VAR_TELEGRAM_BOT_USER_DATA_FILE} must be set")
+        for env_var, value, minimum in [
+            (ENV_VAR_TELEGRAM_BOT_MAX_ACTIVE_CHATS, self.max_active_chats, 0),
+            (ENV_VAR_TELEGRAM_BOT_MAX_QUEUED_MESSAGES, self.max_queued_messages, 0),
+            (ENV_VAR_TELEGRAM_BOT_CHAT_QUEUE_SIZE, self.chat_queue_size, 1),
+            (ENV_VAR_TELEGRAM_BOT_RATE_LIMIT, self.rate_limit, 0),
+            (ENV_VAR_TELEGRAM_BOT_RATE_BURST, self.rate_burst, 1),
+            (ENV_VAR_TELEGRAM_BOT_COALESCE_WINDOW, self.coalesce_window, 0),
+        ]:
+            if value < minimum:
+                errors.append(f"{env_var} must be at least {minimum}, got {value}")
+        if self.stream_edit_interval < 0:
+            errors.append(
+                f"{ENV_VAR_TELEGRAM_BOT_STREAM_EDIT_INTERVAL} can't be negative, "
+                f"got {self.stream_edit_interval}"
+            )
+        if self.workers < 0:
+            errors.append(
+                f"{ENV_VAR_TELEGRAM_BOT_WORKERS} can't be negative, got {self.workers}"
+            )
+
+        if errors:
+            raise ConfigError(errors)
+
+    @classmethod
+    def from_env(cls) -> "TelegramConfig":
+        env = _Environment()
+        config = dict(
+            token=env.text(ENV_VAR_TELEGRAM_BOT_TOKEN),
+            user_data_file=env.text(ENV_VAR_TELEGRAM_BOT_USER_DATA_FILE),
+            superuser_chat_id=env.text(ENV_VAR_TELEGRAM_BOT_SUPERUSER_CHAT_ID),
+            split_response_newlines=env.flag(
+                ENV_VAR_TELEGRAM_BOT_SPLIT_RESPONSE_NEWLINES,
+                DEFAULT_TELEGRAM_BOT_SPLIT_RESPONSE_NEWLINES,
+            ),
+            stream_responses=env.flag(
+                ENV_VAR_TELEGRAM_BOT_STREAM_RESPONSES,
+                DEFAULT_TELEGRAM_BOT_STREAM_RESPONSES,
+            ),
+            stream_edit_interval=env.number(
+                ENV_VAR_TELEGRAM_BOT_STREAM_EDIT_INTERVAL,
+                DEFAULT_TELEGRAM_BOT_STREAM_EDIT_INTERVAL,
+            ),
+            workers=env.integer(
+                ENV_VAR_TELEGRAM_BOT_WORKERS, DEFAULT_TELEGRAM_BOT_WORKERS
+            ),
+            max_active_chats=env.integer(
+                ENV_VAR_TELEGRAM_BOT_MAX_ACTIVE_CHATS,
+                DEFAULT_TELEGRAM_BOT_MAX_ACTIVE_CHATS,
+            ),
+            max_queued_messages=env.integer(
+                ENV_VAR_TELEGRAM_BOT_MAX_QUEUED_MESSAGES,
+                DEFAULT_TELEGRAM_BOT_MAX_QUEUED_MESSAGES,
+            ),
+            chat_queue_size=env.integer(
+                ENV_VAR_TELEGRAM_BOT_CHAT_QUEUE_SIZE,
+                DEFAULT_TELEGRAM_BOT_CHAT_QUEUE_SIZE,
+            ),
+            rate_limit=env.number(
+                ENV_VAR_TELEGRAM_BOT_RATE_LIMIT, DEFAULT_TELEGRAM_BOT_RATE_LIMIT
+            ),
+            rate_burst=env.integer(
+                ENV_VAR_TELEGRAM_BOT_RATE_BURST, DEFAULT_TELEGRAM_BOT_RATE_BURST
+            ),
+            coalesce_messages=env.flag(
+                ENV_VAR_TELEGRAM_BOT_COALESCE_MESSAGES,
+                DEFAULT_TELEGRAM_BOT_COALESCE_MESSAGES,
+            ),
+            coalesce_window=env.number(
+                ENV_VAR_TELEGRAM_BOT_COALESCE_WINDOW,
+                DEFAULT_TELEGRAM_BOT_COALESCE_WINDOW,
+            ),
+        )
+        env.check()
+        return cls(**config)
+
+
+class _Environment:
+    # Collects every unparsable variable, so one run reports all of them
+
+    def __init__(self) -> None:
+        self.errors: List[str] = []
+
+    def text(self, name: str, default: str = "") -> str:
+        return os.getenv(name, "") or default
+
+    def flag(self, name: str, default: str) -> bool:
+        value = self.text(name, default).lower()
+        if value not in ["true", "false"]:
+            self.errors.append(f"{name} must be true or false, got {value!r}")
+        return value == "true"
+
+    def integer(self, name: str, default: str) -> int:
+        value = self.text(name, default)
+        try:
+            return int(value)
+        except ValueError:
+            self.errors.append(f"{name} must be an integer, got {value!r}")
+            return int(default)
+
+    def number(self, name: str, default: str) -> float:
+        value = self.text(name, default)
+        try:
+            return float(value)
+        except ValueError:
+            self.errors.append(f"{name} must be a number, got {value!r}")
+            return float(default)
+
+    def mapping(self, name: str) -> Dict[str, str]:
+        # name=value pairs separated by commas
+        mapping: Dict[str, str] = {}
+        for item in self.text(name).split(","):
+            if not item.strip():
+                continue
+            key, separator, value = item.partition("=")
+            key, value = key.strip(), value.strip()
+            if not separator or not key or not value:
+                self.errors.append(f"{name} entries must be name=value, got {item!r}")
+            elif key in mapping:
+                self.errors.append(f"{name} names {key!r} twice")
+            else:
+                mapping[key] = value
+        return mapping
+
+    def strings(self, name: str) -> Tuple[str, ...]:
+        # Separated by commas; \, is a comma, \n a newline, \t a tab and
+        # \\ a backslash
+        escapes = {",": ",", "n": "\n", "t": "\t", "\\": "\\"}
+        strings: List[str] = []
+        current = ""
+        characters = iter(self.text(name))
+        for character in characters:
+            if character == "\\":
+                escaped = next(characters, "")
+                if escaped not in escapes:
+                    self.errors.append(
+                        f"{name} has an unknown escape \\{escaped}, use \\, \\n "
+                        "\\t or \\\\"
+                    )
+                    return ()
+                current += escapes[escaped]
+            elif character == ",":
+                strings.append(current)
+                current = ""
+            else:
+                current += character
+        strings.append(current)
+        return tuple(string for string in strings if string)
+
+    def check(self) -> None:
+        if self.errors:
+            raise ConfigError(self.errors)
@@ -0,0 +1,89 @@
+import os
+from typing import Any, List, Tuple
+
+# torch is imported where it's needed: config.py reads the constants before
+# torch loads
+
+# Weights quantized to int8 per output channel, activations on the fly, for
+# every nn.Linear; the matmuls run on int8 kernels (fbgemm/oneDNN)
+CPU_QUANTIZATION_INT8 = "int8"
+# Weights and activations in bfloat16, half the memory of float32; only fast
+# on CPUs with native bf16 (AVX512-BF16, AMX)
+CPU_QUANTIZATION_BF16 = "bf16"
+CPU_QUANTIZATIONS = [CPU_QUANTIZATION_INT8, CPU_QUANTIZATION_BF16]
+
+
+def split_cores(io_cores: int) -> Tuple[List[int], List[int]]:
+    # The cores the calling thread may run on, as (I/O cores, compute cores):
+    # the first io_cores for tokenization, the event loop and everything
+    # else, the rest for generation. Both empty when there is nothing to
+    # split, or no way to pin threads (not Linux)
+    if io_cores <= 0 or not hasattr(os, "sched_getaffinity"):
+        return [], []
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) <= io_cores:
+        return [], []
+    return cores[:io_cores], cores[io_cores:]
+
+
+def share_cores(cores: List[int], index: int, workers: int) -> List[int]:
+    # Worker index's share of cores, for processes splitting them
+    share = cores[index * len(cores) // workers : (index + 1) * len(cores) // workers]
+    return share or [cores[index % len(cores)]]
+
+
+def pin_thread(cores: List[int]) -> None:
+    # Pins the calling thread; threads it starts afterwards (torch's OpenMP
+    # pool included) inherit the pinning
+    os.sched_setaffinity(0, cores)
+
+
+def pin_process(cores: List[int]) -> None:
+    # Pins every thread of the process: the Telegram event loop, executor
+    # threads, whichever thread loaded the model
+    for thread_id in os.listdir("/proc/self/task"):
+        try:
+            os.sched_setaffinity(int(thread_id), cores)
+        except OSError:
+            # Exited in the meantime
+            pass
+
+
+def set_threads(threads: int, interop_threads: int) -> None:
+    # 0 leaves a setting alone
+    import torch
+
+    if threads > 0:
+        torch.set_num_threads(threads)
+    if interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # Only possible once per process, before any inter-op work
+            print(
+                "Warning: inter-op threads already set to "
+                f"{torch.get_num_interop_threads()}"
+            )
+
+
+def load_dtype(quantization: str) -> Any:
+    # What to load the weights as: bf16 straight away instead of converting
+    # a float32 copy, and float32 for int8, which quantizes float32 Linears
+    import torch
+
+    if quantization == CPU_QUANTIZATION_BF16:
+        return torch.bfloat16
+    return torch.float32
+
+
+def quantize_for_cpu(model: Any, quantization: str) -> Any:
+    import torch
+
+    if quantization == CPU_QUANTIZATION_BF16:
+        if not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+            print("Warning: this CPU has no native bfloat16, expect it to be slow")
+        return model.to(torch.bfloat16)
+
+    from torch.ao.quantization import quantize_dynamic
+
+    return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
@@ -0,0 +1,395 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import torch
+from transformers import DynamicCache
+
+# Per-layer (keys, values), each shaped [1, heads, tokens, head_dim]
+KVState = List[Tuple[torch.Tensor, torch.Tensor]]
+
+
+def cache_from_states(states: List[KVState], device: str) -> DynamicCache:
+    # Rows of different lengths are left-padded with zeros; the caller is
+    # responsible for masking those columns out.
+    length = max(state[0][0].shape[-2] for state in states)
+    cache = DynamicCache()
+    for layer_idx in range(len(states[0])):
+        keys = torch.cat(
+            [_pad_left(state[layer_idx][0].to(device), length) for state in states]
+        )
+        values = torch.cat(
+            [_pad_left(state[layer_idx][1].to(device), length) for state in states]
+        )
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+def state_from_cache(cache: DynamicCache, row: int, columns: torch.Tensor) -> KVState:
+    return [
+        (
+            layer.keys[row : row + 1, :, columns, :],
+            layer.values[row : row + 1, :, columns, :],
+        )
+        for layer in cache.layers
+    ]
+
+
+def slice_state(state: KVState, start: int, end: int) -> KVState:
+    return [
+        (keys[:, :, start:end, :], values[:, :, start:end, :]) for keys, values in state
+    ]
+
+
+def state_to(state: KVState, device: str) -> KVState:
+    return [(keys.to(device), values.to(device)) for keys, values in state]
+
+
+def pad_cache_left(cache: DynamicCache, length: int) -> DynamicCache:
+    for layer in cache.layers:
+        layer.keys = _pad_left(layer.keys, length)
+        layer.values = _pad_left(layer.values, length)
+    return cache
+
+
+def concat_caches(first: DynamicCache, second: DynamicCache) -> DynamicCache:
+    for layer, other in zip(first.layers, second.layers):
+        layer.keys = torch.cat([layer.keys, other.keys])
+        layer.values = torch.cat([layer.values, other.values])
+    return first
+
+
+def pad_mask_left(attention_mask: torch.Tensor, length: int) -> torch.Tensor:
+    return torch.nn.functional.pad(
+        attention_mask, (length - attention_mask.shape[-1], 0)
+    )
+
+
+def trim_leading_padding(
+    cache: DynamicCache, attention_mask: torch.Tensor
+) -> torch.Tensor:
+    # Drops the leading columns that are padding for every row, e.g. after
+    # the longest row left the batch. Returns the trimmed mask.
+    used_columns = attention_mask.any(dim=0).nonzero()
+    start = int(used_columns[0]) if len(used_columns) else 0
+    if start > 0:
+        attention_mask = attention_mask[:, start:]
+        for layer in cache.layers:
+            layer.keys = layer.keys[:, :, start:, :]
+            layer.values = layer.values[:, :, start:, :]
+    return attention_mask
+
+
+def _pad_left(tensor: torch.Tensor, length: int) -> torch.Tensor:
+    missing = length - tensor.shape[-2]
+    if missing <= 0:
+        return tensor
+    return torch.nn.functional.pad(tensor, (0, 0, missing, 0))
+
+
+def common_prefix_length(first: List[int], second: List[int]) -> int:
+    length = 0
+    for a, b in zip(first, second):
+        if a != b:
+            break
+        length += 1
+    return length
+
+
+class SessionKVCache:
+    """
+    Keeps the KV state of each session's last turn so the next turn only has
+    to prefill what was appended since. Entries are matched on token ids, not
+    on history bookkeeping: trimming old messages or changing the system
+    message changes the head of the prompt, the shared prefix shrinks to
+    nothing and the entry is simply not used.
+    """
+
+    def __init__(self, max_tokens: int, offload_device: Optional[str] = None) -> None:
+        self.max_tokens = max_tokens
+        self.offload_device = offload_device
+
+        self._entries: "OrderedDict[Hashable, Tuple[List[int], KVState]]" = (
+            OrderedDict()
+        )
+        self._tokens: int = 0
+        self._lock = threading.Lock()
+
+        self.lookups: int = 0
+        self.hits: int = 0
+        self.evictions: int = 0
+        self.prefill_tokens_saved: int = 0
+        self.prefill_tokens_computed: int = 0
+
+    def take(
+        self, session_id: Hashable, input_ids: List[int]
+    ) -> Tuple[Optional[KVState], int]:
+        # The entry is removed: the request now owns it and stores a fresh one
+        # when it finishes.
+        with self._lock:
+            self.lookups += 1
+            entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self._tokens -= len(entry[0])
+
+        reused = 0
+        state = None
+        if entry is not None:
+            token_ids, state = entry
+            # At least one prompt token has to go through the model to get
+            # logits for the first new token.
+            reused = min(common_prefix_length(token_ids, input_ids), len(input_ids) - 1)
+
+        with self._lock:
+            if reused > 0:
+                self.hits += 1
+            self.prefill_tokens_saved += reused
+            self.prefill_tokens_computed += len(input_ids) - reused
+
+        if reused <= 0:
+            return None, 0
+
+        return slice_state(state, 0, reused), reused
+
+    def store(self, session_id: Hashable, token_ids: List[int], state: KVState) -> None:
+        if len(token_ids) > self.max_tokens:
+            return
+
+        if self.offload_device is not None:
+            state = state_to(state, self.offload_device)
+
+        with self._lock:
+            previous = self._entries.pop(session_id, None)
+            if previous is not None:
+                self._tokens -= len(previous[0])
+
+            self._entries[session_id] = (token_ids, state)
+            self._tokens += len(token_ids)
+
+            while self._tokens > self.max_tokens:
+                _, (evicted_ids, _) = self._entries.popitem(last=False)
+                self._tokens -= len(evicted_ids)
+                self.evictions += 1
+
+    def invalidate(self, session_id: Hashable) -> None:
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self._tokens -= len(entry[0])
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._tokens = 0
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.prefill_tokens_saved + self.prefill_tokens_computed
+            return {
+                "sessions": len(self._entries),
+                "cached_tokens": self._tokens,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "evictions": self.evictions,
+                "prefill_tokens_saved": self.prefill_tokens_saved,
+                "prefill_tokens_computed": self.prefill_tokens_computed,
+                "prefill_saved_ratio": (
+                    self.prefill_tokens_saved / total if total else 0.0
+                ),
+            }
+
+
+def concat_states(states: List[KVState]) -> KVState:
+    return [
+        (
+            torch.cat([state[layer_idx][0] for state in states], dim=-2),
+            torch.cat([state[layer_idx][1] for state in states], dim=-2),
+        )
+        for layer_idx in range(len(states[0]))
+    ]
+
+
+class _RadixNode:
+    def __init__(
+        self,
+        token_ids: List[int],
+        state: Optional[KVState],
+        parent: Optional["_RadixNode"],
+    ) -> None:
+        self.token_ids = token_ids
+        self.state = state
+        self.parent = parent
+        self.children: Dict[int, "_RadixNode"] = {}
+        self.last_access: int = 0
+        self.pinned: bool = False
+
+
+class PrefixCache:
+    """
+    Radix tree of KV states keyed on prompt token ids, shared by every
+    session. Each edge holds the KV of its own tokens only, so prompts that
+    start the same way (system message, jailbreak preamble, a common
+    template head) store and prefill that part once. Unpinned leaves are
+    evicted least recently used first once max_tokens is exceeded.
+    """
+
+    def __init__(self, max_tokens: int, device: str) -> None:
+        self.max_tokens = max_tokens
+        self.device = device
+
+        self._root = _RadixNode([], None, None)
+        self._tokens: int = 0
+        self._clock: int = 0
+        self._pinned_ids: List[int] = []
+        self._lock = threading.Lock()
+
+        self.lookups: int = 0
+        self.hits: int = 0
+        self.evictions: int = 0
+        self.prefill_tokens_saved: int = 0
+
+    def match(self, input_ids: List[int]) -> Tuple[Optional[KVState], int]:
+        # At least one prompt token has to go through the model to get logits
+        # for the first new token.
+        wanted = input_ids[: len(input_ids) - 1]
+
+        with self._lock:
+            self.lookups += 1
+            self._clock += 1
+
+            states: List[KVState] = []
+            matched = 0
+            node = self._root
+            while matched < len(wanted):
+                child = node.children.get(wanted[matched])
+                if child is None:
+                    break
+
+                child.last_access = self._clock
+                length = common_prefix_length(child.token_ids, wanted[matched:])
+                states.append(slice_state(child.state, 0, length))
+                matched += length
+                if length < len(child.token_ids):
+                    break
+                node = child
+
+            if matched == 0:
+                return None, 0
+
+            self.hits += 1
+            self.prefill_tokens_saved += matched
+
+        return state_to(concat_states(states), self.device), matched
+
+    def insert(self, token_ids: List[int], state: KVState) -> None:
+        with self._lock:
+            self._insert(token_ids, state)
+            self._evict()
+
+    def pin(self, token_ids: List[int], state: KVState) -> None:
+        # Only one prefix is pinned at a time: the one every prompt currently
+        # starts with. Whatever was pinned before becomes evictable.
+        with self._lock:
+            self._set_pinned(self._pinned_ids, False)
+            self._insert(token_ids, state)
+            self._pinned_ids = token_ids
+            self._set_pinned(token_ids, True)
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._root = _RadixNode([], None, None)
+            self._tokens = 0
+            self._pinned_ids = []
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "cached_tokens": self._tokens,
+                "pinned_tokens": len(self._pinned_ids),
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "evictions": self.evictions,
+                "prefill_tokens_saved": self.prefill_tokens_saved,
+            }
+
+    def _insert(self, token_ids: List[int], state: KVState) -> None:
+        self._clock += 1
+        node = self._root
+        position = 0
+        while position < len(token_ids):
+            child = node.children.get(token_ids[position])
+            if child is None:
+                # Clone so the node does not keep the caller's whole tensor
+                # alive through a view.
+                leaf_state = [
+                    (keys.clone(), values.clone())
+                    for keys, values in state_to(
+                        slice_state(state, position, len(token_ids)), self.device
+                    )
+                ]
+                leaf = _RadixNode(token_ids[position:], leaf_state, node)
+                leaf.last_access = self._clock
+                node.children[token_ids[position]] = leaf
+                self._tokens += len(leaf.token_ids)
+                return
+
+            length = common_prefix_length(child.token_ids, token_ids[position:])
+            if length < len(child.token_ids):
+                child = self._split(child, length)
+
+            child.last_access = self._clock
+            position += length
+            node = child
+
+    def _split(self, node: _RadixNode, length: int) -> _RadixNode:
+        head = _RadixNode(
+            node.token_ids[:length],
+            [(k.clone(), v.clone()) for k, v in slice_state(node.state, 0, length)],
+            node.parent,
+        )
+        head.last_access = node.last_access
+        head.pinned = node.pinned
+        head.parent.children[head.token_ids[0]] = head
+
+        node.token_ids = node.token_ids[length:]
+        node.state = [
+            (k.clone(), v.clone())
+            for k, v in slice_state(node.state, length, length + len(node.token_ids))
+        ]
+        node.parent = head
+        head.children[node.token_ids[0]] = node
+        return head
+
+    def _set_pinned(self, token_ids: List[int], pinned: bool) -> None:
+        node = self._root
+        position = 0
+        while position < len(token_ids):
+            child = node.children.get(token_ids[position])
+            if child is None:
+                return
+            child.pinned = pinned
+            position += len(child.token_ids)
+            node = child
+
+    def _evict(self) -> None:
+        while self._tokens > self.max_tokens:
+            leaves = [
+                node
+                for node in self._iter_nodes()
+                if not node.children and not node.pinned
+            ]
+            if not leaves:
+                return
+
+            leaf = min(leaves, key=lambda node: node.last_access)
+            del leaf.parent.children[leaf.token_ids[0]]
+            self._tokens -= len(leaf.token_ids)
+            self.evictions += 1
+
+    def _iter_nodes(self) -> List[_RadixNode]:
+        nodes: List[_RadixNode] = []
+        stack = list(self._root.children.values())
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(node.children.values())
+        return nodes
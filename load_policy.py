@@ -0,0 +1,198 @@
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional, Tuple
+
+# Latencies of requests that finished in the last this many intervals count
+WINDOW_INTERVALS = 3
+# Fewer finished requests than this say nothing about the p95
+MIN_SAMPLES = 5
+# Limits come back once the p95 is this far under the target, queue empty
+RELAX_BELOW = 0.7
+# Share of the way between minimum and configured limit lost per overloaded
+# interval, and regained per relaxed one: cut fast, restore slowly
+LEVEL_DOWN = 0.25
+LEVEL_UP = 0.1
+# A bigger batch has to raise tokens/sec by this much to be kept
+BATCH_GAIN = 1.05
+
+
+@dataclass(frozen=True)
+class Limits:
+    max_new_tokens: int
+    # Longest prompt, history included
+    prompt_tokens: int
+    batch_size: int
+
+
+class LoadPolicy:
+    """
+    Adapts a Chatbot's limits to its load. Every interval it looks at the
+    p95 latency of the requests that finished lately, the queue depth and
+    the tokens generated per second. While the p95 is over the target, or a
+    whole batch is waiting, max_new_tokens and the prompt budget move a step
+    towards their minimums, and the batch grows as long as that raises the
+    tokens per second. Once the p95 is comfortably under the target with
+    nothing waiting, they move back towards the configured limits, which
+    stay the upper bounds (/max_tokens still sets them). Every adjustment is
+    printed.
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        min_new_tokens: int,
+        min_prompt_tokens: int,
+        max_batch_size: int,
+    ) -> None:
+        self.interval = interval
+        self.min_new_tokens = min_new_tokens
+        self.min_prompt_tokens = min_prompt_tokens
+        # 0 for the configured batch size
+        self.max_batch_size = max_batch_size
+
+        # 1 is the configured limits, 0 the minimums
+        self.level: float = 1.0
+        # The adapted batch size, 0 until the first update
+        self.batch_size: int = 0
+        # Batch size and tokens/sec before the batch last grew, and intervals
+        # left until the window only holds requests of the bigger batch
+        self._grown_from: Optional[Tuple[int, float, int]] = None
+        # Largest batch that raised tokens/sec, until the load eases
+        self._batch_ceiling: int = 0
+
+        # (finished at, latency, tokens) of recently finished requests
+        self._samples: Deque[Tuple[float, float, int]] = deque()
+        self._updated_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+        self.adjustments: int = 0
+        self.observed: Dict[str, float] = {}
+        self.limits: Optional[Limits] = None
+
+    def observe(self, finished_at: float, latency: float, tokens: int) -> None:
+        with self._lock:
+            self._samples.append((finished_at, latency, tokens))
+
+    def update(
+        self, now: float, target_p95: float, queue_depth: int, configured: Limits
+    ) -> Limits:
+        # The limits for a request submitted now; adjusts them at most once
+        # per interval
+        with self._lock:
+            if target_p95 <= 0:
+                self.level = 1.0
+                self.batch_size = 0
+                self._grown_from = None
+                self.limits = configured
+                return configured
+
+            if not self.batch_size:
+                self.batch_size = configured.batch_size
+            if self._updated_at is None:
+                self._updated_at = now
+            elif now - self._updated_at >= self.interval:
+                self._updated_at = now
+                self._adjust(now, target_p95, queue_depth, configured)
+
+            limits = self._limits(configured)
+            if self.limits is not None and limits != self.limits:
+                self._report(self.limits, limits)
+            self.limits = limits
+            return limits
+
+    def format(self, target_p95: float) -> str:
+        with self._lock:
+            if target_p95 <= 0 or self.limits is None:
+                return "Load policy off, limits are fixed"
+            limits = self.limits
+            lines: List[str] = [
+                f"Target p95: {target_p95:g}s, level {self.level:.2f}, "
+                f"{self.adjustments} adjustments",
+                f"max_new_tokens: {limits.max_new_tokens}",
+                f"prompt_tokens: {limits.prompt_tokens}",
+                f"batch_size: {limits.batch_size}",
+            ]
+            if self.observed:
+                lines.append(self._format_observed())
+            return "\n".join(lines)
+
+    def _adjust(
+        self, now: float, target_p95: float, queue_depth: int, configured: Limits
+    ) -> None:
+        window = self.interval * WINDOW_INTERVALS
+        while self._samples and self._samples[0][0] < now - window:
+            self._samples.popleft()
+        latencies = sorted(latency for _, latency, _ in self._samples)
+        p95: Optional[float] = None
+        if len(latencies) >= MIN_SAMPLES:
+            p95 = latencies[min(int(0.95 * len(latencies)), len(latencies) - 1)]
+        tokens_per_second = sum(tokens for _, _, tokens in self._samples) / window
+        self.observed = {
+            "queue_depth": queue_depth,
+            "tokens_per_second": tokens_per_second,
+        }
+        if p95 is not None:
+            self.observed["p95"] = p95
+
+        batch_size = self._limits(configured).batch_size
+        overloaded = (p95 is not None and p95 > target_p95) or queue_depth >= batch_size
+        relaxed = (p95 is None or p95 < target_p95 * RELAX_BELOW) and not queue_depth
+
+        if overloaded:
+            self.level = max(0.0, self.level - LEVEL_DOWN)
+            if queue_depth:
+                self._grow_batch(tokens_per_second, configured.batch_size)
+        elif relaxed:
+            self.level = min(1.0, self.level + LEVEL_UP)
+            # Back to the configured batch, growing again takes new pressure
+            self.batch_size = configured.batch_size
+            self._grown_from = None
+            self._batch_ceiling = 0
+
+    def _grow_batch(self, tokens_per_second: float, configured: int) -> None:
+        largest = max(configured, self.max_batch_size)
+        if self._grown_from is not None:
+            previous_size, previous_rate, intervals = self._grown_from
+            if intervals > 1:
+                self._grown_from = (previous_size, previous_rate, intervals - 1)
+                return
+            self._grown_from = None
+            if tokens_per_second < previous_rate * BATCH_GAIN:
+                # More rows didn't buy throughput, only slower steps
+                self.batch_size = previous_size
+                self._batch_ceiling = previous_size
+                return
+        ceiling = self._batch_ceiling or largest
+        if self.batch_size < ceiling:
+            self._grown_from = (self.batch_size, tokens_per_second, WINDOW_INTERVALS)
+            self.batch_size = min(ceiling, self.batch_size + max(1, configured // 2))
+
+    def _limits(self, configured: Limits) -> Limits:
+        def between(minimum: int, maximum: int) -> int:
+            minimum = min(minimum, maximum)
+            return minimum + round(self.level * (maximum - minimum))
+
+        largest = max(configured.batch_size, self.max_batch_size)
+        return Limits(
+            max_new_tokens=between(self.min_new_tokens, configured.max_new_tokens),
+            prompt_tokens=between(self.min_prompt_tokens, configured.prompt_tokens),
+            batch_size=max(configured.batch_size, min(self.batch_size, largest)),
+        )
+
+    def _report(self, old: Limits, new: Limits) -> None:
+        self.adjustments += 1
+        changes = ", ".join(
+            f"{name} {getattr(old, name)} -> {getattr(new, name)}"
+            for name in ["max_new_tokens", "prompt_tokens", "batch_size"]
+            if getattr(old, name) != getattr(new, name)
+        )
+        print(f"Load policy: {changes} ({self._format_observed()})")
+
+    def _format_observed(self) -> str:
+        observed = self.observed
+        p95 = f"p95 {observed['p95']:.2f}s" if "p95" in observed else "p95 unknown"
+        return (
+            f"{p95}, {observed.get('queue_depth', 0):g} queued, "
+            f"{observed.get('tokens_per_second', 0):.0f} tokens/s"
+        )
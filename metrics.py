@@ -0,0 +1,297 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+TOKEN_BUCKETS: Tuple[float, ...] = (
+    16,
+    32,
+    64,
+    128,
+    256,
+    512,
+    1024,
+    2048,
+    4096,
+    8192,
+    16384,
+)
+RATE_BUCKETS: Tuple[float, ...] = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense."""
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...]) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # One more than buckets: the +Inf bucket
+        self._counts: List[int] = [0] * (len(buckets) + 1)
+        self._sum: float = 0.0
+        self._count: int = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            return list(self._counts), self._sum, self._count
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket the quantile falls in, which is as precise
+        # as a histogram gets
+        counts, _, count = self.snapshot()
+        if count == 0:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> List[str]:
+        counts, total, count = self.snapshot()
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f"{self.name}_sum {total:g}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self.value: float = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.value:g}",
+        ]
+
+
+class Gauge:
+    """A value that is set, or computed by a function when it is read."""
+
+    def __init__(
+        self, name: str, help: str, function: Optional[Callable[[], float]] = None
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.function = function
+        self._value: float = 0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> float:
+        if self.function is not None:
+            return self.function()
+        return self._value
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value -= amount
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.value:g}",
+        ]
+
+
+class Metrics:
+    """
+    Every metric the chatbot records. Requests are observed once, when they
+    finish, and decode steps once per batch, so nothing is done per streamed
+    token. Gauges backed by a function are only computed when scraped.
+    """
+
+    def __init__(self, prefix: str = "chatbot") -> None:
+        self.prefix = prefix
+        self._metrics: Dict[str, Histogram | Counter | Gauge] = {}
+
+        self.time_to_first_token = self._histogram(
+            "time_to_first_token_seconds",
+            "Time from submission to the first generated token",
+            LATENCY_BUCKETS,
+        )
+        self.generation_time = self._histogram(
+            "generation_seconds",
+            "Time from submission until generation finished",
+            LATENCY_BUCKETS,
+        )
+        self.queue_time = self._histogram(
+            "queue_seconds",
+            "Time a request waited before it was admitted into the batch",
+            LATENCY_BUCKETS,
+        )
+        self.prefill_time = self._histogram(
+            "prefill_seconds",
+            "Time spent prefilling a batch of admitted prompts",
+            LATENCY_BUCKETS,
+        )
+        self.decode_step_time = self._histogram(
+            "decode_step_seconds",
+            "Time spent on one decode step of the running batch",
+            LATENCY_BUCKETS,
+        )
+        self.prompt_build_time = self._histogram(
+            "prompt_build_seconds",
+            "Time spent rendering and tokenizing a prompt",
+            LATENCY_BUCKETS,
+        )
+        self.prompt_tokens = self._histogram(
+            "prompt_tokens", "Prompt length in tokens", TOKEN_BUCKETS
+        )
+        self.output_tokens = self._histogram(
+            "output_tokens", "Generated tokens per request", TOKEN_BUCKETS
+        )
+        self.tokens_per_second = self._histogram(
+            "tokens_per_second",
+            "Decode speed of a request after its first token",
+            RATE_BUCKETS,
+        )
+        self.telegram_send_time = self._histogram(
+            "telegram_send_seconds",
+            "Time spent sending one message to Telegram",
+            LATENCY_BUCKETS,
+        )
+        self.telegram_queue_time = self._histogram(
+            "telegram_queue_seconds",
+            "Time a Telegram message waited for its chat's turn at the model",
+            LATENCY_BUCKETS,
+        )
+        self.telegram_response_time = self._histogram(
+            "telegram_response_seconds",
+            "Time from receiving a Telegram message to the reply being sent",
+            LATENCY_BUCKETS,
+        )
+
+        self.requests = self._counter("requests_total", "Finished requests")
+        self.request_errors = self._counter(
+            "request_errors_total", "Requests that failed"
+        )
+        self.generated_tokens = self._counter(
+            "generated_tokens_total", "Tokens generated across all requests"
+        )
+
+        self.in_flight = self._gauge(
+            "requests_in_flight", "Requests submitted but not finished"
+        )
+
+    def gauge(self, name: str, help: str, function: Callable[[], float]) -> Gauge:
+        return self._gauge(name, help, function)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        result: Dict[str, Dict[str, float]] = {}
+        for name, metric in self._metrics.items():
+            if isinstance(metric, Histogram):
+                _, total, count = metric.snapshot()
+                result[name] = {
+                    "count": count,
+                    "mean": total / count if count else 0.0,
+                    "p50": metric.quantile(0.5),
+                    "p95": metric.quantile(0.95),
+                }
+            else:
+                result[name] = {"value": metric.value}
+        return result
+
+    def format(self, prefixes: Tuple[str, ...] = ("",)) -> str:
+        # One line per metric whose name starts with one of prefixes, for /stats
+        lines: List[str] = []
+        for name, values in self.summary().items():
+            if not name.startswith(prefixes):
+                continue
+            if "value" in values:
+                lines.append(f"{name}: {values['value']:g}")
+            else:
+                lines.append(
+                    f"{name}: n={values['count']} mean={values['mean']:.3g} "
+                    f"p50<={values['p50']:g} p95<={values['p95']:g}"
+                )
+        return "\n".join(lines)
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def _histogram(self, name: str, help: str, buckets: Tuple[float, ...]) -> Histogram:
+        return self._register(name, Histogram(f"{self.prefix}_{name}", help, buckets))
+
+    def _counter(self, name: str, help: str) -> Counter:
+        return self._register(name, Counter(f"{self.prefix}_{name}", help))
+
+    def _gauge(
+        self, name: str, help: str, function: Optional[Callable[[], float]] = None
+    ) -> Gauge:
+        return self._register(name, Gauge(f"{self.prefix}_{name}", help, function))
+
+    def _register(self, name: str, metric: Any) -> Any:
+        self._metrics[name] = metric
+        return metric
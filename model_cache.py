@@ -0,0 +1,52 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Any, Dict
+
+import peft
+import torch
+import transformers
+
+# Written last, so a directory without it is a save that didn't finish
+CACHE_KEY_FILE = "cache_key.json"
+
+
+def model_cache_path(cache_dir: str, key: Dict[str, Any]) -> str:
+    # Library versions are part of the key: quantized weights in particular
+    # are only guaranteed to load with what wrote them.
+    key = {
+        **key,
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "peft": peft.__version__,
+    }
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    return os.path.join(cache_dir, digest[:16])
+
+
+def is_cached(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, CACHE_KEY_FILE))
+
+
+def save_prepared_model(
+    path: str, model: Any, tokenizer: Any, key: Dict[str, Any]
+) -> None:
+    # Saved next to the final location and renamed into place, so a crash
+    # halfway never leaves something that looks like a usable cache entry
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=parent, prefix=".staging-")
+    try:
+        model.save_pretrained(staging, safe_serialization=True)
+        tokenizer.save_pretrained(staging)
+        with open(os.path.join(staging, CACHE_KEY_FILE), "w") as f:
+            json.dump(key, f, indent=2, sort_keys=True)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(staging, path)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
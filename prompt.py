@@ -0,0 +1,121 @@
+import re
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+# Rendered through the chat template to check that piecewise tokenization
+# gives the same ids as tokenizing the whole prompt
+_PROBE_MESSAGES: List[Dict[str, str]] = [
+    {"role": "user", "content": "Hello there!\n How are you doing?"},
+    {"role": "assistant", "content": " I'm fine, thanks.\n\nAnd you?"},
+    {"role": "user", "content": "Tell me a joke  about tokenizers."},
+]
+
+
+class PromptTokenizer:
+    """
+    Tokenizes rendered chat prompts without re-tokenizing the parts that were
+    already seen. Tokenizers split their input on added/special tokens before
+    anything else, so a prompt is just the concatenation of the ids of the
+    text pieces between those tokens. Pieces are cached, which makes every
+    earlier message in a conversation a cache hit on the next turn.
+
+    If a probe prompt does not round-trip to the same ids as tokenizing it in
+    one go (e.g. special tokens that strip surrounding whitespace), it falls
+    back to plain tokenization.
+    """
+
+    def __init__(self, tokenizer: Any, max_pieces: int = 8192) -> None:
+        self.tokenizer = tokenizer
+        self.max_pieces = max_pieces
+
+        self._pieces: "OrderedDict[Tuple[bool, str], List[int]]" = OrderedDict()
+        self._special_ids: Dict[str, int] = {
+            token.content: token_id
+            for token_id, token in tokenizer.added_tokens_decoder.items()
+        }
+
+        self._split: Optional[re.Pattern] = None
+        if self._special_ids:
+            self._split = re.compile(
+                "("
+                + "|".join(
+                    re.escape(content)
+                    for content in sorted(self._special_ids, key=len, reverse=True)
+                )
+                + ")"
+            )
+
+        # Text that is not at the very start of the prompt is tokenized behind
+        # a special token, so tokenizers that only add a prefix space to the
+        # first word treat it the way they would in the full prompt.
+        self._sentinel: str = tokenizer.eos_token or next(iter(self._special_ids), "")
+        self._sentinel_length: int = len(
+            tokenizer(self._sentinel, add_special_tokens=False)["input_ids"]
+        )
+
+        self._prefix_ids, self._suffix_ids = self._special_token_wrapping()
+
+        self.enabled: bool = self._split is not None and self._verify()
+
+    def encode(self, text: str) -> List[int]:
+        if not self.enabled:
+            return self.tokenizer(text)["input_ids"]
+        return self._encode(text)
+
+    def _encode(self, text: str) -> List[int]:
+        input_ids: List[int] = list(self._prefix_ids)
+        at_start = True
+        for piece in self._split.split(text):
+            if not piece:
+                continue
+
+            special_id = self._special_ids.get(piece)
+            if special_id is not None:
+                input_ids.append(special_id)
+            else:
+                input_ids.extend(self._encode_piece(piece, at_start))
+            at_start = False
+        input_ids.extend(self._suffix_ids)
+
+        return input_ids
+
+    def _encode_piece(self, piece: str, at_start: bool) -> List[int]:
+        key = (at_start, piece)
+        cached = self._pieces.get(key)
+        if cached is not None:
+            self._pieces.move_to_end(key)
+            return cached
+
+        if at_start:
+            ids = self.tokenizer(piece, add_special_tokens=False)["input_ids"]
+        else:
+            ids = self.tokenizer(self._sentinel + piece, add_special_tokens=False)[
+                "input_ids"
+            ][self._sentinel_length :]
+
+        self._pieces[key] = ids
+        if len(self._pieces) > self.max_pieces:
+            self._pieces.popitem(last=False)
+
+        return ids
+
+    def _special_token_wrapping(self) -> Tuple[List[int], List[int]]:
+        # Whatever tokenizer(text) adds around the text (BOS, EOS, ...)
+        wrapped: List[int] = self.tokenizer("a")["input_ids"]
+        bare: List[int] = self.tokenizer("a", add_special_tokens=False)["input_ids"]
+        for start in range(len(wrapped) - len(bare) + 1):
+            if wrapped[start : start + len(bare)] == bare:
+                return wrapped[:start], wrapped[start + len(bare) :]
+        return [], []
+
+    def _verify(self) -> bool:
+        try:
+            probe: str = self.tokenizer.apply_chat_template(
+                _PROBE_MESSAGES, tokenize=False, add_generation_prompt=False
+            )
+        except Exception:
+            return False
+
+        matches = self._encode(probe) == self.tokenizer(probe)["input_ids"]
+        self._pieces.clear()
+        return matches
@@ -0,0 +1,218 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def response_cache_key(identity: Dict[str, Any], input_ids: List[int]) -> str:
+    # identity holds everything besides the prompt that decides the reply:
+    # model, adapters, sampling parameters
+    digest = hashlib.sha256(json.dumps(identity, sort_keys=True).encode())
+    digest.update(json.dumps(input_ids).encode())
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    Generated token ids by prompt and settings, so a repeated request is
+    answered without running the model. Recently used replies are kept in
+    memory (at most max_entries, least recently used dropped first); with a
+    path, every reply also goes to an SQLite database that outlives the
+    process and holds up to disk_max_entries. Entries expire ttl seconds
+    after they were stored, 0 keeps them forever. Disk writes are queued and
+    committed by a background thread every flush_interval seconds, so
+    storing a reply never waits for the disk.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: float = 0.0,
+        path: str = "",
+        disk_max_entries: int = 0,
+        flush_interval: float = 1.0,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.disk_max_entries = disk_max_entries
+        self.flush_interval = flush_interval
+
+        # key -> (expires_at, output_ids); expires_at 0 never expires
+        self._entries: "OrderedDict[str, Tuple[float, List[int]]]" = OrderedDict()
+        self._lock = threading.RLock()
+
+        self.hits: int = 0
+        self.disk_hits: int = 0
+        self.misses: int = 0
+        self.stores: int = 0
+
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pending: List[Tuple[str, List[int], float]] = []
+        # Taken out of _pending by the flush running now, until committed
+        self._flushing: List[Tuple[str, List[int], float]] = []
+        # Serializes use of the connection; _lock is never held waiting on
+        # it, so put() doesn't wait for a commit
+        self._db_lock = threading.Lock()
+        self._closed = threading.Event()
+        if path:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, output_ids TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, stored_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_stored_at "
+                "ON responses (stored_at)"
+            )
+            self._connection.commit()
+            threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def get(self, key: str) -> Optional[List[int]]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and _expired(entry[0], now):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return list(entry[1])
+
+            # A reply stored moments ago may still be waiting for the flush
+            loaded = self._load_pending(key, now)
+
+        if loaded is None:
+            loaded = self._load(key, now)
+
+        with self._lock:
+            if loaded is None:
+                self.misses += 1
+                return None
+
+            # Expires when it would have on disk, a hit doesn't renew it
+            output_ids, expires_at = loaded
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, output_ids, now, expires_at)
+            return list(output_ids)
+
+    def put(self, key: str, output_ids: List[int]) -> None:
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl > 0 else 0.0
+        with self._lock:
+            self.stores += 1
+            self._remember(key, list(output_ids), now, expires_at)
+            if self._connection is not None:
+                self._pending.append((key, list(output_ids), expires_at))
+
+    def flush(self) -> None:
+        with self._db_lock:
+            with self._lock:
+                if self._connection is None or not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, []
+            try:
+                self._write(self._flushing)
+            finally:
+                with self._lock:
+                    self._flushing = []
+
+    def close(self) -> None:
+        self._closed.set()
+        self.flush()
+        with self._db_lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _remember(
+        self,
+        key: str,
+        output_ids: List[int],
+        now: float,
+        expires_at: Optional[float] = None,
+    ) -> None:
+        if expires_at is None:
+            expires_at = now + self.ttl if self.ttl > 0 else 0.0
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (expires_at, output_ids)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _write(self, entries: List[Tuple[str, List[int], float]]) -> None:
+        # Called holding _db_lock only
+        now = time.time()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                [
+                    (key, json.dumps(output_ids), expires_at, now)
+                    for key, output_ids, expires_at in entries
+                ],
+            )
+            self._connection.execute(
+                "DELETE FROM responses WHERE expires_at > 0 AND expires_at < ?",
+                (now,),
+            )
+            if self.disk_max_entries > 0:
+                # Oldest first, like the memory tier minus the recency
+                self._connection.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM "
+                    "responses ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+                    (self.disk_max_entries,),
+                )
+
+    def _load_pending(
+        self, key: str, now: float
+    ) -> Optional[Tuple[List[int], float]]:
+        # Called holding _lock; newest first, the flush in progress last
+        for pending_key, output_ids, expires_at in reversed(
+            self._flushing + self._pending
+        ):
+            if pending_key == key:
+                if _expired(expires_at, now):
+                    return None
+                return output_ids, expires_at
+        return None
+
+    def _load(self, key: str, now: float) -> Optional[Tuple[List[int], float]]:
+        # (output_ids, expires_at) from the disk tier
+        with self._db_lock:
+            if self._connection is None:
+                return None
+            row = self._connection.execute(
+                "SELECT output_ids, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or _expired(row[1], now):
+            return None
+        return json.loads(row[0]), row[1]
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+
+def _expired(expires_at: float, now: float) -> bool:
+    return 0 < expires_at < now
@@ -0,0 +1,921 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+import torch
+from transformers import DynamicCache
+
+from cpu import pin_thread
+from kv_cache import (
+    KVState,
+    PrefixCache,
+    SessionKVCache,
+    cache_from_states,
+    concat_caches,
+    pad_cache_left,
+    pad_mask_left,
+    slice_state,
+    state_from_cache,
+    trim_leading_padding,
+)
+from metrics import Metrics
+
+# Why a request finished: end of sequence or a stop string, max_new_tokens,
+# cancel(), its timeout, or an exception
+FINISH_STOP = "stop"
+FINISH_LENGTH = "length"
+FINISH_CANCELLED = "cancelled"
+FINISH_TIMEOUT = "timeout"
+FINISH_ERROR = "error"
+
+
+@dataclass
+class SamplingParams:
+    max_new_tokens: int
+    temperature: float
+    top_p: float
+    top_k: int
+    repetition_penalty: float
+    do_sample: bool = True
+    # Generation ends as soon as the reply contains one of these; the streamer
+    # is expected to cut the text there
+    stop_strings: Tuple[str, ...] = ()
+
+
+@dataclass
+class GenerationRequest:
+    input_ids: List[int]
+    params: SamplingParams
+    # Anything with the transformers streamer interface: put(tensor) / end(),
+    # or None when nobody is listening
+    streamer: Any
+    # Requests sharing a session_id reuse each other's KV state through the
+    # session cache; None opts out.
+    session_id: Optional[Hashable] = None
+    # Pin this prompt's KV in the prefix cache as the prefix every prompt
+    # currently starts with
+    pin_prefix: bool = False
+    # Named LoRA adapter to generate with, "" for the model as loaded
+    adapter: str = ""
+    # Seconds after submission the request is cut short, 0 for never
+    timeout: float = 0.0
+    # Called on the scheduler thread once the request is done, failed or not;
+    # on the caller's for requests answered through complete()
+    callback: Optional[Callable[["GenerationRequest"], None]] = None
+    output_ids: List[int] = field(default_factory=list)
+    error: Optional[BaseException] = None
+    finish_reason: str = ""
+    cancelled: bool = False
+    submitted_at: float = 0.0
+    first_token_at: float = 0.0
+    finished_at: float = 0.0
+    done: threading.Event = field(default_factory=threading.Event)
+
+    def wait(self) -> List[int]:
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.output_ids
+
+    def cancel(self) -> None:
+        # Takes effect at the next token boundary, or before the prefill when
+        # the request is still queued; what was generated so far is kept
+        self.cancelled = True
+
+
+class _Sequence:
+    def __init__(self, request: GenerationRequest) -> None:
+        self.request = request
+        self.last_token: int = -1
+        self.adapter_acquired: bool = False
+        self.deadline: float = (
+            request.submitted_at + request.timeout if request.timeout > 0 else 0.0
+        )
+        # Tokens at the end of the reply a stop string can span: one per
+        # byte, and one more for a character the first of them completes
+        self.stop_window: int = max(
+            (len(stop.encode()) + 1 for stop in request.params.stop_strings),
+            default=0,
+        )
+
+
+class GenerationScheduler:
+    """
+    Runs every submitted request through one shared decode loop. Requests join
+    the running batch at token boundaries (their prompts are prefilled as a
+    left-padded batch and the resulting KV cache is spliced into the running
+    one) and leave it as soon as they finish, so a long reply never holds a
+    short one hostage and the device always works on as many rows as it can.
+    """
+
+    def __init__(
+        self,
+        model: Any,
+        tokenizer: Any,
+        device: str,
+        max_batch_size: int,
+        session_cache: Optional[SessionKVCache] = None,
+        prefix_cache: Optional[PrefixCache] = None,
+        metrics: Optional[Metrics] = None,
+        proposer: Any = None,
+        num_speculative_tokens: int = 4,
+        compiled_decoder: Any = None,
+        adapters: Any = None,
+        on_finish: Optional[Callable[[GenerationRequest], None]] = None,
+        cores: Optional[List[int]] = None,
+    ) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max(1, max_batch_size)
+        self.session_cache = session_cache
+        self.prefix_cache = prefix_cache
+        self.metrics = metrics
+        # PromptLookupProposer / DraftModelProposer, or None to decode one
+        # token per step
+        self.proposer = proposer
+        self.num_speculative_tokens = num_speculative_tokens
+        # CompiledDecoder for plain decode steps whose shape it has a bucket
+        # for; prefill, verification and anything larger run eagerly
+        self.compiled_decoder = compiled_decoder
+        # LoRAAdapters when requests may name an adapter; every forward pass
+        # then tells the model which one each row uses
+        self.adapters = adapters
+        # Told about every request that leaves the batch, like the metrics
+        self.on_finish = on_finish
+        # CPU cores the decode loop is pinned to, None for wherever it starts
+        self.cores = cores
+
+        # Counted per row: one row verified once is one step
+        self.speculative_steps: int = 0
+        self.proposed_tokens: int = 0
+        self.accepted_tokens: int = 0
+
+        eos_token_ids: Set[int] = set()
+        for eos in (
+            getattr(model.generation_config, "eos_token_id", None),
+            tokenizer.eos_token_id,
+        ):
+            if eos is None:
+                continue
+            eos_token_ids.update(eos if isinstance(eos, list) else [eos])
+        self.eos_token_ids: Set[int] = eos_token_ids
+
+        self._pending: "queue.Queue[GenerationRequest]" = queue.Queue()
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+
+        self._active: List[_Sequence] = []
+        self._cache: Optional[DynamicCache] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        # Per-row bitmap of every token id seen so far, for repetition penalty
+        self._seen: Optional[torch.Tensor] = None
+
+        if metrics is not None:
+            metrics.gauge(
+                "queue_depth", "Requests waiting to join the batch", self.queue_depth
+            )
+            metrics.gauge(
+                "batch_size", "Rows in the running batch", lambda: len(self._active)
+            )
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        if self._closed.is_set():
+            raise RuntimeError("generation scheduler is closed")
+        self._ensure_started()
+        request.submitted_at = time.perf_counter()
+        if self.metrics is not None:
+            self.metrics.in_flight.inc()
+        self._pending.put(request)
+        self._wakeup.set()
+        return request
+
+    def queue_depth(self) -> int:
+        return self._pending.qsize()
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        # Cancels every request, running or queued, and waits for the decode
+        # loop to end, so nothing runs on the device or calls back afterwards
+        self._closed.set()
+        self._wakeup.set()
+        with self._thread_lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                return
+        # Submitted as the loop was ending
+        while True:
+            try:
+                request = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            request.finish_reason = FINISH_CANCELLED
+            self._finish(_Sequence(request))
+
+    def complete(self, request: GenerationRequest, output_ids: List[int]) -> None:
+        # Answers a request with a reply that needs no generating (the response
+        # cache has it): the streamer gets all of it at once, and the request
+        # stays out of the generation metrics so cached replies don't pass for
+        # impossibly fast decoding.
+        now = time.perf_counter()
+        request.submitted_at = request.first_token_at = request.finished_at = now
+        request.output_ids = list(output_ids)
+        request.finish_reason = (
+            FINISH_LENGTH
+            if len(output_ids) >= request.params.max_new_tokens
+            else FINISH_STOP
+        )
+        request.done.set()
+        if request.streamer is not None:
+            if output_ids:
+                request.streamer.put(torch.tensor(output_ids))
+            request.streamer.end()
+        if request.callback is not None:
+            try:
+                request.callback(request)
+            except Exception as e:
+                print(f"Warning: generation callback failed: {e}")
+
+    def speculation_stats(self) -> Dict[str, float]:
+        return {
+            "steps": self.speculative_steps,
+            "proposed_tokens": self.proposed_tokens,
+            "accepted_tokens": self.accepted_tokens,
+            "acceptance_rate": (
+                self.accepted_tokens / self.proposed_tokens
+                if self.proposed_tokens
+                else 0.0
+            ),
+            # Tokens each verification pass produced, i.e. the speedup over
+            # plain decoding before the cost of proposing
+            "tokens_per_step": (
+                (self.accepted_tokens + self.speculative_steps) / self.speculative_steps
+                if self.speculative_steps
+                else 0.0
+            ),
+        }
+
+    def _ensure_started(self) -> None:
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+
+    def _loop(self) -> None:
+        if self.cores:
+            # Before the first forward pass, so torch's worker threads are
+            # started, and pinned, from here
+            pin_thread(self.cores)
+        with torch.inference_mode():
+            while True:
+                if self._closed.is_set():
+                    # Cut at the next token boundary; queued ones are
+                    # cancelled as they are admitted
+                    for seq in self._active:
+                        seq.request.cancel()
+                if not self._active and self._pending.empty():
+                    if self._closed.is_set():
+                        return
+                    self._wakeup.wait()
+                    self._wakeup.clear()
+                    continue
+
+                try:
+                    self._admit()
+                    if self._active:
+                        self._step()
+                except Exception as e:
+                    self._fail_all(e)
+
+    def _admit(self) -> None:
+        joining: List[_Sequence] = []
+        while len(self._active) + len(joining) < self.max_batch_size:
+            try:
+                request = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            joining.append(_Sequence(request))
+
+        if not joining:
+            return
+
+        started = time.perf_counter()
+        if self.metrics is not None:
+            for seq in joining:
+                self.metrics.queue_time.observe(started - seq.request.submitted_at)
+
+        # Requests given up on while they waited never reach the device
+        for seq in joining:
+            reason = self._interruption(seq, started)
+            if reason:
+                seq.request.finish_reason = reason
+                self._finish(seq)
+        joining = [seq for seq in joining if not seq.request.finish_reason]
+        if not joining:
+            return
+
+        if self.adapters is not None:
+            joining = [seq for seq in joining if self._acquire_adapter(seq)]
+            if not joining:
+                return
+
+        try:
+            states: List[Optional[KVState]] = []
+            reused: List[int] = []
+            for seq in joining:
+                state, length = self._take_cached_state(seq.request)
+                states.append(state)
+                reused.append(length)
+
+            batch = self.tokenizer.pad(
+                {
+                    "input_ids": [
+                        seq.request.input_ids[length:]
+                        for seq, length in zip(joining, reused)
+                    ]
+                },
+                padding=True,
+                return_tensors="pt",
+            )
+            input_ids = batch["input_ids"].to(self.device)
+            attention_mask = batch["attention_mask"].to(self.device)
+
+            cache = DynamicCache()
+            past_length = max(reused)
+            if past_length > 0:
+                # Rows resuming from a cached prefix carry it as left-padded
+                # past; rows without one get an all-padding past. The gap
+                # between a short past and its left-padded suffix is masked
+                # like any other padding.
+                template = next(state for state in states if state is not None)
+                cache = cache_from_states(
+                    [
+                        (
+                            state
+                            if state is not None
+                            else [(k[:, :, :0, :], v[:, :, :0, :]) for k, v in template]
+                        )
+                        for state in states
+                    ],
+                    self.device,
+                )
+                past_mask = torch.tensor(
+                    [[0] * (past_length - length) + [1] * length for length in reused],
+                    dtype=attention_mask.dtype,
+                    device=self.device,
+                )
+                attention_mask = torch.cat([past_mask, attention_mask], dim=-1)
+
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, past_length:]
+
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=cache,
+                use_cache=True,
+                logits_to_keep=1,
+                **self._adapter_kwargs(joining),
+            )
+
+            seen = torch.zeros(
+                (len(joining), outputs.logits.shape[-1]),
+                dtype=torch.bool,
+                device=self.device,
+            )
+            for row, seq in enumerate(joining):
+                seen[row, torch.tensor(seq.request.input_ids, device=self.device)] = (
+                    True
+                )
+        except Exception as e:
+            for seq in joining:
+                self._finish(seq, e)
+            return
+
+        self._merge(joining, outputs.past_key_values, attention_mask, seen)
+        if self.proposer is not None:
+            self.proposer.admit([seq.request.input_ids for seq in joining])
+        self._emit(joining, outputs.logits[:, -1, :])
+
+        if self.metrics is not None:
+            # _emit waits for the sampled tokens, so this includes device time
+            self.metrics.prefill_time.observe(time.perf_counter() - started)
+
+    def _take_cached_state(
+        self, request: GenerationRequest
+    ) -> Tuple[Optional[KVState], int]:
+        state: Optional[KVState] = None
+        reused = 0
+        if self.session_cache is not None and request.session_id is not None:
+            state, reused = self.session_cache.take(
+                request.session_id, request.input_ids
+            )
+
+        # The prefix cache holds KV computed without any named adapter, which
+        # an adapter that touches attention would compute differently
+        if self.prefix_cache is not None and not request.adapter:
+            prefix_state, prefix_reused = self.prefix_cache.match(request.input_ids)
+            if prefix_reused > reused:
+                state, reused = prefix_state, prefix_reused
+
+        return state, reused
+
+    def _acquire_adapter(self, seq: _Sequence) -> bool:
+        try:
+            self.adapters.acquire(seq.request.adapter)
+        except Exception as e:
+            self._finish(seq, e)
+            return False
+        seq.adapter_acquired = True
+        return True
+
+    def _adapter_kwargs(self, sequences: List[_Sequence]) -> Dict[str, Any]:
+        if self.adapters is None:
+            return {}
+        return {
+            "adapter_names": self.adapters.adapter_names(
+                [seq.request.adapter for seq in sequences]
+            )
+        }
+
+    def _step(self) -> None:
+        started = time.perf_counter()
+
+        proposals: List[List[int]] = []
+        if self.proposer is not None:
+            proposals = self.proposer.propose(
+                [
+                    seq.request.input_ids + seq.request.output_ids
+                    for seq in self._active
+                ],
+                self.num_speculative_tokens,
+            )
+
+        if any(proposals):
+            self._verify(proposals)
+        else:
+            self._decode()
+
+        if self.metrics is not None:
+            self.metrics.decode_step_time.observe(time.perf_counter() - started)
+
+    def _decode(self) -> None:
+        input_ids = torch.tensor(
+            [[seq.last_token] for seq in self._active], device=self.device
+        )
+        self._attention_mask = torch.cat(
+            [
+                self._attention_mask,
+                self._attention_mask.new_ones((len(self._active), 1)),
+            ],
+            dim=-1,
+        )
+        position_ids = self._attention_mask.sum(-1, keepdim=True) - 1
+
+        if self.compiled_decoder is not None and self.compiled_decoder.fits(
+            *self._attention_mask.shape
+        ):
+            logits = self.compiled_decoder.decode(
+                self._cache, self._attention_mask, input_ids, position_ids
+            )
+        else:
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=self._attention_mask,
+                position_ids=position_ids,
+                past_key_values=self._cache,
+                use_cache=True,
+                **self._adapter_kwargs(self._active),
+            )
+            self._cache = outputs.past_key_values
+            logits = outputs.logits[:, -1, :]
+        self._emit(self._active, logits)
+
+    def _verify(self, proposals: List[List[int]]) -> None:
+        # Every row feeds its last token followed by its proposals through
+        # the model in one pass, then keeps the longest run of proposals the
+        # model agrees with plus one token of its own.
+        width = max(len(row) for row in proposals)
+        drafts = torch.tensor(
+            [
+                # Filler is fine: a proposal that turns out to be right is
+                # accepted no matter where it came from
+                row + [seq.last_token] * (width - len(row))
+                for seq, row in zip(self._active, proposals)
+            ],
+            device=self.device,
+        )
+        input_ids = torch.cat(
+            [
+                torch.tensor(
+                    [[seq.last_token] for seq in self._active], device=self.device
+                ),
+                drafts,
+            ],
+            dim=-1,
+        )
+        position_ids = self._attention_mask.sum(-1, keepdim=True) + torch.arange(
+            width + 1, device=self.device
+        )
+        self._attention_mask = torch.cat(
+            [
+                self._attention_mask,
+                self._attention_mask.new_ones((len(self._active), width + 1)),
+            ],
+            dim=-1,
+        )
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=self._attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._cache,
+            use_cache=True,
+            logits_to_keep=width + 1,
+            **self._adapter_kwargs(self._active),
+        )
+        self._cache = outputs.past_key_values
+
+        accepted, final_tokens = self._verify_sample(
+            outputs.logits, drafts, [seq.request.params for seq in self._active]
+        )
+        self._drop_rejected_columns(accepted, width + 1)
+
+        accepted_counts: List[int] = accepted.tolist()
+        self.speculative_steps += len(accepted_counts)
+        self.proposed_tokens += sum(len(row) for row in proposals)
+        self.accepted_tokens += sum(
+            min(n, len(row)) for n, row in zip(accepted_counts, proposals)
+        )
+        self.proposer.verified(accepted_counts)
+
+        drafts_list: List[List[int]] = drafts.tolist()
+        self._accept(
+            self._active,
+            [
+                row[:n] + [token]
+                for row, n, token in zip(
+                    drafts_list, accepted_counts, final_tokens.tolist()
+                )
+            ],
+        )
+
+    def _verify_sample(
+        self, logits: torch.Tensor, drafts: torch.Tensor, params: List[SamplingParams]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Speculative sampling with a deterministic proposal: proposal i is
+        # accepted with the probability the model gives it, and the first
+        # rejection is replaced by a sample from the model's distribution
+        # without the rejected token. The output is distributed exactly as if
+        # every token had been sampled one at a time.
+        rows, positions, vocab_size = logits.shape
+        width = positions - 1
+
+        # What the repetition penalty has seen at each position includes the
+        # proposals before it
+        seen = self._seen.unsqueeze(1).repeat(1, positions, 1)
+        for i in range(width):
+            seen[:, i + 1 :, :].scatter_(
+                -1, drafts[:, i].view(rows, 1, 1).expand(rows, width - i, 1), True
+            )
+
+        penalized, filtered, greedy = self._process_logits(
+            logits.reshape(rows * positions, vocab_size),
+            [p for p in params for _ in range(positions)],
+            seen.reshape(rows * positions, vocab_size),
+        )
+        greedy = greedy.view(rows, positions)[:, 0]
+        choices = penalized.argmax(dim=-1).view(rows, positions)
+        probs = filtered.softmax(dim=-1).view(rows, positions, vocab_size)
+
+        draft_probs = probs[:, :width].gather(-1, drafts.unsqueeze(-1)).squeeze(-1)
+        accept = torch.where(
+            greedy.unsqueeze(-1),
+            drafts == choices[:, :width],
+            torch.rand(draft_probs.shape, device=probs.device) < draft_probs,
+        )
+        accepted = accept.int().cumprod(dim=-1).sum(dim=-1)
+
+        row_index = torch.arange(rows, device=probs.device)
+        residual = probs[row_index, accepted]
+        rejected_token = drafts[row_index, accepted.clamp(max=width - 1)]
+        residual[row_index, rejected_token] *= (accepted >= width).to(residual.dtype)
+        residual = torch.where(
+            residual.sum(-1, keepdim=True) > 0, residual, probs[row_index, accepted]
+        )
+        sampled = torch.multinomial(residual, num_samples=1).squeeze(-1)
+
+        return accepted, torch.where(greedy, choices[row_index, accepted], sampled)
+
+    def _drop_rejected_columns(self, accepted: torch.Tensor, block: int) -> None:
+        # Of the block of columns just computed, each row keeps its last
+        # token and its accepted proposals, which are a prefix of the block.
+        # Those are shifted right so the block ends up no wider than the
+        # longest row needs; the gap is masked like any other padding.
+        kept = accepted + 1
+        width = int(kept.max())
+        if width == block and bool((kept == block).all()):
+            return
+
+        start = self._attention_mask.shape[-1] - block
+        source = torch.arange(width, device=self.device).unsqueeze(0) - (
+            width - kept
+        ).unsqueeze(-1)
+        valid = source >= 0
+        source = source.clamp(min=0) + start
+
+        for layer in self._cache.layers:
+            index = source[:, None, :, None].expand(
+                -1, layer.keys.shape[1], -1, layer.keys.shape[-1]
+            )
+            layer.keys = torch.cat(
+                [layer.keys[:, :, :start], layer.keys.gather(2, index)], dim=2
+            )
+            layer.values = torch.cat(
+                [layer.values[:, :, :start], layer.values.gather(2, index)], dim=2
+            )
+        self._attention_mask = torch.cat(
+            [self._attention_mask[:, :start], valid.to(self._attention_mask.dtype)],
+            dim=-1,
+        )
+
+    def _emit(self, sequences: List[_Sequence], logits: torch.Tensor) -> None:
+        # `sequences` is always the tail of the running batch: either all of
+        # it (a decode step) or the rows that were just merged in (a prefill).
+        offset = len(self._active) - len(sequences)
+        row_index = torch.arange(offset, len(self._active), device=self.device)
+        next_tokens = self._sample(
+            logits, [seq.request.params for seq in sequences], row_index
+        )
+        self._accept(sequences, [[token] for token in next_tokens.tolist()])
+
+    def _accept(self, sequences: List[_Sequence], tokens: List[List[int]]) -> None:
+        # `sequences` is the tail of the running batch, as in _emit
+        offset = len(self._active) - len(sequences)
+        now = time.perf_counter()
+        finished: List[int] = []
+        for r, (seq, new_tokens) in enumerate(zip(sequences, tokens)):
+            request = seq.request
+            # Checked once per step, between forward passes, so a row given up
+            # on stops taking up the batch right away
+            request.finish_reason = self._interruption(seq, now)
+            if request.finish_reason:
+                finished.append(offset + r)
+                continue
+
+            if not request.output_ids:
+                request.first_token_at = now
+
+            emitted: List[int] = []
+            for token in new_tokens:
+                if token in self.eos_token_ids:
+                    request.finish_reason = FINISH_STOP
+                    break
+                emitted.append(token)
+                if len(request.output_ids) + len(emitted) >= (
+                    request.params.max_new_tokens
+                ):
+                    request.finish_reason = FINISH_LENGTH
+                    break
+
+            if emitted:
+                request.output_ids.extend(emitted)
+                seq.last_token = emitted[-1]
+                self._seen[offset + r, emitted] = True
+                if request.streamer is not None:
+                    request.streamer.put(torch.tensor(emitted))
+                if seq.stop_window and self._hit_stop_string(seq, len(emitted)):
+                    request.finish_reason = FINISH_STOP
+
+            if request.finish_reason:
+                finished.append(offset + r)
+
+        if finished:
+            self._evict(finished)
+
+    def _interruption(self, seq: _Sequence, now: float) -> str:
+        if seq.request.cancelled or self._closed.is_set():
+            return FINISH_CANCELLED
+        if seq.deadline and now >= seq.deadline:
+            return FINISH_TIMEOUT
+        return ""
+
+    def _hit_stop_string(self, seq: _Sequence, new_tokens: int) -> bool:
+        # Only the tail that could hold a stop string the new tokens completed
+        # is decoded, not the whole reply
+        request = seq.request
+        tail = self.tokenizer.decode(
+            request.output_ids[-(seq.stop_window + new_tokens) :],
+            skip_special_tokens=True,
+        )
+        return any(stop in tail for stop in request.params.stop_strings)
+
+    def _sample(
+        self,
+        logits: torch.Tensor,
+        params: List[SamplingParams],
+        rows: torch.Tensor,
+    ) -> torch.Tensor:
+        penalized, filtered, greedy = self._process_logits(
+            logits, params, self._seen[rows]
+        )
+        sampled = torch.multinomial(filtered.softmax(dim=-1), num_samples=1)
+        return torch.where(greedy, penalized.argmax(dim=-1), sampled.squeeze(-1))
+
+    def _process_logits(
+        self,
+        logits: torch.Tensor,
+        params: List[SamplingParams],
+        seen: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        # Returns the repetition-penalized logits (for greedy rows), the
+        # scores to sample from after temperature, top-k and top-p (in vocab
+        # order, -inf where filtered out), and which rows are greedy.
+        logits = logits.float()
+        vocab_size = logits.shape[-1]
+
+        penalty = torch.tensor(
+            [p.repetition_penalty for p in params], device=logits.device
+        ).unsqueeze(-1)
+        penalized = torch.where(logits < 0, logits * penalty, logits / penalty)
+        logits = torch.where(seen, penalized, logits)
+
+        greedy = torch.tensor(
+            [not p.do_sample or p.temperature <= 0 for p in params],
+            device=logits.device,
+        )
+        temperature = torch.tensor(
+            [p.temperature if p.temperature > 0 else 1.0 for p in params],
+            device=logits.device,
+        ).unsqueeze(-1)
+        scores = logits / temperature
+
+        sorted_scores, sorted_indices = scores.sort(dim=-1, descending=True)
+
+        top_k = torch.tensor(
+            [p.top_k if 0 < p.top_k < vocab_size else vocab_size for p in params],
+            device=logits.device,
+        )
+        positions = torch.arange(vocab_size, device=logits.device).unsqueeze(0)
+        sorted_scores = sorted_scores.masked_fill(
+            positions >= top_k.unsqueeze(-1), float("-inf")
+        )
+
+        top_p = torch.tensor([p.top_p for p in params], device=logits.device)
+        sorted_probs = sorted_scores.softmax(dim=-1)
+        # Drop a token once the mass *before* it already covers top_p; the
+        # first token always survives.
+        outside_top_p = (sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p.unsqueeze(
+            -1
+        )
+        sorted_scores = sorted_scores.masked_fill(outside_top_p, float("-inf"))
+
+        filtered = torch.full_like(scores, float("-inf")).scatter(
+            -1, sorted_indices, sorted_scores
+        )
+
+        return logits, filtered, greedy
+
+    def _merge(
+        self,
+        joining: List[_Sequence],
+        cache: DynamicCache,
+        attention_mask: torch.Tensor,
+        seen: torch.Tensor,
+    ) -> None:
+        if not self._active:
+            self._active = joining
+            self._cache = cache
+            self._attention_mask = attention_mask
+            self._seen = seen
+            return
+
+        # Both sides are left-padded, so aligning them is a matter of
+        # prepending zero columns to whichever one is shorter.
+        length = max(self._attention_mask.shape[-1], attention_mask.shape[-1])
+        self._cache = concat_caches(
+            pad_cache_left(self._cache, length), pad_cache_left(cache, length)
+        )
+        self._attention_mask = torch.cat(
+            [
+                pad_mask_left(self._attention_mask, length),
+                pad_mask_left(attention_mask, length),
+            ]
+        )
+        self._seen = torch.cat([self._seen, seen])
+        self._active = self._active + joining
+
+    def _evict(self, rows: List[int]) -> None:
+        for row in rows:
+            self._store_cached_state(row)
+            self._finish(self._active[row])
+
+        leaving = set(rows)
+        keep = [r for r in range(len(self._active)) if r not in leaving]
+        self._active = [self._active[r] for r in keep]
+        if self.proposer is not None:
+            self.proposer.evict(keep)
+        if not self._active:
+            self._cache = None
+            self._attention_mask = None
+            self._seen = None
+            return
+
+        keep_index = torch.tensor(keep, device=self.device)
+        self._cache.batch_select_indices(keep_index)
+        self._attention_mask = self._attention_mask[keep_index]
+        self._seen = self._seen[keep_index]
+
+        # The row that just left may have been the longest one; drop the
+        # columns that are now padding for everybody.
+        self._attention_mask = trim_leading_padding(self._cache, self._attention_mask)
+
+    def _store_cached_state(self, row: int) -> None:
+        request = self._active[row].request
+        store_session = (
+            self.session_cache is not None and request.session_id is not None
+        )
+        store_prefix = self.prefix_cache is not None and not request.adapter
+        if not store_session and not store_prefix:
+            return
+
+        # Every column this row ever attended to, in order: its prompt and all
+        # generated tokens that have been fed back in (the last sampled one
+        # never is). Speculative decoding can also have fed proposals past
+        # where the reply stopped; those are cut off.
+        token_ids = request.input_ids + request.output_ids
+        columns = self._attention_mask[row].nonzero().squeeze(-1)[: len(token_ids)]
+        token_ids = token_ids[: len(columns)]
+        state = state_from_cache(self._cache, row, columns)
+
+        if store_session:
+            self.session_cache.store(request.session_id, token_ids, state)
+
+        if store_prefix:
+            # Only the prompt is shared; generated text is per-conversation
+            # and lives in the session cache.
+            prompt_state = slice_state(state, 0, len(request.input_ids))
+            if request.pin_prefix:
+                self.prefix_cache.pin(request.input_ids, prompt_state)
+            else:
+                self.prefix_cache.insert(request.input_ids, prompt_state)
+
+    def _finish(self, seq: _Sequence, error: Optional[BaseException] = None) -> None:
+        request = seq.request
+        request.error = error
+        if error is not None:
+            request.finish_reason = FINISH_ERROR
+        request.finished_at = time.perf_counter()
+        if seq.adapter_acquired:
+            self.adapters.release(request.adapter)
+            seq.adapter_acquired = False
+        # Set before ending the stream so a consumer that just drained it never
+        # blocks in wait()
+        request.done.set()
+        if request.streamer is not None:
+            request.streamer.end()
+        if self.metrics is not None:
+            self._record(request)
+        if self.on_finish is not None:
+            self.on_finish(request)
+        if request.callback is not None:
+            try:
+                request.callback(request)
+            except Exception as e:
+                print(f"Warning: generation callback failed: {e}")
+
+    def _record(self, request: GenerationRequest) -> None:
+        metrics = self.metrics
+        metrics.in_flight.dec()
+        metrics.requests.inc()
+        if request.error is not None:
+            metrics.request_errors.inc()
+            return
+
+        output_tokens = len(request.output_ids)
+        metrics.generated_tokens.inc(output_tokens)
+        metrics.prompt_tokens.observe(len(request.input_ids))
+        metrics.output_tokens.observe(output_tokens)
+        metrics.generation_time.observe(request.finished_at - request.submitted_at)
+        if request.first_token_at:
+            metrics.time_to_first_token.observe(
+                request.first_token_at - request.submitted_at
+            )
+            decode_time = request.finished_at - request.first_token_at
+            if output_tokens > 1 and decode_time > 0:
+                metrics.tokens_per_second.observe((output_tokens - 1) / decode_time)
+
+    def _fail_all(self, error: BaseException) -> None:
+        for seq in self._active:
+            self._finish(seq, error)
+        self._active = []
+        self._cache = None
+        self._attention_mask = None
+        self._seen = None
+        if self.proposer is not None:
+            self.proposer.reset()
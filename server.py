@@ -0,0 +1,445 @@
+from __future__ import annotations
+
+import json
+import select
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Any, Callable, Deque, Dict, List, Optional
+
+from batch import prepare_row
+from config import DEFAULT_SERVER_MAX_QUEUED_REQUESTS
+from scheduler import FINISH_CANCELLED, FINISH_TIMEOUT, GenerationRequest
+from streaming import TokenStream, cut_at_stop_string
+
+if TYPE_CHECKING:
+    from chat import Chatbot
+
+# Seconds an idle keep-alive connection is kept open
+KEEP_ALIVE_TIMEOUT = 60.0
+# How often a request waiting for a slot or its reply checks on its client
+DISCONNECT_POLL_INTERVAL = 0.25
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+# OpenAI request fields and the batch row params (batch.py) they set
+OPENAI_SAMPLING_PARAMS: Dict[str, str] = {
+    "max_tokens": "max_new_tokens",
+    "max_completion_tokens": "max_new_tokens",
+    "temperature": "temperature",
+    "top_p": "top_p",
+    # Not OpenAI's, but what the chatbot samples with
+    "top_k": "top_k",
+    "repetition_penalty": "repetition_penalty",
+}
+# Scheduler finish reasons OpenAI has no name for: a reply GENERATION_TIMEOUT
+# cut short ran out of budget like one that hit max_tokens, and one cancelled
+# by a shutdown just ended
+OPENAI_FINISH_REASONS: Dict[str, str] = {
+    FINISH_TIMEOUT: "length",
+    FINISH_CANCELLED: "stop",
+}
+
+
+class RequestLimiter:
+    """
+    Admission control for the HTTP server. At most max_concurrent requests
+    are handed to the scheduler at a time, up to max_queued more wait for a
+    slot in arrival order and anything beyond that is turned away, so a burst
+    can't pile unbounded work (and handler threads) up behind the model.
+    """
+
+    def __init__(self, max_concurrent: int, max_queued: int) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.running: int = 0
+        self.rejected: int = 0
+        self._waiting: Deque[threading.Event] = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    def acquire(self, gone: Callable[[], bool]) -> bool:
+        # False when the queue is full, or when gone() tells the caller left
+        # while it was waiting
+        with self._lock:
+            if self.running < self.max_concurrent and not self._waiting:
+                self.running += 1
+                return True
+            if len(self._waiting) >= self.max_queued:
+                self.rejected += 1
+                return False
+            turn = threading.Event()
+            self._waiting.append(turn)
+
+        while not turn.wait(DISCONNECT_POLL_INTERVAL):
+            if not gone():
+                continue
+            with self._lock:
+                if not turn.is_set():
+                    self._waiting.remove(turn)
+                    return False
+            # The slot came in just now; pass it on
+            self.release()
+            return False
+        return True
+
+    def release(self) -> None:
+        with self._lock:
+            if self._waiting:
+                # The slot goes straight to the next in line
+                self._waiting.popleft().set()
+            else:
+                self.running -= 1
+
+
+class ChatCompletionServer(ThreadingHTTPServer):
+    """
+    Serves the one loaded Chatbot over an OpenAI-compatible HTTP API:
+    POST /v1/chat/completions, streamed as server-sent events with
+    "stream": true, and GET /v1/models. Requests are prepared like batch rows,
+    so they get the chat template, default system message and sampling
+    settings of the environment, and share the decode loop (and response
+    cache) with everything else. Connections are kept alive between requests.
+    """
+
+    daemon_threads = True
+    # Connections accepted by the kernel before the server gets to them; the
+    # default of 5 resets clients arriving in a burst
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        chatbot: Chatbot,
+        host: str,
+        port: int,
+        max_concurrent: int = 0,
+        max_queued: int = DEFAULT_SERVER_MAX_QUEUED_REQUESTS,
+    ) -> None:
+        self.chatbot = chatbot
+        self.limiter = RequestLimiter(
+            max_concurrent or 2 * chatbot.max_batch_size, max_queued
+        )
+        super().__init__((host, port), _Handler)
+
+        chatbot.metrics.gauge(
+            "server_requests_running",
+            "HTTP requests being generated",
+            lambda: self.limiter.running,
+        )
+        chatbot.metrics.gauge(
+            "server_requests_queued",
+            "HTTP requests waiting for a free slot",
+            lambda: self.limiter.queued,
+        )
+        chatbot.metrics.gauge(
+            "server_requests_rejected_total",
+            "HTTP requests turned away with the queue full",
+            lambda: self.limiter.rejected,
+        )
+
+    def models(self) -> List[str]:
+        # The base model, and every LoRA adapter by its name
+        names = [self.chatbot.model_name]
+        if self.chatbot.adapters is not None:
+            names += self.chatbot.adapters.names()
+        return names
+
+
+def completion_row(chatbot: Chatbot, completion: Dict[str, Any]) -> Dict[str, Any]:
+    # The batch row an OpenAI chat completion request amounts to. Fields the
+    # chatbot has no use for (seed, user, penalties...) are ignored.
+    messages = completion.get("messages")
+    if not isinstance(messages, list) or not messages:
+        raise ValueError('"messages" must be a non-empty list')
+    if completion.get("n", 1) != 1:
+        raise ValueError("only n=1 is supported")
+
+    params: Dict[str, Any] = {}
+    for name, param in OPENAI_SAMPLING_PARAMS.items():
+        if completion.get(name) is not None:
+            params[param] = completion[name]
+    stop = completion.get("stop")
+    if stop is not None:
+        params["stop_strings"] = [stop] if isinstance(stop, str) else stop
+    if int(params.get("max_new_tokens", chatbot.max_new_tokens)) < 1:
+        raise ValueError("max_tokens must be at least 1")
+
+    row: Dict[str, Any] = {
+        "messages": [
+            {"role": message["role"], "content": _message_text(message["content"])}
+            for message in messages
+        ],
+        "params": params,
+    }
+    # A model named after a LoRA adapter picks it, any other gets the base
+    model = completion.get("model")
+    if chatbot.adapters is not None and model in chatbot.adapters.paths:
+        row["adapter"] = model
+    return row
+
+
+def _message_text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(part["text"] for part in content if part.get("type") == "text")
+    raise ValueError("message content must be a string or a list of parts")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
+    # Streamed events are small writes that shouldn't wait for an ACK
+    disable_nagle_algorithm = True
+    server: ChatCompletionServer
+
+    def do_GET(self) -> None:
+        path = self.path.split("?")[0]
+        if path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif path == "/v1/models":
+            self._send_json(
+                200,
+                {
+                    "object": "list",
+                    "data": [
+                        {"id": name, "object": "model", "owned_by": "local"}
+                        for name in self.server.models()
+                    ],
+                },
+            )
+        else:
+            self._send_error(404, f"no route for GET {path}", "not_found_error")
+
+    def do_POST(self) -> None:
+        body = self._read_body()
+        if body is None:
+            return
+        path = self.path.split("?")[0]
+        if path != "/v1/chat/completions":
+            self._send_error(404, f"no route for POST {path}", "not_found_error")
+            return
+
+        chatbot = self.server.chatbot
+        try:
+            completion = json.loads(body)
+            if not isinstance(completion, dict):
+                raise ValueError("the body must be a JSON object")
+            input_ids, params, adapter = prepare_row(
+                chatbot, completion_row(chatbot, completion)
+            )
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            self._send_error(400, str(e), "invalid_request_error")
+            return
+
+        limiter = self.server.limiter
+        if not limiter.acquire(self._client_gone):
+            if not self._client_gone():
+                self._send_error(
+                    429,
+                    "too many requests queued, try again later",
+                    "rate_limit_error",
+                    headers={"Retry-After": "1"},
+                )
+            return
+
+        try:
+            stream = bool(completion.get("stream"))
+            request = chatbot.submit_generation(
+                GenerationRequest(
+                    input_ids=input_ids,
+                    params=params,
+                    streamer=(
+                        TokenStream(
+                            chatbot.tokenizer,
+                            chunk_tokens=chatbot.stream_chunk_tokens,
+                            chunk_interval=chatbot.stream_chunk_interval,
+                            stop_strings=params.stop_strings,
+                        )
+                        if stream
+                        else None
+                    ),
+                    adapter=adapter,
+                    timeout=chatbot.generation_timeout,
+                )
+            )
+            reply = _Reply(
+                f"chatcmpl-{uuid.uuid4().hex}",
+                int(time.time()),
+                completion.get("model") or chatbot.model_name,
+            )
+            try:
+                if stream:
+                    options = completion.get("stream_options") or {}
+                    self._stream(reply, request, bool(options.get("include_usage")))
+                else:
+                    self._complete(reply, request)
+            except (BrokenPipeError, ConnectionResetError, socket.timeout):
+                # Nobody left to answer
+                request.cancel()
+                self.close_connection = True
+        finally:
+            limiter.release()
+
+    def _complete(self, reply: _Reply, request: GenerationRequest) -> None:
+        while not request.done.wait(DISCONNECT_POLL_INTERVAL):
+            if self._client_gone():
+                request.cancel()
+                self.close_connection = True
+                return
+        if request.error is not None:
+            self._send_error(500, str(request.error), "server_error")
+            return
+
+        text, _ = cut_at_stop_string(
+            self.server.chatbot.tokenizer.decode(
+                request.output_ids, skip_special_tokens=True
+            ),
+            request.params.stop_strings,
+        )
+        self._send_json(
+            200,
+            {
+                **reply.header("chat.completion"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text.strip()},
+                        "finish_reason": _finish_reason(request),
+                    }
+                ],
+                "usage": _usage(request),
+            },
+        )
+
+    def _stream(
+        self, reply: _Reply, request: GenerationRequest, include_usage: bool
+    ) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        self._send_event(reply.chunk({"role": "assistant", "content": ""}))
+        for text in request.streamer:
+            self._send_event(reply.chunk({"content": text}))
+
+        request.done.wait()
+        if request.error is not None:
+            self._send_event(
+                {"error": {"message": str(request.error), "type": "server_error"}}
+            )
+        else:
+            self._send_event(reply.chunk({}, _finish_reason(request)))
+            if include_usage:
+                self._send_event(
+                    {
+                        **reply.header("chat.completion.chunk"),
+                        "choices": [],
+                        "usage": _usage(request),
+                    }
+                )
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _read_body(self) -> Optional[bytes]:
+        # None once an error has been sent
+        if "chunked" in self.headers.get("Transfer-Encoding", ""):
+            self._send_error(411, "send a Content-Length", "invalid_request_error")
+            self.close_connection = True
+            return None
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0 or length > MAX_REQUEST_BYTES:
+            self._send_error(413, "request body too large", "invalid_request_error")
+            self.close_connection = True
+            return None
+        return self.rfile.read(length)
+
+    def _client_gone(self) -> bool:
+        # A closed connection reads as empty; anything else, like a pipelined
+        # next request, is left where it is
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            return bool(readable) and not self.connection.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    def _send_event(self, event: Dict[str, Any]) -> None:
+        self._write_chunk(f"data: {json.dumps(event)}\n\n".encode())
+
+    def _write_chunk(self, data: bytes) -> None:
+        # One chunk of the chunked transfer encoding; empty ends the body
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    def _send_json(
+        self,
+        status: int,
+        payload: Dict[str, Any],
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(
+        self,
+        status: int,
+        message: str,
+        type: str,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self._send_json(status, {"error": {"message": message, "type": type}}, headers)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if self.server.chatbot.debug:
+            print(f"{self.address_string()} - {format % args}")
+
+
+class _Reply:
+    # What every object sent for one completion has in common
+    def __init__(self, id: str, created: int, model: str) -> None:
+        self.id = id
+        self.created = created
+        self.model = model
+
+    def header(self, object: str) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "object": object,
+            "created": self.created,
+            "model": self.model,
+        }
+
+    def chunk(
+        self, delta: Dict[str, str], finish_reason: Optional[str] = None
+    ) -> Dict[str, Any]:
+        return {
+            **self.header("chat.completion.chunk"),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+
+def _finish_reason(request: GenerationRequest) -> str:
+    return OPENAI_FINISH_REASONS.get(request.finish_reason, request.finish_reason)
+
+
+def _usage(request: GenerationRequest) -> Dict[str, int]:
+    return {
+        "prompt_tokens": len(request.input_ids),
+        "completion_tokens": len(request.output_ids),
+        "total_tokens": len(request.input_ids) + len(request.output_ids),
+    }
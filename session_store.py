@@ -0,0 +1,267 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+SESSION_STORE_MEMORY = "memory"
+SESSION_STORE_SQLITE = "sqlite"
+
+
+class _Session:
+    def __init__(
+        self,
+        messages: Optional[List[Dict[str, str]]] = None,
+        summary: str = "",
+        first_seq: int = 0,
+    ) -> None:
+        self.messages: List[Dict[str, str]] = messages if messages is not None else []
+        self.summary = summary
+        # Sequence number of messages[0] in the backing store; trimming the
+        # head advances it instead of renumbering what is left.
+        self.first_seq = first_seq
+
+
+class SessionStore:
+    """
+    Conversation history keyed by user id, holding at most max_sessions
+    sessions in memory. Least recently used sessions are dropped when the
+    limit is reached; subclasses that persist them load them back on demand.
+    """
+
+    def __init__(self, max_sessions: int) -> None:
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str | None, _Session]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def messages(self, user_id: str | None) -> List[Dict[str, str]]:
+        with self._lock:
+            session = self._get(user_id)
+            return list(session.messages) if session is not None else []
+
+    def summary(self, user_id: str | None) -> str:
+        with self._lock:
+            session = self._get(user_id)
+            return session.summary if session is not None else ""
+
+    def append(self, user_id: str | None, message: Dict[str, str]) -> None:
+        with self._lock:
+            session = self._get_or_create(user_id)
+            session.messages.append(message)
+            self._on_append(user_id, session)
+
+    def drop_oldest(self, user_id: str | None, count: int) -> None:
+        with self._lock:
+            session = self._get(user_id)
+            if session is None or count <= 0:
+                return
+            count = min(count, len(session.messages))
+            session.messages = session.messages[count:]
+            session.first_seq += count
+            self._on_drop_oldest(user_id, session)
+
+    def set_summary(self, user_id: str | None, summary: str) -> None:
+        with self._lock:
+            session = self._get_or_create(user_id)
+            session.summary = summary
+            self._on_set_summary(user_id, session)
+
+    def clear(self, user_id: str | None) -> None:
+        with self._lock:
+            self._sessions.pop(user_id, None)
+            self._on_clear(user_id)
+
+    def clear_all(self) -> None:
+        with self._lock:
+            self._sessions.clear()
+            self._on_clear_all()
+
+    def forget(self, user_id: str | None) -> None:
+        # Drops only the in-memory copy: a persistent store reads the session
+        # back when it is touched again, the in-memory one loses it
+        with self._lock:
+            self.flush()
+            self._sessions.pop(user_id, None)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+    def hot_sessions(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def _get(self, user_id: str | None) -> Optional[_Session]:
+        session = self._sessions.get(user_id)
+        if session is not None:
+            self._sessions.move_to_end(user_id)
+            return session
+
+        session = self._load(user_id)
+        if session is not None:
+            self._remember(user_id, session)
+        return session
+
+    def _get_or_create(self, user_id: str | None) -> _Session:
+        session = self._get(user_id)
+        if session is None:
+            session = _Session()
+            self._remember(user_id, session)
+        return session
+
+    def _remember(self, user_id: str | None, session: _Session) -> None:
+        self._sessions[user_id] = session
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    # Persistence hooks, no-ops for the in-memory store
+
+    def _load(self, user_id: str | None) -> Optional[_Session]:
+        return None
+
+    def _on_append(self, user_id: str | None, session: _Session) -> None:
+        pass
+
+    def _on_drop_oldest(self, user_id: str | None, session: _Session) -> None:
+        pass
+
+    def _on_set_summary(self, user_id: str | None, session: _Session) -> None:
+        pass
+
+    def _on_clear(self, user_id: str | None) -> None:
+        pass
+
+    def _on_clear_all(self) -> None:
+        pass
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    SessionStore backed by an SQLite database in WAL mode. Only hot sessions
+    are kept in memory, cold ones are read back when they are touched again.
+    Writes are queued and committed in one transaction once flush_every of
+    them have piled up or flush_interval seconds have passed, whichever comes
+    first.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_sessions: int,
+        flush_every: int = 256,
+        flush_interval: float = 1.0,
+    ) -> None:
+        super().__init__(max_sessions)
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "user_id TEXT NOT NULL, seq INTEGER NOT NULL, "
+            "role TEXT NOT NULL, content TEXT NOT NULL, "
+            "PRIMARY KEY (user_id, seq)) WITHOUT ROWID"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            "user_id TEXT PRIMARY KEY, summary TEXT NOT NULL)"
+        )
+        self._connection.commit()
+
+        self._pending: List[Tuple[str, Tuple]] = []
+        self._last_flush: float = time.monotonic()
+
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    def flush(self) -> None:
+        with self._lock:
+            if not self._pending:
+                return
+            with self._connection:
+                for statement, args in self._pending:
+                    self._connection.execute(statement, args)
+            self._pending = []
+            self._last_flush = time.monotonic()
+
+    def close(self) -> None:
+        self._closed.set()
+        self.flush()
+        with self._lock:
+            self._connection.close()
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def _queue(self, statement: str, args: Tuple) -> None:
+        self._pending.append((statement, args))
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def _load(self, user_id: str | None) -> Optional[_Session]:
+        # A session evicted from memory may still have queued writes
+        self.flush()
+
+        key = _key(user_id)
+        rows = self._connection.execute(
+            "SELECT seq, role, content FROM messages WHERE user_id = ? ORDER BY seq",
+            (key,),
+        ).fetchall()
+        summary_row = self._connection.execute(
+            "SELECT summary FROM summaries WHERE user_id = ?", (key,)
+        ).fetchone()
+
+        if not rows and summary_row is None:
+            return None
+
+        return _Session(
+            messages=[{"role": role, "content": content} for _, role, content in rows],
+            summary=summary_row[0] if summary_row is not None else "",
+            first_seq=rows[0][0] if rows else 0,
+        )
+
+    def _on_append(self, user_id: str | None, session: _Session) -> None:
+        message = session.messages[-1]
+        self._queue(
+            "INSERT OR REPLACE INTO messages (user_id, seq, role, content) "
+            "VALUES (?, ?, ?, ?)",
+            (
+                _key(user_id),
+                session.first_seq + len(session.messages) - 1,
+                message["role"],
+                message["content"],
+            ),
+        )
+
+    def _on_drop_oldest(self, user_id: str | None, session: _Session) -> None:
+        self._queue(
+            "DELETE FROM messages WHERE user_id = ? AND seq < ?",
+            (_key(user_id), session.first_seq),
+        )
+
+    def _on_set_summary(self, user_id: str | None, session: _Session) -> None:
+        self._queue(
+            "INSERT OR REPLACE INTO summaries (user_id, summary) VALUES (?, ?)",
+            (_key(user_id), session.summary),
+        )
+
+    def _on_clear(self, user_id: str | None) -> None:
+        self._queue("DELETE FROM messages WHERE user_id = ?", (_key(user_id),))
+        self._queue("DELETE FROM summaries WHERE user_id = ?", (_key(user_id),))
+
+    def _on_clear_all(self) -> None:
+        self._queue("DELETE FROM messages", ())
+        self._queue("DELETE FROM summaries", ())
+
+
+def _key(user_id: str | None) -> str:
+    # The CLI conversation has no user_id
+    return "" if user_id is None else str(user_id)
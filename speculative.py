@@ -0,0 +1,187 @@
+from typing import Any, List, Optional
+
+import torch
+from transformers import DynamicCache
+
+from kv_cache import (
+    concat_caches,
+    pad_cache_left,
+    pad_mask_left,
+    trim_leading_padding,
+)
+
+# Longest trailing n-gram prompt lookup tries to find earlier in the sequence
+PROMPT_LOOKUP_MAX_NGRAM = 3
+
+
+class PromptLookupProposer:
+    """
+    Proposes the tokens that followed the last occurrence of the sequence's
+    trailing n-gram, anywhere earlier in the prompt or the reply. Chat replies
+    quote names, code and earlier messages a lot, and this costs no model.
+    """
+
+    def __init__(self, max_ngram: int = PROMPT_LOOKUP_MAX_NGRAM) -> None:
+        self.max_ngram = max_ngram
+
+    def propose(self, tokens: List[List[int]], num_tokens: int) -> List[List[int]]:
+        return [self._lookup(row, num_tokens) for row in tokens]
+
+    def _lookup(self, row: List[int], num_tokens: int) -> List[int]:
+        sequence = torch.tensor(row)
+        for n in range(min(self.max_ngram, len(row) - 1), 0, -1):
+            # Every n-gram but the trailing one itself
+            windows = sequence[:-1].unfold(0, n, 1)
+            matches = (windows == sequence[-n:]).all(dim=-1).nonzero()
+            if len(matches):
+                start = int(matches[-1]) + n
+                return row[start : start + num_tokens]
+        return []
+
+    def admit(self, prompts: List[List[int]]) -> None:
+        pass
+
+    def verified(self, accepted: List[int]) -> None:
+        pass
+
+    def evict(self, keep: List[int]) -> None:
+        pass
+
+    def reset(self) -> None:
+        pass
+
+
+class DraftModelProposer:
+    """
+    Proposes tokens by running a small model that shares the main model's
+    tokenizer greedily ahead of it. The draft keeps its own batched KV cache
+    with the same rows as the scheduler's; columns it computed for rejected
+    proposals are masked out rather than removed.
+    """
+
+    def __init__(self, model: Any, tokenizer: Any, device: str) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+
+        self._cache: Optional[DynamicCache] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        # Per row, how many of its tokens the draft has been fed
+        self._fed: List[int] = []
+        # Columns the last propose() fed with its own proposals
+        self._proposal_columns: int = 0
+
+    def admit(self, prompts: List[List[int]]) -> None:
+        # The draft is small enough to prefill whole prompts; it has no
+        # session or prefix cache of its own.
+        batch = self.tokenizer.pad(
+            {"input_ids": prompts}, padding=True, return_tensors="pt"
+        )
+        input_ids = batch["input_ids"].to(self.device)
+        attention_mask = batch["attention_mask"].to(self.device)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=(attention_mask.cumsum(-1) - 1).clamp(min=0),
+            past_key_values=DynamicCache(),
+            use_cache=True,
+            logits_to_keep=1,
+        )
+
+        if self._cache is None:
+            self._cache = outputs.past_key_values
+            self._attention_mask = attention_mask
+        else:
+            length = max(self._attention_mask.shape[-1], attention_mask.shape[-1])
+            self._cache = concat_caches(
+                pad_cache_left(self._cache, length),
+                pad_cache_left(outputs.past_key_values, length),
+            )
+            self._attention_mask = torch.cat(
+                [
+                    pad_mask_left(self._attention_mask, length),
+                    pad_mask_left(attention_mask, length),
+                ]
+            )
+        self._fed.extend(len(prompt) for prompt in prompts)
+
+    def propose(self, tokens: List[List[int]], num_tokens: int) -> List[List[int]]:
+        # Whatever the main model accepted since the last call, plus the token
+        # it sampled itself: usually one token, two when every proposal was
+        # accepted (the last one is never fed to the draft).
+        pending = [row[fed:] for row, fed in zip(tokens, self._fed)]
+        width = max(len(row) for row in pending)
+        input_ids = torch.tensor(
+            [
+                [self.tokenizer.pad_token_id] * (width - len(row)) + row
+                for row in pending
+            ],
+            device=self.device,
+        )
+        pending_mask = torch.tensor(
+            [[0] * (width - len(row)) + [1] * len(row) for row in pending],
+            dtype=self._attention_mask.dtype,
+            device=self.device,
+        )
+        attention_mask = torch.cat([self._attention_mask, pending_mask], dim=-1)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, -width:]
+
+        proposals: List[torch.Tensor] = []
+        for _ in range(num_tokens):
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=self._cache,
+                use_cache=True,
+                logits_to_keep=1,
+            )
+            self._cache = outputs.past_key_values
+            input_ids = outputs.logits[:, -1, :].argmax(dim=-1, keepdim=True)
+            proposals.append(input_ids)
+            if len(proposals) == num_tokens:
+                break
+
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones((len(pending), 1))], dim=-1
+            )
+            position_ids = attention_mask.sum(-1, keepdim=True) - 1
+
+        self._attention_mask = attention_mask
+        self._fed = [len(row) for row in tokens]
+        self._proposal_columns = num_tokens - 1
+
+        return torch.cat(proposals, dim=-1).tolist()
+
+    def verified(self, accepted: List[int]) -> None:
+        if self._proposal_columns == 0:
+            return
+
+        # Proposals past the first rejected one were fed for nothing
+        kept = torch.tensor(
+            [min(n, self._proposal_columns) for n in accepted], device=self.device
+        )
+        columns = torch.arange(self._proposal_columns, device=self.device)
+        self._attention_mask[:, -self._proposal_columns :] *= (
+            columns.unsqueeze(0) < kept.unsqueeze(-1)
+        ).to(self._attention_mask.dtype)
+        self._fed = [fed + int(n) for fed, n in zip(self._fed, kept.tolist())]
+        self._proposal_columns = 0
+
+    def evict(self, keep: List[int]) -> None:
+        if not keep:
+            self.reset()
+            return
+
+        keep_index = torch.tensor(keep, device=self.device)
+        self._cache.batch_select_indices(keep_index)
+        self._attention_mask = self._attention_mask[keep_index]
+        self._fed = [self._fed[r] for r in keep]
+
+        self._attention_mask = trim_leading_padding(self._cache, self._attention_mask)
+
+    def reset(self) -> None:
+        self._cache = None
+        self._attention_mask = None
+        self._fed = []
+        self._proposal_columns = 0
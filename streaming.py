@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Iterator, List, Sequence, Tuple
+
+# What a decode ends with while a multi-byte character is still incomplete
+INCOMPLETE_CHARACTER = "\ufffd"
+
+
+def cut_at_stop_string(text: str, stop_strings: Sequence[str]) -> Tuple[str, bool]:
+    # The text before the first stop string in it, and whether there was one
+    cut = min(
+        (index for index in map(text.find, stop_strings) if index >= 0),
+        default=-1,
+    )
+    return (text[:cut], True) if cut >= 0 else (text, False)
+
+
+def partial_stop_length(text: str, stop_strings: Sequence[str]) -> int:
+    # Length of the longest end of text that a stop string starts with
+    return max(
+        (
+            length
+            for stop in stop_strings
+            for length in range(min(len(stop) - 1, len(text)), 0, -1)
+            if text.endswith(stop[:length])
+        ),
+        default=0,
+    )
+
+
+class TokenStream:
+    """
+    Streams the reply of one generation request as text. The scheduler thread
+    only appends token ids (put/end, the interface of transformers' streamers)
+    and wakes readers once chunk_tokens new tokens, or chunk_interval seconds
+    worth of them, have come in; decoding happens on the readers' side, a few
+    tokens at a time, and is held back while a character is still incomplete
+    or while the text could be the start of one of the stop_strings, at the
+    first of which the text ends.
+    Any number of readers, synchronous or async, can follow the same stream,
+    each getting every chunk. A reader that falls behind gets what piled up
+    as one chunk the next time it looks, so the producer never waits on it and
+    a stream holds no more than its reply.
+    """
+
+    def __init__(
+        self,
+        tokenizer: Any,
+        chunk_tokens: int = 1,
+        chunk_interval: float = 0.0,
+        skip_special_tokens: bool = True,
+        stop_strings: Sequence[str] = (),
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.chunk_interval = chunk_interval
+        self.skip_special_tokens = skip_special_tokens
+        self.stop_strings = [stop for stop in stop_strings if stop]
+
+        # Producer side: readers only see the first _visible token ids
+        self._ids: List[int] = []
+        self._visible: int = 0
+        self._visible_at: float = 0.0
+        self._ended: bool = False
+        self._condition = threading.Condition()
+        # Async readers waiting for more, woken once each
+        self._waiters: List[Callable[[], None]] = []
+
+        # Reader side, shared so every token is decoded once however many
+        # readers there are: decoded text in chunks, the window of ids the
+        # next decode starts from and the ids attempted so far
+        self._decode_lock = threading.Lock()
+        self._chunks: List[str] = []
+        self._prefix_offset: int = 0
+        self._read_offset: int = 0
+        self._attempted: int = 0
+        # Decoded text that may turn out to be the start of a stop string
+        self._held: str = ""
+        self._stopped: bool = False
+        self._complete: bool = False
+        self._text: str | None = None
+
+    def put(self, value: Any) -> None:
+        # value: a 1-d tensor of new token ids
+        with self._condition:
+            self._ids.extend(value.tolist())
+            pending = len(self._ids) - self._visible
+            if pending < self.chunk_tokens and not (
+                self.chunk_interval > 0
+                and time.monotonic() - self._visible_at >= self.chunk_interval
+            ):
+                return
+            self._publish()
+
+    def end(self) -> None:
+        with self._condition:
+            self._ended = True
+            self._publish()
+
+    def __iter__(self) -> Iterator[str]:
+        index = 0
+        while True:
+            with self._condition:
+                while not self._ready(index):
+                    self._condition.wait()
+            text, index, done = self._read(index)
+            if text:
+                yield text
+            if done:
+                return
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        index = 0
+        while True:
+            await self._until_ready(loop, index)
+            text, index, done = self._read(index)
+            if text:
+                yield text
+            if done:
+                return
+
+    def text(self) -> str:
+        # The whole reply, once the request is done
+        with self._condition:
+            while not self._ended:
+                self._condition.wait()
+        return self._final_text()
+
+    async def atext(self) -> str:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self._ended:
+                    break
+            await self._until_ready(loop, None)
+        return self._final_text()
+
+    def _publish(self) -> None:
+        # Called with the condition held
+        self._visible = len(self._ids)
+        if self.chunk_interval > 0:
+            self._visible_at = time.monotonic()
+        self._condition.notify_all()
+        waiters, self._waiters = self._waiters, []
+        for wake in waiters:
+            wake()
+
+    def _ready(self, index: int | None) -> bool:
+        # Called with the condition held; index None waits for the end only
+        if self._ended:
+            return True
+        if index is None:
+            return False
+        return index < len(self._chunks) or self._visible > self._attempted
+
+    async def _until_ready(
+        self, loop: asyncio.AbstractEventLoop, index: int | None
+    ) -> None:
+        with self._condition:
+            if self._ready(index):
+                return
+            # One call_soon_threadsafe per wait, however many tokens come in
+            # before this reader gets to run again
+            woken = asyncio.Event()
+            self._waiters.append(lambda: loop.call_soon_threadsafe(woken.set))
+        await woken.wait()
+
+    def _read(self, index: int) -> Tuple[str, int, bool]:
+        with self._condition:
+            visible, ended = self._visible, self._ended
+        with self._decode_lock:
+            self._decode(visible, ended)
+            chunks = self._chunks[index:]
+            return "".join(chunks), index + len(chunks), self._complete
+
+    def _decode(self, visible: int, ended: bool) -> None:
+        # Called with the decode lock held. Decodes the ids between
+        # _prefix_offset and visible and keeps what the last _read_offset ids
+        # didn't already produce; the extra context in front keeps spaces and
+        # merged characters the same as decoding the whole reply would.
+        if visible > self._attempted:
+            self._attempted = visible
+            self._emit(visible, ended)
+        if ended and not self._complete:
+            # Whatever was held back goes out as is
+            self._emit(len(self._ids), True)
+            self._append("", True)
+            self._complete = True
+
+    def _emit(self, end: int, final: bool) -> None:
+        if end <= self._read_offset:
+            return
+        prefix = self._decode_ids(self._ids[self._prefix_offset : self._read_offset])
+        text = self._decode_ids(self._ids[self._prefix_offset : end])
+        if len(text) > len(prefix) and (
+            final or not text.endswith(INCOMPLETE_CHARACTER)
+        ):
+            self._append(text[len(prefix) :], final)
+            self._prefix_offset, self._read_offset = self._read_offset, end
+
+    def _append(self, text: str, final: bool) -> None:
+        if self._stopped:
+            return
+        if not self.stop_strings:
+            if text:
+                self._chunks.append(text)
+            return
+
+        # Only the held back text and what follows can complete a stop string
+        text, self._stopped = cut_at_stop_string(self._held + text, self.stop_strings)
+        held = (
+            0
+            if final or self._stopped
+            else partial_stop_length(text, self.stop_strings)
+        )
+        self._held = text[len(text) - held :] if held else ""
+        text = text[: len(text) - held]
+        if text:
+            self._chunks.append(text)
+
+    def _decode_ids(self, ids: List[int]) -> str:
+        if not ids:
+            return ""
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens)
+
+    def _final_text(self) -> str:
+        with self._decode_lock:
+            self._decode(len(self._ids), True)
+            if self._text is None:
+                self._text = "".join(self._chunks)
+            return self._text
@@ -1,12 +1,34 @@
 import os
-import json
+import signal
+import time
+import asyncio
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any
+from admission import (
+    REJECT_BUSY,
+    REJECT_CHAT_QUEUE_FULL,
+    REJECT_RATE_LIMITED,
+    AdmissionRejected,
+    ChatAdmission,
+)
 from chat import Chatbot
-from time import sleep
+from config import (
+    ENV_VAR_TELEGRAM_BOT_SUPERUSER_CHAT_ID,
+    ENV_VAR_TELEGRAM_BOT_TOKEN,
+    ChatbotConfig,
+    ConfigError,
+    TelegramConfig,
+)
+from metrics import Metrics
+from user_registry import UserRegistry
+from worker_pool import WorkerPool, invoke
 from random import uniform
-from typing import Dict
-from telegram import Update
-from telegram.constants import ChatAction
+from telegram import Message, Update
+from telegram.constants import ChatAction, MessageLimit
+from telegram.error import RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -23,111 +45,298 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-# Constants for environment variable names
-ENV_VAR_TELEGRAM_BOT_TOKEN: str = "TELEGRAM_BOT_TOKEN"
-ENV_VAR_TELEGRAM_BOT_USER_DATA_FILE: str = "TELEGRAM_BOT_USER_DATA_FILE"
-ENV_VAR_TELEGRAM_BOT_SUPERUSER_CHAT_ID: str = "TELEGRAM_BOT_SUPERUSER_CHAT_ID"
-ENV_VAR_TELEGRAM_BOT_SPLIT_RESPONSE_NEWLINES: str = (
-    "TELEGRAM_BOT_SPLIT_RESPONSE_NEWLINES"
-)
-
-# File to store user data
-USER_DATA_FILE: str = os.getenv(ENV_VAR_TELEGRAM_BOT_USER_DATA_FILE, "")
-if not USER_DATA_FILE:
-    raise ValueError("TELEGRAM_BOT_USER_DATA_FILE environment variable not set")
-
-# Superuser chat ID
-SUPERUSER_CHAT_ID: str = os.getenv(ENV_VAR_TELEGRAM_BOT_SUPERUSER_CHAT_ID, "")
-if not SUPERUSER_CHAT_ID:
-    logger.warning("TELEGRAM_BOT_SUPERUSER_CHAT_ID environment variable not set")
+# Raises on a missing TELEGRAM_BOT_USER_DATA_FILE or any malformed setting
+telegram_config: TelegramConfig = TelegramConfig.from_env()
+if not telegram_config.superuser_chat_id:
+    logger.warning(
+        f"{ENV_VAR_TELEGRAM_BOT_SUPERUSER_CHAT_ID} environment variable not set"
+    )
 
-# Split response newlines
-SPLIT_RESPONSE_NEWLINES: bool = (
-    os.getenv(ENV_VAR_TELEGRAM_BOT_SPLIT_RESPONSE_NEWLINES, "false").lower() == "true"
+# Registry of chat_id: username pairs
+user_registry: UserRegistry | None = None
+# Looks up the users the registry doesn't hold in memory, one at a time and
+# in order, so a chat's messages still reach admission in the order they came
+registry_lookups: ThreadPoolExecutor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="user-registry"
 )
 
-# Dictionary to store chat_id: username pairs
-user_data: Dict[str, str] = {}
-
-# Initialize the AI chatbot global var
+# Initialize the AI chatbot global var; main() loads it in the background
+# while the bot is already connected, handlers wait for it
 chatbot: Chatbot | None = None
-
-
-# Load user data from file
-def load_user_data() -> None:
-    global user_data
-    if os.path.exists(USER_DATA_FILE):
-        with open(USER_DATA_FILE, "r") as f:
-            user_data = json.load(f)
-        logger.info(f"Loaded user data from {USER_DATA_FILE}")
+chatbot_loaded: threading.Event = threading.Event()
+# With TELEGRAM_BOT_WORKERS, model worker processes answer instead
+pool: WorkerPool | None = None
+# Which chat's message goes to the model next; main() sets it up
+admission: ChatAdmission | None = None
+
+# What a chat is told when its message is turned away
+REJECTION_MESSAGES = {
+    REJECT_RATE_LIMITED: "You're sending messages too fast, please slow down.",
+    REJECT_CHAT_QUEUE_FULL: "Still working on your earlier messages, hang on.",
+    REJECT_BUSY: "I'm swamped right now, please try again in a bit.",
+}
+
+
+async def wait_for_chatbot() -> Chatbot | WorkerPool:
+    # The pool waits for a ready worker on every request by itself
+    if pool is not None:
+        return pool
+    if chatbot is None:
+        await asyncio.to_thread(chatbot_loaded.wait)
+    if chatbot is None:
+        raise RuntimeError("Chatbot failed to load")
+    return chatbot
+
+
+async def call_chatbot(chat_id: str, name: str, *args: Any) -> Any:
+    # A Chatbot method or attribute (see worker_pool.invoke) for chat_id; in
+    # pool mode on the worker that owns the chat. Off the event loop either
+    # way: /system prefills the new prompt prefix, /clear and /history go
+    # to the session store
+    if pool is not None:
+        return await pool.call(chat_id, name, *args)
+    return await asyncio.to_thread(invoke, await wait_for_chatbot(), name, *args)
+
+
+async def call_every_chatbot(name: str, *args: Any) -> Any:
+    # Same, on every worker; returns what one of them returned
+    if pool is not None:
+        results = await pool.call_all(name, *args)
+        return results[0] if results else None
+    return await asyncio.to_thread(invoke, await wait_for_chatbot(), name, *args)
+
+
+def telegram_metrics() -> Metrics:
+    return pool.metrics if pool is not None else chatbot.metrics
+
+
+def watch_admission(metrics: Metrics) -> None:
+    if admission is None:
         return
-    logger.warning(
-        f"User data file {USER_DATA_FILE} not found. Starting with empty user data."
-    )
+    for name, help in [
+        ("active", "Chats whose message is at the model"),
+        ("queued", "Messages waiting for their chat's turn"),
+        ("waiting_chats", "Chats with a message waiting"),
+        ("admitted", "Messages let in"),
+        ("merged", "Messages answered along with an earlier one"),
+        ("rejected_rate_limited", "Messages turned away by the rate limit"),
+        ("rejected_chat_queue_full", "Messages turned away by a full chat queue"),
+        ("rejected_busy", "Messages turned away or pushed out with the queue full"),
+    ]:
+        metrics.gauge(
+            f"telegram_admission_{name}",
+            help,
+            lambda name=name: admission.stats()[name],
+        )
 
 
-# Save user data to file
-def save_user_data() -> None:
-    with open(USER_DATA_FILE, "w") as f:
-        json.dump(user_data, f)
-    logger.debug(f"Saved user data to {USER_DATA_FILE}")
+def load_chatbot(config: ChatbotConfig) -> None:
+    global chatbot
+    try:
+        chatbot = Chatbot(config)
+        watch_admission(chatbot.metrics)
+        logger.info("Chatbot loaded")
+    except BaseException:
+        logger.exception("Failed to load the chatbot, stopping the bot")
+        # run_polling() stops on SIGINT like on Ctrl-C
+        os.kill(os.getpid(), signal.SIGINT)
+    finally:
+        chatbot_loaded.set()
+
+
+async def lookup_user(chat_id: str) -> str | None:
+    username: str | None = user_registry.cached(chat_id)
+    if username is None:
+        # An SQLite query, off the event loop
+        username = await asyncio.get_running_loop().run_in_executor(
+            registry_lookups, user_registry.get, chat_id
+        )
+    return username
 
 
 # Command handler for /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id: str = str(update.effective_chat.id)
-    if chat_id not in user_data:
+    username: str | None = await lookup_user(chat_id)
+    if username is None:
         await update.message.reply_text("Hello! What's your name?")
         logger.info(f"New user with chat_id {chat_id} started the bot")
         return
 
-    await update.message.reply_text(f"Hello again, {user_data[chat_id]}!")
-    logger.info(
-        f"Existing user {user_data[chat_id]} (chat_id: {chat_id}) started the bot"
-    )
+    await update.message.reply_text(f"Hello again, {username}!")
+    logger.info(f"Existing user {username} (chat_id: {chat_id}) started the bot")
 
 
 # Message handler
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id: str = str(update.effective_chat.id)
+    received_at: float = time.perf_counter()
 
     logger.debug(f"Received message from chat_id: {chat_id}: {update.message.text}")
 
-    if chat_id not in user_data:
-        user_data[chat_id] = update.message.text
-        save_user_data()
+    username: str | None = await lookup_user(chat_id)
+    if username is None:
+        user_registry.register(chat_id, update.message.text)
         await update.message.reply_text(f"Thanks! {update.message.text}!")
         logger.info(f"New user registered: {update.message.text} (chat_id: {chat_id})")
         return
 
+    if admission is None:
+        await answer_message(
+            update, context, chat_id, update.message.text, received_at, 0.0
+        )
+        return
+    try:
+        async with admission.slot(chat_id, update.message.text) as turn:
+            if not turn.texts:
+                logger.debug(f"Merged a message from chat_id {chat_id} into its turn")
+                return
+            # A burst of messages is answered as one, in the reply to the first
+            text = "\n".join(turn.texts)
+            await answer_message(
+                update, context, chat_id, text, received_at, turn.waited
+            )
+    except AdmissionRejected as e:
+        logger.info(f"Turned away a message from chat_id {chat_id}: {e.reason}")
+        await update.message.reply_text(REJECTION_MESSAGES[e.reason])
+
+
+async def answer_message(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: str,
+    text: str,
+    received_at: float,
+    waited: float,
+) -> None:
     await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+    backend = await wait_for_chatbot()
+    telegram_metrics().telegram_queue_time.observe(waited)
+
+    if telegram_config.stream_responses:
+        reply = StreamingReply(
+            update,
+            telegram_config.stream_edit_interval,
+            telegram_config.split_response_newlines,
+        )
+        async for chunk in backend.astream_response(text, user_id=chat_id):
+            await reply.add(chunk)
+        await reply.finish()
+        response = reply.response.strip()
+    else:
+        response = await backend.agenerate_response(text, user_id=chat_id)
+        # Empty when a newer message from the chat superseded this one
+        if response:
+            await send_response(update, context, chat_id, response)
 
-    response = chatbot.generate_response(
-        update.message.text,
-        user_id=chat_id,
-        print_response=False,
-    )
+    telegram_metrics().telegram_response_time.observe(time.perf_counter() - received_at)
+
+    logger.debug(f"Answered message for chat_id {chat_id}: {response}")
 
-    if SPLIT_RESPONSE_NEWLINES:
+
+async def send_response(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: str, response: str
+) -> None:
+    if telegram_config.split_response_newlines:
         lines = response.split("\n")
 
         for c, line in enumerate(lines):
             if not line:
                 continue
 
-            await update.message.reply_text(line)
+            await send_reply(update, line)
 
             if c < len(lines) - 1:
                 await context.bot.send_chat_action(
                     chat_id=chat_id, action=ChatAction.TYPING
                 )
-                sleep(uniform(0.2, 1))
+                await asyncio.sleep(uniform(0.2, 1))
     else:
-        await update.message.reply_text(response)
+        await send_reply(update, response)
+
+
+async def send_reply(update: Update, text: str) -> Message:
+    started: float = time.perf_counter()
+    message: Message = await update.message.reply_text(text)
+    telegram_metrics().telegram_send_time.observe(time.perf_counter() - started)
+    return message
+
+
+class StreamingReply:
+    """
+    Shows a reply while it is being generated: the first tokens are sent as a
+    new message, which is then edited with whatever arrived since, at most once
+    per edit_interval. A message that reaches Telegram's length limit, or a
+    finished line when splitting on newlines, is left as is and the rest goes
+    into a new message.
+    """
+
+    def __init__(self, update: Update, edit_interval: float, split_newlines: bool):
+        self.update = update
+        self.edit_interval = edit_interval
+        self.split_newlines = split_newlines
+        self.response: str = ""
+
+        # Text of the message currently being edited, and what it shows so far
+        self._text: str = ""
+        self._message: Message | None = None
+        self._shown: str = ""
+        self._last_sent: float = 0.0
+
+    async def add(self, text: str) -> None:
+        self.response += text
+        self._text += text
+
+        if self.split_newlines:
+            *lines, self._text = self._text.split("\n")
+            for line in lines:
+                await self._complete(line)
+
+        while len(self._text) > MessageLimit.MAX_TEXT_LENGTH:
+            cut = self._text.rfind(" ", 0, MessageLimit.MAX_TEXT_LENGTH)
+            if cut <= 0:
+                cut = MessageLimit.MAX_TEXT_LENGTH
+            head, self._text = self._text[:cut], self._text[cut:]
+            await self._complete(head)
+
+        if time.monotonic() - self._last_sent >= self.edit_interval:
+            await self._show(self._text)
+
+    async def finish(self) -> None:
+        await self._complete(self._text)
+        self._text = ""
+
+    async def _complete(self, text: str) -> None:
+        await self._show(text)
+        self._message = None
+        self._shown = ""
+
+    async def _show(self, text: str) -> None:
+        text = text.strip()
+        # Telegram rejects empty messages and edits that change nothing
+        if not text or text == self._shown:
+            return
 
-    logger.debug(
-        f"Answered message for user {user_data[chat_id]} (chat_id: {chat_id}): {response}"
-    )
+        while True:
+            try:
+                if self._message is None:
+                    self._message = await send_reply(self.update, text)
+                else:
+                    started = time.perf_counter()
+                    await self._message.edit_text(text)
+                    telegram_metrics().telegram_send_time.observe(
+                        time.perf_counter() - started
+                    )
+                break
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(f"Flood limit hit, retrying in {retry_after}s")
+                await asyncio.sleep(retry_after)
+
+        self._shown = text
+        self._last_sent = time.monotonic()
 
 
 async def handle_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -139,7 +348,7 @@ async def handle_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         else ""
     )
 
-    if chat_id == SUPERUSER_CHAT_ID:
+    if chat_id == telegram_config.superuser_chat_id:
         if command in [
             "temp",
             "temperature",
@@ -151,27 +360,74 @@ async def handle_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         ]:
             param = "temperature" if command == "temp" else command
             param = "max_new_tokens" if param == "max_tokens" else param
-            chatbot.set_parameter(param, args)
+            await call_every_chatbot("set_parameter", param, args)
             await update.message.reply_text(
-                f"{param.capitalize()} set to: {getattr(chatbot, param)}"
+                f"{param.capitalize()} set to: {await call_chatbot(chat_id, param)}"
             )
             return
         elif command == "system":
-            chatbot.set_parameter("system_message", args)
+            await call_every_chatbot("set_parameter", "system_message", args)
             await update.message.reply_text(
-                f"System message set to: {chatbot.system_message}"
+                "System message set to: "
+                f"{await call_chatbot(chat_id, 'system_message')}"
             )
             return
         elif command == "users":
             await send_user_list(update, context)
             return
+        elif command == "stats":
+            if pool is not None:
+                stats = await pool.format_stats()
+            else:
+                stats = await call_chatbot(chat_id, "format_stats")
+            await update.message.reply_text(stats)
+            return
+        elif command == "policy":
+            # /policy [target_p95] shows the load policy, or sets its target
+            if args:
+                await call_every_chatbot(
+                    "set_parameter", "adaptive_target_p95", args.strip()
+                )
+            if pool is not None:
+                policy = await pool.format_each("format_policy")
+            else:
+                policy = await call_chatbot(chat_id, "format_policy")
+            await update.message.reply_text(policy)
+            return
+        elif command == "adapter":
+            # /adapter [chat_id] name|none, the superuser's own chat by default
+            adapter_args = args.split()
+            if not adapter_args:
+                await update.message.reply_text(
+                    await call_chatbot(chat_id, "format_adapters", chat_id)
+                )
+                return
+            target_chat_id = adapter_args[0] if len(adapter_args) > 1 else chat_id
+            # Every worker learns it, so it survives the chat moving
+            try:
+                await call_every_chatbot(
+                    "set_adapter", target_chat_id, adapter_args[-1]
+                )
+            except (ValueError, RuntimeError) as e:
+                await update.message.reply_text(str(e))
+                return
+            chat_adapters = await call_chatbot(target_chat_id, "chat_adapters")
+            await update.message.reply_text(
+                f"Adapter for chat {target_chat_id} set to: "
+                f"{chat_adapters.get(target_chat_id, 'none')}"
+            )
+            return
 
-    if command == "clear":
-        chatbot.clear_history()
+    if command == "stop":
+        stopped = await call_chatbot(chat_id, "stop_generation", chat_id)
+        await update.message.reply_text("Stopped" if stopped else "Nothing to stop")
+        return
+    elif command == "clear":
+        await call_chatbot(chat_id, "clear_history", chat_id)
         await update.message.reply_text("Chat history cleared")
         return
     elif command == "history":
-        history = chatbot.history.get(chat_id, [])
+        history = await call_chatbot(chat_id, "history.messages", chat_id)
         history_text = "\n".join(
             [f"{entry['role'].capitalize()}: {entry['content']}" for entry in history]
         )
@@ -179,7 +435,7 @@ async def handle_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     elif command in ["help", "?"]:
         await send_help_message(
-            update, context, is_superuser=(chat_id == SUPERUSER_CHAT_ID)
+            update, context, is_superuser=(chat_id == telegram_config.superuser_chat_id)
         )
         return
     else:
@@ -191,6 +447,7 @@ async def send_help_message(
     update: Update, context: ContextTypes.DEFAULT_TYPE, is_superuser: bool
 ) -> None:
     help_message = "Available commands:\n"
+    help_message += "/stop: Stop the reply being written\n"
     help_message += "/clear: Clear chat history\n"
     help_message += "/history: Show chat history\n"
     help_message += "/help or /?: Show this help message\n"
@@ -205,17 +462,24 @@ async def send_help_message(
         help_message += "/system <message>: Set system message\n"
         help_message += "/debug true|false: Enable or disable debug mode\n"
         help_message += "/users: Show all users (chat ID and username)\n"
+        help_message += "/stats: Show runtime metrics\n"
+        help_message += (
+            "/policy [target_p95]: Show the load policy, or set its p95 target\n"
+        )
+        help_message += (
+            "/adapter [chat_id] [name|none]: Show or switch a chat's LoRA adapter\n"
+        )
 
     await update.message.reply_text(help_message)
 
 
 async def send_user_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if str(update.effective_chat.id) != SUPERUSER_CHAT_ID:
+    if str(update.effective_chat.id) != telegram_config.superuser_chat_id:
         await update.message.reply_text("You are not authorized to use this command.")
         return
 
     user_list = "User List:\n"
-    for chat_id, username in user_data.items():
+    for chat_id, username in await asyncio.to_thread(user_registry.items):
         user_list += f"Chat ID: {chat_id}, Username: {username}\n"
 
     await update.message.reply_text(user_list)
@@ -224,19 +488,66 @@ async def send_user_list(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 def main() -> None:
     logger.info("Starting the bot")
 
-    telegram_bot_token: str = os.getenv(ENV_VAR_TELEGRAM_BOT_TOKEN, "")
-    if not telegram_bot_token:
+    if not telegram_config.token:
         logger.fatal(f"Environment variable {ENV_VAR_TELEGRAM_BOT_TOKEN} not set")
         return
 
-    global chatbot
-    chatbot = Chatbot()
+    # Validated here, the model itself loads while the bot connects
+    try:
+        chatbot_config: ChatbotConfig = ChatbotConfig.from_env()
+    except ConfigError as e:
+        logger.fatal(str(e))
+        return
+
+    # One message per chat at the model, as many chats as the batch holds
+    global admission
+    admission = ChatAdmission(
+        max_active=telegram_config.max_active_chats
+        or chatbot_config.max_batch_size * max(1, telegram_config.workers),
+        max_queued=telegram_config.max_queued_messages,
+        chat_queue_size=telegram_config.chat_queue_size,
+        rate=telegram_config.rate_limit,
+        burst=telegram_config.rate_burst,
+        priority_chat_ids=[
+            chat_id for chat_id in [telegram_config.superuser_chat_id] if chat_id
+        ],
+        coalesce=telegram_config.coalesce_messages,
+        coalesce_window=telegram_config.coalesce_window,
+    )
+
+    global pool
+    if telegram_config.workers > 0:
+        pool = WorkerPool(
+            chatbot_config,
+            telegram_config.workers,
+            # run_polling() stops on SIGINT like on Ctrl-C
+            on_failure=lambda: os.kill(os.getpid(), signal.SIGINT),
+        )
+        pool.start()
+        watch_admission(pool.metrics)
+        if chatbot_config.metrics_port > 0:
+            pool.metrics.serve(chatbot_config.metrics_port, chatbot_config.metrics_host)
+    else:
+        threading.Thread(
+            target=load_chatbot,
+            args=(chatbot_config,),
+            name="chatbot-loader",
+            daemon=True,
+        ).start()
 
-    # Load existing user data
-    load_user_data()
+    # Open the user registry; users are looked up on demand, not loaded here
+    global user_registry
+    user_registry = UserRegistry(telegram_config.user_data_file)
 
     # Create the Application and pass it your bot's token
-    application: Application = Application.builder().token(telegram_bot_token).build()
+    # Updates are processed one at a time unless told otherwise, which would
+    # serialize every chat behind whichever one is currently generating.
+    application: Application = (
+        Application.builder()
+        .token(telegram_config.token)
+        .concurrent_updates(True)
+        .build()
+    )
     logger.info("Application built successfully")
 
     # Add handlers
@@ -251,6 +562,14 @@ def main() -> None:
     logger.info("Starting to poll for updates")
     application.run_polling()
 
+    # Queued session store, response cache and registry writes would
+    # otherwise be lost
+    if chatbot is not None:
+        chatbot.close()
+    if pool is not None:
+        pool.close()
+    user_registry.close()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def tiny_model(tmp_path_factory):
+    # The benchmarks' tiny random model, built locally; skips without the
+    # model stack
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    from benchmarks.tiny_model import build_tiny_model
+
+    return build_tiny_model(str(tmp_path_factory.mktemp("tiny-model")))
+
+
+@pytest.fixture
+def make_chatbot(tiny_model, monkeypatch):
+    # Chatbot() on the tiny model, with settings on top of the test defaults;
+    # closed at the end of the test unless the test did
+    chatbots = []
+
+    def make(**env):
+        for name, value in {
+            "MODEL_NAME": tiny_model,
+            "CHAT_TEMPLATE": "chatml",
+            "DEVICE": "cpu",
+            **env,
+        }.items():
+            monkeypatch.setenv(name, value)
+
+        from chat import Chatbot
+
+        chatbot = Chatbot()
+        chatbots.append(chatbot)
+        return chatbot
+
+    yield make
+    for chatbot in chatbots:
+        chatbot.close()
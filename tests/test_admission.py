@@ -0,0 +1,285 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from admission import (
+    REJECT_BUSY,
+    REJECT_RATE_LIMITED,
+    AdmissionRejected,
+    ChatAdmission,
+)
+
+
+class StubModel:
+    """Holds a chat's slot for a while per turn, like a generation would."""
+
+    def __init__(self, admission, seconds=0.02):
+        self.admission = admission
+        self.seconds = seconds
+        # (chat_id, texts) of every turn, in the order they got the model
+        self.turns = []
+        self.waits = {}
+
+    async def send(self, chat_id, text):
+        try:
+            async with self.admission.slot(chat_id, text) as turn:
+                if not turn.texts:
+                    return "merged"
+                self.turns.append((chat_id, turn.texts))
+                self.waits.setdefault(chat_id, []).append(turn.waited)
+                await asyncio.sleep(self.seconds)
+                return "answered"
+        except AdmissionRejected as e:
+            return e.reason
+
+
+def test_spamming_chat_is_rate_limited_and_shed():
+    async def run():
+        admission = ChatAdmission(
+            max_active=1, max_queued=2, chat_queue_size=10, rate=0.5, burst=4
+        )
+        model = StubModel(admission)
+        # Some model time on the record, which is what gets it shed later
+        assert await model.send("spam", "0") == "answered"
+
+        spam = [
+            asyncio.create_task(model.send("spam", str(i))) for i in range(1, 6)
+        ]
+        await asyncio.sleep(0)
+        polite = asyncio.create_task(model.send("polite", "hi"))
+        results = await asyncio.gather(*spam)
+        return admission, model, results, await polite
+
+    admission, model, results, polite = asyncio.run(run())
+    # Three fit the rest of the burst, the newest waiting one makes room for
+    # the polite chat once the queue is full
+    assert results == [
+        "answered",
+        "answered",
+        REJECT_BUSY,
+        REJECT_RATE_LIMITED,
+        REJECT_RATE_LIMITED,
+    ]
+    assert polite == "answered"
+    # Spam message 1 already had the model; the polite chat goes next
+    assert [chat_id for chat_id, _ in model.turns] == [
+        "spam",
+        "spam",
+        "polite",
+        "spam",
+    ]
+    assert admission.rejected[REJECT_RATE_LIMITED] == 2
+    assert admission.rejected[REJECT_BUSY] == 1
+    assert admission.stats()["queued"] == 0
+    assert admission.stats()["active"] == 0
+
+
+def test_well_behaved_chat_waits_are_bounded_under_abuse():
+    turn_seconds = 0.02
+
+    async def run():
+        admission = ChatAdmission(max_active=1, max_queued=8, chat_queue_size=3)
+        model = StubModel(admission, turn_seconds)
+        end = time.monotonic() + 0.8
+        tasks = []
+
+        async def abuse(chat_id):
+            # A message every couple of milliseconds, replies or not
+            while time.monotonic() < end:
+                tasks.append(asyncio.create_task(model.send(chat_id, "spam")))
+                await asyncio.sleep(0.002)
+
+        async def behave():
+            # Once the abusers have used the model for a while, and less
+            # often than they get it each
+            results = []
+            await asyncio.sleep(0.2)
+            while time.monotonic() < end:
+                results.append(await model.send("polite", "hello"))
+                await asyncio.sleep(0.1)
+            return results
+
+        polite = asyncio.create_task(behave())
+        await asyncio.gather(*[abuse(f"abuser-{i}") for i in range(4)])
+        results = await polite
+        await asyncio.gather(*tasks)
+        return admission, model, results
+
+    admission, model, results = asyncio.run(run())
+    assert results and all(result == "answered" for result in results)
+    # At most the turn at the model when it arrived, plus scheduling noise;
+    # without fair share it would queue behind the abusers' messages
+    assert max(model.waits["polite"]) < 4 * turn_seconds
+    assert admission.rejected[REJECT_BUSY] > 0
+
+
+def test_superuser_is_admitted_first():
+    async def run():
+        admission = ChatAdmission(
+            max_active=1,
+            max_queued=2,
+            chat_queue_size=10,
+            rate=0.001,
+            burst=1,
+            priority_chat_ids=["root"],
+        )
+        model = StubModel(admission)
+        # Keeps the model busy while everybody else lines up
+        first = asyncio.create_task(model.send("first", "hi"))
+        await asyncio.sleep(0)
+        others = [
+            asyncio.create_task(model.send(f"user-{i}", "hi")) for i in range(2)
+        ]
+        await asyncio.sleep(0)
+        # Last in, with the queue full and beyond its rate: still first out,
+        # and nobody is pushed out for it either
+        root = [asyncio.create_task(model.send("root", str(i))) for i in range(2)]
+        return model, await asyncio.gather(first, *others, *root)
+
+    model, results = asyncio.run(run())
+    assert results == ["answered"] * 5
+    order = [chat_id for chat_id, _ in model.turns]
+    assert order[:3] == ["first", "root", "root"]
+    assert sorted(order[3:]) == ["user-0", "user-1"]
+
+
+def coalescing(window):
+    return ChatAdmission(
+        max_active=4,
+        max_queued=16,
+        chat_queue_size=8,
+        coalesce=True,
+        coalesce_window=window,
+    )
+
+
+def test_messages_inside_the_window_make_one_turn():
+    async def run():
+        admission = coalescing(0.05)
+        model = StubModel(admission)
+        first = asyncio.create_task(model.send("chat", "a"))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(model.send("chat", "b"))
+        await asyncio.sleep(0.01)
+        third = asyncio.create_task(model.send("chat", "c"))
+        return admission, model, await asyncio.gather(first, second, third)
+
+    admission, model, results = asyncio.run(run())
+    assert results == ["answered", "merged", "merged"]
+    assert model.turns == [("chat", ["a", "b", "c"])]
+    # The turn waited for the window to close
+    assert model.waits["chat"][0] >= 0.05
+    assert admission.merged == 2
+
+
+def test_messages_sent_during_a_reply_make_the_next_turn():
+    async def run():
+        admission = coalescing(0.0)
+        model = StubModel(admission, seconds=0.05)
+        first = asyncio.create_task(model.send("chat", "a"))
+        await asyncio.sleep(0.01)
+        # The reply to "a" is still being generated
+        later = [asyncio.create_task(model.send("chat", text)) for text in "bc"]
+        return model, await asyncio.gather(first, *later)
+
+    model, results = asyncio.run(run())
+    assert results == ["answered", "answered", "merged"]
+    assert model.turns == [("chat", ["a"]), ("chat", ["b", "c"])]
+
+
+def test_message_after_the_window_starts_a_new_turn():
+    async def run():
+        admission = coalescing(0.03)
+        model = StubModel(admission, seconds=0.01)
+        first = await model.send("chat", "a")
+        await asyncio.sleep(0.01)
+        second = await model.send("chat", "b")
+        return admission, model, [first, second]
+
+    admission, model, results = asyncio.run(run())
+    assert results == ["answered", "answered"]
+    assert model.turns == [("chat", ["a"]), ("chat", ["b"])]
+    assert admission.merged == 0
+
+
+def test_other_chats_are_not_merged():
+    async def run():
+        admission = coalescing(0.03)
+        model = StubModel(admission)
+        return model, await asyncio.gather(
+            model.send("one", "a"), model.send("two", "b")
+        )
+
+    model, results = asyncio.run(run())
+    assert results == ["answered", "answered"]
+    assert sorted(model.turns) == [("one", ["a"]), ("two", ["b"])]
+
+
+def test_telegram_handler_answers_a_burst_with_one_generation(tmp_path, monkeypatch):
+    pytest.importorskip("telegram")
+    monkeypatch.setenv("TELEGRAM_BOT_USER_DATA_FILE", str(tmp_path / "users.db"))
+    import telegram_chatbot
+    from metrics import Metrics
+
+    class StubChatbot:
+        def __init__(self):
+            self.metrics = Metrics()
+            self.prompts = []
+
+        async def agenerate_response(self, text, user_id=None):
+            self.prompts.append((user_id, text))
+            await asyncio.sleep(0.02)
+            return f"reply {len(self.prompts)}"
+
+    replies = []
+
+    def update_for(text):
+        async def reply_text(reply, **kwargs):
+            replies.append(reply)
+
+        return SimpleNamespace(
+            effective_chat=SimpleNamespace(id=1),
+            message=SimpleNamespace(text=text, reply_text=reply_text),
+        )
+
+    async def send_chat_action(**kwargs):
+        pass
+
+    context = SimpleNamespace(bot=SimpleNamespace(send_chat_action=send_chat_action))
+    stub = StubChatbot()
+    monkeypatch.setattr(telegram_chatbot, "chatbot", stub)
+    monkeypatch.setattr(telegram_chatbot, "pool", None)
+    monkeypatch.setattr(telegram_chatbot, "admission", coalescing(0.05))
+    monkeypatch.setattr(
+        telegram_chatbot,
+        "user_registry",
+        SimpleNamespace(get=lambda chat_id: "me", cached=lambda chat_id: None),
+    )
+
+    async def run():
+        handlers = []
+        for text in ["hi", "are you there", "hello?"]:
+            handlers.append(
+                asyncio.create_task(
+                    telegram_chatbot.handle_message(update_for(text), context)
+                )
+            )
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*handlers)
+        # After the window, and the reply, a turn of its own
+        await asyncio.sleep(0.06)
+        await telegram_chatbot.handle_message(update_for("bye"), context)
+
+    asyncio.run(run())
+    assert stub.prompts == [("1", "hi\nare you there\nhello?"), ("1", "bye")]
+    assert replies == ["reply 1", "reply 2"]
+
+
+def test_rate_limit_is_off_by_default(monkeypatch):
+    from config import TelegramConfig
+
+    monkeypatch.delenv("TELEGRAM_BOT_RATE_LIMIT", raising=False)
+    monkeypatch.setenv("TELEGRAM_BOT_USER_DATA_FILE", "users.sqlite3")
+    assert TelegramConfig.from_env().rate_limit == 0
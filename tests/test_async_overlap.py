@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def chatbot(make_chatbot):
+    # Both chats have to run the model
+    return make_chatbot(MAX_NEW_TOKENS="48", RESPONSE_CACHE_MAX_ENTRIES="0")
+
+
+def test_two_chats_generate_in_overlapping_time(chatbot):
+    requests = []
+    submit = chatbot.scheduler.submit
+
+    def recording_submit(request):
+        if request.streamer is not None:
+            requests.append(request)
+        return submit(request)
+
+    chatbot.scheduler.submit = recording_submit
+
+    async def run():
+        ticks = []
+
+        async def tick():
+            # Whatever else the event loop has to do meanwhile
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.001)
+
+        ticker = asyncio.create_task(tick())
+        replies = await asyncio.gather(
+            chatbot.agenerate_response("hello there", user_id="one"),
+            chatbot.agenerate_response("how are you", user_id="two"),
+        )
+        ticker.cancel()
+        return replies, ticks
+
+    try:
+        replies, ticks = asyncio.run(run())
+    finally:
+        chatbot.scheduler.submit = submit
+
+    assert len(replies) == 2
+    assert len(requests) == 2
+    first, second = requests
+    # Each one started producing tokens before the other was done
+    assert first.first_token_at < second.finished_at
+    assert second.first_token_at < first.finished_at
+
+    started = min(request.submitted_at for request in requests)
+    finished = max(request.finished_at for request in requests)
+    during = [at for at in ticks if started <= at <= finished]
+    assert len(during) >= 2
+    # The loop was never blocked for long while the model ran
+    gaps = [b - a for a, b in zip(ticks, ticks[1:])]
+    assert max(gaps) < 0.25
+
+    assert [m["role"] for m in chatbot.history.messages("one")] == [
+        "user",
+        "assistant",
+    ]
+
+
+def test_close_cancels_generation_and_stops_the_loop(make_chatbot):
+    chatbot = make_chatbot()
+    scheduler = chatbot.scheduler
+    from scheduler import FINISH_CANCELLED, GenerationRequest, SamplingParams
+
+    first_token = threading.Event()
+    closing = threading.Event()
+
+    class Gate:
+        # Holds the decode loop on the first token until close() has begun,
+        # so no reply can finish on its own first
+        def put(self, value):
+            first_token.set()
+            closing.wait()
+
+        def end(self):
+            pass
+
+    _, input_ids = chatbot.build_prompt(
+        [{"role": "user", "content": "tell me a long story"}], ""
+    )
+    params = SamplingParams(
+        max_new_tokens=64, temperature=0, top_p=1.0, top_k=0, repetition_penalty=1.0
+    )
+    running = scheduler.submit(GenerationRequest(input_ids, params, Gate()))
+    assert first_token.wait(60)
+    queued = [
+        scheduler.submit(GenerationRequest(input_ids, params, None)) for _ in range(3)
+    ]
+
+    closer = threading.Thread(target=scheduler.close)
+    closer.start()
+    while not scheduler._closed.is_set():
+        time.sleep(0.001)
+    closing.set()
+    closer.join(60)
+
+    assert not closer.is_alive()
+    assert not scheduler._thread.is_alive()
+    for request in [running, *queued]:
+        assert request.done.is_set()
+        assert request.finish_reason == FINISH_CANCELLED
+    assert len(running.output_ids) == 1
+    assert not any(request.output_ids for request in queued)
+    with pytest.raises(RuntimeError):
+        chatbot.submit_request("too late", "one")
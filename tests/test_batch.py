@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("torch")
+
+from batch import prepare_row  # noqa: E402
+
+chatbot = SimpleNamespace(
+    max_new_tokens=64,
+    temperature=0.7,
+    top_p=0.9,
+    top_k=40,
+    repetition_penalty=1.1,
+    stop_strings=(),
+    adapters=None,
+    context_token_budget=1024,
+    build_prompt=lambda messages, system_message: ("", [1, 2, 3]),
+)
+
+
+def params(**overrides):
+    _, sampling, _ = prepare_row(chatbot, {"prompt": "hi", "params": overrides})
+    return sampling
+
+
+def test_do_sample_takes_json_booleans_and_their_strings():
+    assert params(do_sample=False).do_sample is False
+    assert params(do_sample=True).do_sample is True
+    assert params(do_sample="false").do_sample is False
+    assert params(do_sample="True").do_sample is True
+
+    for value in ["no", 0, 1, None]:
+        with pytest.raises(ValueError):
+            params(do_sample=value)
+
+
+def test_integer_params_take_integral_numbers_only():
+    assert params(top_k=10).top_k == 10
+    assert params(max_new_tokens=32.0).max_new_tokens == 32
+
+    for value in [3.7, "12", True, None]:
+        with pytest.raises(ValueError):
+            params(top_k=value)
+        with pytest.raises(ValueError):
+            params(max_new_tokens=value)
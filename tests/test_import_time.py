@@ -0,0 +1,18 @@
+import importlib.util
+
+import pytest
+
+from benchmarks.import_time import MODULES, measure
+
+# Generous for a loaded CI runner; importing torch alone takes longer
+MAX_SECONDS = 2.0
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_entry_point_imports_no_model_stack(module):
+    if module == "telegram_chatbot" and importlib.util.find_spec("telegram") is None:
+        pytest.skip("python-telegram-bot not installed")
+
+    result = measure(module, repeat=1)
+    assert result["heavy_modules"] == []
+    assert result["seconds"] < MAX_SECONDS
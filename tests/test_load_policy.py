@@ -0,0 +1,168 @@
+from load_policy import (
+    BATCH_GAIN,
+    MIN_SAMPLES,
+    RELAX_BELOW,
+    WINDOW_INTERVALS,
+    Limits,
+    LoadPolicy,
+)
+
+CONFIGURED = Limits(max_new_tokens=256, prompt_tokens=2048, batch_size=8)
+TARGET = 2.0
+
+
+def policy(max_batch_size=0):
+    return LoadPolicy(
+        1.0, min_new_tokens=64, min_prompt_tokens=512, max_batch_size=max_batch_size
+    )
+
+
+def finish(policy, at, latency, count=MIN_SAMPLES, tokens=10):
+    for _ in range(count):
+        policy.observe(at, latency, tokens)
+
+
+def steady(policy, tokens):
+    # A full window of requests a bit under the target, which neither cuts
+    # nor restores anything, so tokens/sec is measured over all of it
+    policy.update(0.0, TARGET, 0, CONFIGURED)
+    now = 0.0
+    for _ in range(WINDOW_INTERVALS):
+        now += 1.0
+        finish(policy, now - 0.5, TARGET * (1 + RELAX_BELOW) / 2, tokens=tokens)
+        policy.update(now, TARGET, 0, CONFIGURED)
+    assert policy.level == 1.0
+    return now
+
+
+def assert_within_bounds(limits):
+    assert 64 <= limits.max_new_tokens <= CONFIGURED.max_new_tokens
+    assert 512 <= limits.prompt_tokens <= CONFIGURED.prompt_tokens
+    assert limits.batch_size >= CONFIGURED.batch_size
+
+
+def test_off_without_a_target():
+    load_policy = policy()
+    finish(load_policy, 0.5, 10.0)
+    assert load_policy.update(0.0, 0.0, 100, CONFIGURED) == CONFIGURED
+    assert load_policy.update(5.0, 0.0, 100, CONFIGURED) == CONFIGURED
+    assert load_policy.adjustments == 0
+
+
+def test_slow_requests_lower_the_level():
+    load_policy = policy()
+    assert load_policy.update(0.0, TARGET, 0, CONFIGURED) == CONFIGURED
+
+    finish(load_policy, 0.5, TARGET * 2)
+    limits = load_policy.update(1.0, TARGET, 0, CONFIGURED)
+    assert load_policy.level < 1.0
+    assert limits.max_new_tokens < CONFIGURED.max_new_tokens
+    assert limits.prompt_tokens < CONFIGURED.prompt_tokens
+    assert load_policy.adjustments == 1
+
+
+def test_a_queued_batch_lowers_the_level_without_latencies():
+    load_policy = policy()
+    load_policy.update(0.0, TARGET, 0, CONFIGURED)
+    load_policy.update(1.0, TARGET, CONFIGURED.batch_size, CONFIGURED)
+    assert load_policy.level < 1.0
+
+
+def test_adjusts_at_most_once_per_interval():
+    load_policy = policy()
+    load_policy.update(0.0, TARGET, 0, CONFIGURED)
+    finish(load_policy, 0.5, TARGET * 2)
+    load_policy.update(1.0, TARGET, 0, CONFIGURED)
+    level = load_policy.level
+    load_policy.update(1.5, TARGET, 0, CONFIGURED)
+    assert load_policy.level == level
+
+
+def test_level_recovers_once_latency_is_well_under_the_target():
+    load_policy = policy()
+    load_policy.update(0.0, TARGET, 0, CONFIGURED)
+    now = 0.0
+    for _ in range(4):
+        now += 1.0
+        finish(load_policy, now - 0.5, TARGET * 2)
+        load_policy.update(now, TARGET, 0, CONFIGURED)
+    assert load_policy.level == 0.0
+
+    # Under the target but not by RELAX_BELOW: held where it is
+    now += WINDOW_INTERVALS + 1.0
+    finish(load_policy, now - 0.5, TARGET * (1 + RELAX_BELOW) / 2)
+    load_policy.update(now, TARGET, 0, CONFIGURED)
+    assert load_policy.level == 0.0
+
+    for _ in range(30):
+        now += 1.0
+        finish(load_policy, now - 0.5, TARGET * RELAX_BELOW / 2)
+        limits = load_policy.update(now, TARGET, 0, CONFIGURED)
+    assert load_policy.level == 1.0
+    assert limits == CONFIGURED
+
+
+def test_bigger_batch_is_reverted_when_throughput_does_not_follow():
+    load_policy = policy(max_batch_size=32)
+    now = steady(load_policy, tokens=100)
+
+    # Overloaded with a queue: the batch grows
+    now += 1.0
+    finish(load_policy, now - 0.5, TARGET * 2, tokens=100)
+    grown = load_policy.update(now, TARGET, 20, CONFIGURED)
+    assert grown.batch_size > CONFIGURED.batch_size
+
+    # The same tokens/sec for as long as the window takes to fill up
+    for _ in range(WINDOW_INTERVALS):
+        now += 1.0
+        finish(load_policy, now - 0.5, TARGET * 2, tokens=100)
+        limits = load_policy.update(now, TARGET, 20, CONFIGURED)
+    assert limits.batch_size == CONFIGURED.batch_size
+
+
+def test_bigger_batch_is_kept_when_throughput_follows():
+    load_policy = policy(max_batch_size=32)
+    now = steady(load_policy, tokens=100)
+    now += 1.0
+    finish(load_policy, now - 0.5, TARGET * 2, tokens=100)
+    grown = load_policy.update(now, TARGET, 20, CONFIGURED)
+    assert grown.batch_size > CONFIGURED.batch_size
+
+    tokens = 100
+    for _ in range(WINDOW_INTERVALS):
+        now += 1.0
+        tokens = int(tokens * BATCH_GAIN * 2)
+        finish(load_policy, now - 0.5, TARGET * 2, tokens=tokens)
+        limits = load_policy.update(now, TARGET, 20, CONFIGURED)
+    assert limits.batch_size >= grown.batch_size
+
+
+def test_limits_stay_within_bounds():
+    load_policy = policy(max_batch_size=16)
+    load_policy.update(0.0, TARGET, 0, CONFIGURED)
+    now = 0.0
+    # A long peak, then a long quiet spell
+    for step in range(60):
+        now += 1.0
+        overloaded = step < 30
+        finish(
+            load_policy,
+            now - 0.5,
+            TARGET * (3 if overloaded else 0.1),
+            tokens=50 + step,
+        )
+        limits = load_policy.update(now, TARGET, 40 if overloaded else 0, CONFIGURED)
+        assert_within_bounds(limits)
+        assert limits.batch_size <= 16
+        assert 0.0 <= load_policy.level <= 1.0
+    assert limits == CONFIGURED
+
+
+def test_configured_limits_below_the_minimums_win():
+    load_policy = policy()
+    small = Limits(max_new_tokens=32, prompt_tokens=256, batch_size=4)
+    load_policy.update(0.0, TARGET, 0, small)
+    finish(load_policy, 0.5, TARGET * 2)
+    limits = load_policy.update(1.0, TARGET, 10, small)
+    assert limits.max_new_tokens == 32
+    assert limits.prompt_tokens == 256
@@ -0,0 +1,69 @@
+import threading
+import time
+
+from response_cache import ResponseCache
+
+
+def test_disk_hit_keeps_its_expiry(tmp_path, monkeypatch):
+    path = str(tmp_path / "responses.db")
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+
+    cache = ResponseCache(16, ttl=1.0, path=path)
+    cache.put("key", [1, 2, 3])
+    cache.close()
+
+    cache = ResponseCache(16, ttl=1.0, path=path)
+    now[0] += 0.6
+    assert cache.get("key") == [1, 2, 3]
+    assert cache.disk_hits == 1
+
+    # Served from memory now, but still only until it was stored + ttl
+    now[0] += 0.6
+    assert cache.get("key") is None
+    cache.close()
+
+
+def test_pending_reply_is_served_before_the_flush(tmp_path):
+    cache = ResponseCache(0, path=str(tmp_path / "responses.db"))
+    cache.put("key", [4, 5])
+    assert cache.get("key") == [4, 5]
+    cache.close()
+
+    cache = ResponseCache(0, path=str(tmp_path / "responses.db"))
+    assert cache.get("key") == [4, 5]
+    cache.close()
+
+
+def test_put_does_not_wait_for_the_disk(tmp_path):
+    cache = ResponseCache(0, path=str(tmp_path / "responses.db"))
+    writing = threading.Event()
+    release = threading.Event()
+    write = cache._write
+
+    def slow_write(entries):
+        writing.set()
+        release.wait(5)
+        write(entries)
+
+    cache._write = slow_write
+    cache.put("first", [1])
+    flusher = threading.Thread(target=cache.flush)
+    flusher.start()
+    assert writing.wait(5)
+
+    started = time.perf_counter()
+    cache.put("second", [2])
+    assert time.perf_counter() - started < 1
+    # Both still answer while the first is being written
+    assert cache.get("first") == [1]
+    assert cache.get("second") == [2]
+
+    release.set()
+    flusher.join()
+    cache.close()
+
+    cache = ResponseCache(0, path=str(tmp_path / "responses.db"))
+    assert cache.get("first") == [1]
+    assert cache.get("second") == [2]
+    cache.close()
@@ -0,0 +1,26 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("torch")
+
+from scheduler import (  # noqa: E402
+    FINISH_CANCELLED,
+    FINISH_LENGTH,
+    FINISH_STOP,
+    FINISH_TIMEOUT,
+)
+from server import _finish_reason  # noqa: E402
+
+
+def test_finish_reasons_are_openai_ones():
+    reasons = {
+        reason: _finish_reason(SimpleNamespace(finish_reason=reason))
+        for reason in [FINISH_STOP, FINISH_LENGTH, FINISH_TIMEOUT, FINISH_CANCELLED]
+    }
+    assert reasons == {
+        FINISH_STOP: "stop",
+        FINISH_LENGTH: "length",
+        FINISH_TIMEOUT: "length",
+        FINISH_CANCELLED: "stop",
+    }
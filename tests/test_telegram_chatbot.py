@@ -0,0 +1,66 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("telegram")
+
+
+@pytest.fixture
+def telegram_chatbot(tmp_path, monkeypatch):
+    monkeypatch.setenv("TELEGRAM_BOT_USER_DATA_FILE", str(tmp_path / "users.db"))
+    import telegram_chatbot
+
+    monkeypatch.setattr(telegram_chatbot, "pool", None)
+    return telegram_chatbot
+
+
+def test_chatbot_calls_run_off_the_event_loop(telegram_chatbot, monkeypatch):
+    threads = []
+
+    class StubChatbot:
+        def set_parameter(self, name, value):
+            threads.append(threading.get_ident())
+
+        def clear_history(self, user_id):
+            threads.append(threading.get_ident())
+
+    monkeypatch.setattr(telegram_chatbot, "chatbot", StubChatbot())
+
+    async def run():
+        await telegram_chatbot.call_every_chatbot("set_parameter", "debug", "true")
+        await telegram_chatbot.call_chatbot("1", "clear_history", "1")
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+    assert len(threads) == 2
+    assert loop_thread not in threads
+
+
+def test_user_lookups_keep_the_order_of_messages(telegram_chatbot, monkeypatch):
+    class SlowRegistry:
+        # The first lookup is the slowest, they must still finish in order
+        def __init__(self):
+            self.delays = [0.05, 0.0, 0.0]
+
+        def cached(self, chat_id):
+            return None
+
+        def get(self, chat_id):
+            time.sleep(self.delays.pop(0))
+            return "me"
+
+    monkeypatch.setattr(telegram_chatbot, "user_registry", SlowRegistry())
+
+    async def run():
+        order = []
+
+        async def lookup(index):
+            assert await telegram_chatbot.lookup_user("1") == "me"
+            order.append(index)
+
+        await asyncio.gather(*[lookup(index) for index in range(3)])
+        return order
+
+    assert asyncio.run(run()) == [0, 1, 2]
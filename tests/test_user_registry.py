@@ -0,0 +1,43 @@
+import threading
+import time
+
+from user_registry import UserRegistry
+
+
+def test_registrations_survive_a_restart(tmp_path):
+    path = str(tmp_path / "users.db")
+    registry = UserRegistry(path)
+    registry.register("1", "alice")
+    assert registry.get("1") == "alice"
+    registry.close()
+
+    registry = UserRegistry(path)
+    assert registry.cached("1") is None
+    assert registry.get("1") == "alice"
+    assert registry.cached("1") == "alice"
+    assert list(registry.items()) == [("1", "alice")]
+    registry.close()
+
+
+def test_memory_lookups_do_not_wait_for_a_commit(tmp_path):
+    registry = UserRegistry(str(tmp_path / "users.db"))
+    registry.register("1", "alice")
+    registry.flush()
+
+    # Something holding the connection, like a slow group commit
+    with registry._db_lock:
+        started = time.perf_counter()
+        registry.register("2", "bob")
+        assert registry.cached("1") == "alice"
+        assert registry.get("2") == "bob"
+        assert time.perf_counter() - started < 1
+
+        # A miss does wait for the disk
+        missed = []
+        lookup = threading.Thread(target=lambda: missed.append(registry.get("3")))
+        lookup.start()
+        lookup.join(0.1)
+        assert lookup.is_alive()
+    lookup.join()
+    assert missed == [None]
+    registry.close()
@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+from worker_pool import _generate
+
+
+class StubStreamer:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def text(self):
+        return "".join(self.chunks)
+
+
+class StubChatbot:
+    def __init__(self, recorded):
+        self.recorded = recorded
+
+    def submit_request(self, text, user_id):
+        return SimpleNamespace(streamer=StubStreamer(["Hel", "lo "]))
+
+    def record_response(self, user_id, request, response):
+        return self.recorded(response)
+
+
+def test_done_carries_the_recorded_reply():
+    sent = []
+    _generate(StubChatbot(str.strip), lambda *m: sent.append(m), 7, "chat", "hi")
+    assert sent == [("token", 7, "Hel"), ("token", 7, "lo "), ("done", 7, "Hello")]
+
+
+def test_cancelled_reply_is_done_empty():
+    # record_response returns "" for a reply /clear or a newer message
+    # cancelled; the front end must not send what streamed before that
+    sent = []
+    _generate(StubChatbot(lambda response: ""), lambda *m: sent.append(m), 1, "c", "x")
+    assert sent[-1] == ("done", 1, "")
+
+
+def test_errors_are_reported():
+    class Failing(StubChatbot):
+        def submit_request(self, text, user_id):
+            raise ValueError("boom")
+
+    sent = []
+    _generate(Failing(str.strip), lambda *m: sent.append(m), 2, "c", "x")
+    assert sent == [("error", 2, "boom")]
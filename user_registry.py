@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+# Where the database goes when the configured file is a legacy JSON registry
+MIGRATED_SUFFIX = ".sqlite3"
+
+
+class UserRegistry:
+    """
+    chat_id -> username registry in an SQLite database (WAL mode). Nothing is
+    read at startup; users are looked up on demand and the most recent ones
+    are kept in memory. Registrations are visible immediately and committed by
+    a background thread that groups whatever has queued up into a single
+    transaction, so the caller (the bot's event loop) never waits on disk.
+    """
+
+    def __init__(self, path: str, max_cached: int = 100_000) -> None:
+        self.path = path
+        self.max_cached = max_cached
+
+        legacy_json: Optional[str] = None
+        if _is_legacy_json(path):
+            legacy_json = path
+            self.path = path + MIGRATED_SUFFIX
+
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "chat_id TEXT PRIMARY KEY, username TEXT NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self._connection.commit()
+        # _lock guards the memory tier and is never held waiting for the
+        # disk; _db_lock serializes use of the connection
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+
+        if legacy_json is not None:
+            self._migrate(legacy_json)
+
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        # Registered but not committed yet
+        self._unflushed: Dict[str, str] = {}
+        self._queue: "queue.Queue[Optional[Tuple[str, str]]]" = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def get(self, chat_id: str) -> Optional[str]:
+        username = self.cached(chat_id)
+        if username is not None:
+            return username
+
+        with self._db_lock:
+            row = self._connection.execute(
+                "SELECT username FROM users WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        with self._lock:
+            # Registered again while we were reading
+            username = self._unflushed.get(chat_id, row[0])
+            self._remember(chat_id, username)
+        return username
+
+    def cached(self, chat_id: str) -> Optional[str]:
+        # get() without the disk: None when the user isn't in memory
+        with self._lock:
+            username = self._unflushed.get(chat_id)
+            if username is not None:
+                return username
+
+            username = self._cache.get(chat_id)
+            if username is not None:
+                self._cache.move_to_end(chat_id)
+            return username
+
+    def __contains__(self, chat_id: str) -> bool:
+        return self.get(chat_id) is not None
+
+    def register(self, chat_id: str, username: str) -> None:
+        with self._lock:
+            self._unflushed[chat_id] = username
+            self._remember(chat_id, username)
+        self._queue.put((chat_id, username))
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        self.flush()
+        with self._db_lock:
+            rows = self._connection.execute(
+                "SELECT chat_id, username FROM users ORDER BY rowid"
+            ).fetchall()
+        return iter(rows)
+
+    def __len__(self) -> int:
+        self.flush()
+        with self._db_lock:
+            return self._connection.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def flush(self) -> None:
+        self._queue.join()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._writer.join()
+        with self._db_lock:
+            self._connection.close()
+
+    def _remember(self, chat_id: str, username: str) -> None:
+        self._cache[chat_id] = username
+        self._cache.move_to_end(chat_id)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    def _write_loop(self) -> None:
+        while True:
+            first = self._queue.get()
+            batch: List[Optional[Tuple[str, str]]] = [first]
+            # Group commit: everything queued while the previous transaction
+            # was being written goes into this one.
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            registrations = [item for item in batch if item is not None]
+            try:
+                with self._db_lock:
+                    with self._connection:
+                        self._connection.executemany(
+                            "INSERT OR REPLACE INTO users (chat_id, username) "
+                            "VALUES (?, ?)",
+                            registrations,
+                        )
+                with self._lock:
+                    for chat_id, username in registrations:
+                        if self._unflushed.get(chat_id) == username:
+                            del self._unflushed[chat_id]
+            except sqlite3.Error as e:
+                logger.error(f"Failed to write {len(registrations)} users: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+            if len(registrations) < len(batch):
+                return
+
+    def _migrate(self, legacy_json: str) -> None:
+        migrated = self._connection.execute(
+            "SELECT value FROM meta WHERE key = 'migrated_from'"
+        ).fetchone()
+        if migrated is not None:
+            return
+
+        with open(legacy_json, "r") as f:
+            user_data: Dict[str, str] = json.load(f)
+
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO users (chat_id, username) VALUES (?, ?)",
+                user_data.items(),
+            )
+            self._connection.execute(
+                "INSERT INTO meta (key, value) VALUES ('migrated_from', ?)",
+                (legacy_json,),
+            )
+        logger.info(
+            f"Migrated {len(user_data)} users from {legacy_json} to {self.path}"
+        )
+
+
+def _is_legacy_json(path: str) -> bool:
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return False
+
+    with open(path, "rb") as f:
+        header = f.read(len(SQLITE_HEADER))
+    return header != SQLITE_HEADER and header.lstrip()[:1] == b"{"
@@ -0,0 +1,548 @@
+import asyncio
+import bisect
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from dataclasses import replace
+from multiprocessing.connection import Connection
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+
+from config import ChatbotConfig
+from cpu import pin_process, share_cores
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+# Points each worker gets on the hash ring; more points, more even shares
+HASH_RING_REPLICAS = 64
+# How often workers report their load to the pool
+LOAD_REPORT_INTERVAL = 1.0
+# Pause before a worker that died is started again
+WORKER_RESTART_DELAY = 1.0
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto nodes. Every node owns the arcs ending
+    at its points on the ring, so removing a node only moves the keys it
+    owned (to the nodes next to them) and adding it back returns exactly
+    those keys. Hashes come from blake2b, which unlike hash() is the same in
+    every process and every run.
+    """
+
+    def __init__(self, replicas: int = HASH_RING_REPLICAS) -> None:
+        self.replicas = replicas
+        self._points: List[int] = []
+        self._nodes: Dict[int, int] = {}
+
+    def add(self, node: int) -> None:
+        for replica in range(self.replicas):
+            point = _hash(f"{node}:{replica}")
+            if point not in self._nodes:
+                bisect.insort(self._points, point)
+                self._nodes[point] = node
+
+    def remove(self, node: int) -> None:
+        self._points = [p for p in self._points if self._nodes[p] != node]
+        self._nodes = {p: n for p, n in self._nodes.items() if n != node}
+
+    def get(self, key: str) -> Optional[int]:
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._nodes[self._points[index]]
+
+    def nodes(self) -> List[int]:
+        return sorted(set(self._nodes.values()))
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def invoke(target: Any, name: str, *args: Any) -> Any:
+    # Calls a method of target by its (dotted) name, e.g. "history.messages",
+    # or returns the attribute when it is not callable
+    attribute = target
+    for part in name.split("."):
+        attribute = getattr(attribute, part)
+    return attribute(*args) if callable(attribute) else attribute
+
+
+class _Worker:
+    def __init__(
+        self, index: int, process: Any, connection: Connection, started: float
+    ) -> None:
+        self.index = index
+        self.process = process
+        self.connection = connection
+        self.started = started
+        self.send_lock = threading.Lock()
+        self.ready: bool = False
+        self.pid: int = process.pid
+        # Last load report from the worker itself
+        self.load: Dict[str, float] = {}
+        # Requests the pool sent it that have not finished
+        self.in_flight: int = 0
+
+    def send(self, *message: Any) -> None:
+        with self.send_lock:
+            self.connection.send(message)
+
+
+class _PendingRequest:
+    def __init__(self, worker: _Worker, loop: asyncio.AbstractEventLoop) -> None:
+        self.worker = worker
+        self.loop = loop
+        self.queue: "asyncio.Queue[Tuple[str, Any]]" = asyncio.Queue()
+
+    def put(self, kind: str, value: Any) -> None:
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (kind, value))
+
+
+class WorkerPool:
+    """
+    Several model worker processes, each owning a Chatbot, behind one front
+    end. Every chat is routed to a worker by consistent hashing of its id,
+    so its history and KV caches stay with one worker. Requests and streamed
+    tokens travel as small pickled tuples over one OS pipe per worker.
+
+    A worker that dies leaves the hash ring right away (its chats move to
+    the neighbouring workers, everybody else stays put) and is started
+    again; once it is ready it takes its chats back. A worker that fails to
+    start is not retried.
+    """
+
+    def __init__(
+        self,
+        config: ChatbotConfig,
+        workers: int,
+        on_failure: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.config = config
+        self.size = workers
+        # Called once no worker is left that is running or starting
+        self.on_failure = on_failure
+        # Metrics of the front end; every worker keeps its own
+        self.metrics: Metrics = Metrics()
+
+        self._context = multiprocessing.get_context("spawn")
+        self._ring = HashRing()
+        self._workers: Dict[int, _Worker] = {}
+        self._pending: Dict[int, _PendingRequest] = {}
+        # Worker each chat was last routed to
+        self._owners: Dict[str, int] = {}
+        # Latest call_all per method and first argument, replayed to workers
+        # that start later so a restart doesn't undo /temp or /system
+        self._settings: Dict[Tuple[str, Any], Tuple[Any, ...]] = {}
+        self._request_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        # Workers of the first start that are neither ready nor failed yet
+        self._booting: Set[int] = set(range(workers))
+        self._failed: bool = False
+        self._closing: bool = False
+
+        self.metrics.gauge(
+            "workers_ready", "Workers serving requests", lambda: len(self._ring.nodes())
+        )
+        for index in range(workers):
+            self.metrics.gauge(
+                f"worker_{index}_in_flight",
+                f"Requests in flight on worker {index}",
+                lambda index=index: self._in_flight(index),
+            )
+            self.metrics.gauge(
+                f"worker_{index}_batch_size",
+                f"Rows in the running batch of worker {index}, as last reported",
+                lambda index=index: self._load(index, "batch_size"),
+            )
+
+    def start(self) -> None:
+        for index in range(self.size):
+            self._start_worker(index)
+
+    def close(self) -> None:
+        self._closing = True
+        with self._lock:
+            workers = list(self._workers.values())
+        for worker in workers:
+            try:
+                worker.send("stop")
+            except OSError:
+                pass
+        # Workers flush their session stores and caches before they exit
+        for worker in workers:
+            worker.process.join(timeout=30)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+    async def astream_response(
+        self, user_input: str, user_id: str | None = None
+    ) -> AsyncIterator[str]:
+        worker = await self._route(user_id)
+        async for kind, value in self._exchange(
+            worker, "generate", user_id, user_input
+        ):
+            if kind == "token":
+                yield value
+
+    async def agenerate_response(
+        self, user_input: str, user_id: str | None = None
+    ) -> str:
+        # What the worker recorded, not the tokens that arrived: empty for a
+        # reply cancelled by /clear or a newer message, like Chatbot's
+        worker = await self._route(user_id)
+        response: str = ""
+        async for kind, value in self._exchange(
+            worker, "generate", user_id, user_input
+        ):
+            if kind == "done":
+                response = value
+        return response
+
+    async def call(self, user_id: str | None, name: str, *args: Any) -> Any:
+        # Chatbot method (see invoke) run by the worker owning user_id
+        worker = await self._route(user_id)
+        return await self._call(worker, name, *args)
+
+    async def call_all(self, name: str, *args: Any) -> List[Any]:
+        # Settings like the temperature apply to every worker
+        await self._wait_ready()
+        with self._lock:
+            self._settings[(name, args[0] if args else None)] = args
+            workers = [self._workers[index] for index in self._ring.nodes()]
+        return list(
+            await asyncio.gather(
+                *[self._call(worker, name, *args) for worker in workers]
+            )
+        )
+
+    async def format_stats(self) -> str:
+        await self._wait_ready()
+        with self._lock:
+            workers = sorted(self._workers.values(), key=lambda w: w.index)
+
+        # The front end only records the Telegram side and the workers
+        sections: List[str] = [self.metrics.format(("telegram_", "worker"))]
+        for worker in workers:
+            header = f"Worker {worker.index} (pid {worker.pid}): "
+            if not worker.ready:
+                sections.append(header + "starting")
+                continue
+            load = worker.load
+            header += (
+                f"{worker.in_flight} in flight, "
+                f"batch {load.get('batch_size', 0):g}, "
+                f"queue {load.get('queue_depth', 0):g}, "
+                f"{load.get('generated_tokens', 0):g} tokens generated"
+            )
+            try:
+                sections.append(
+                    header + "\n" + await self._call(worker, "format_stats")
+                )
+            except RuntimeError as e:
+                sections.append(f"{header}\n{e}")
+        return "\n\n".join(sections)
+
+    async def format_each(self, name: str) -> str:
+        # A report method of every worker's Chatbot, e.g. format_policy
+        await self._wait_ready()
+        with self._lock:
+            workers = sorted(self._workers.values(), key=lambda w: w.index)
+
+        sections: List[str] = []
+        for worker in workers:
+            header = f"Worker {worker.index} (pid {worker.pid})"
+            if not worker.ready:
+                sections.append(f"{header}: starting")
+                continue
+            try:
+                sections.append(f"{header}:\n{await self._call(worker, name)}")
+            except RuntimeError as e:
+                sections.append(f"{header}:\n{e}")
+        return "\n\n".join(sections)
+
+    def _in_flight(self, index: int) -> float:
+        worker = self._workers.get(index)
+        return worker.in_flight if worker is not None else 0
+
+    def _load(self, index: int, name: str) -> float:
+        worker = self._workers.get(index)
+        return worker.load.get(name, 0) if worker is not None else 0
+
+    def _start_worker(self, index: int) -> None:
+        config = self.config
+        if config.metrics_port > 0:
+            # The front end serves the configured port
+            config = replace(config, metrics_port=config.metrics_port + 1 + index)
+
+        connection, worker_connection = self._context.Pipe()
+        process = self._context.Process(
+            target=_serve,
+            args=(index, self.size, config, worker_connection),
+            name=f"chatbot-worker-{index}",
+        )
+        process.start()
+        # Only the worker's copy stays open, so its exit ends our reads
+        worker_connection.close()
+
+        worker = _Worker(index, process, connection, time.perf_counter())
+        with self._lock:
+            self._workers[index] = worker
+        logger.info(f"Started worker {index} (pid {worker.pid})")
+        threading.Thread(
+            target=self._read,
+            args=(worker,),
+            name=f"worker-{index}-reader",
+            daemon=True,
+        ).start()
+
+    def _read(self, worker: _Worker) -> None:
+        while True:
+            try:
+                kind, *payload = worker.connection.recv()
+            except (EOFError, OSError):
+                break
+
+            if kind == "ready":
+                with self._lock:
+                    # Ahead of any request, the pipe keeps them in order
+                    for (name, _), args in self._settings.items():
+                        worker.send("call", None, name, args)
+                    worker.ready = True
+                    self._ring.add(worker.index)
+                    self._booting.discard(worker.index)
+                    self._update_ready()
+                logger.info(
+                    f"Worker {worker.index} ready in "
+                    f"{time.perf_counter() - worker.started:.2f}s"
+                )
+            elif kind == "load":
+                worker.load = payload[0]
+            else:
+                request_id, value = payload
+                with self._lock:
+                    pending = self._pending.get(request_id)
+                if pending is not None:
+                    pending.put(kind, value)
+
+        self._on_exit(worker)
+
+    def _on_exit(self, worker: _Worker) -> None:
+        worker.process.join()
+        with self._lock:
+            self._ring.remove(worker.index)
+            if not worker.ready:
+                self._booting.discard(worker.index)
+            self._update_ready()
+            failed = [
+                pending
+                for pending in self._pending.values()
+                if pending.worker is worker
+            ]
+        for pending in failed:
+            pending.put("error", f"worker {worker.index} exited")
+
+        if self._closing:
+            return
+
+        if worker.ready:
+            logger.error(
+                f"Worker {worker.index} exited with code {worker.process.exitcode}, "
+                "restarting it"
+            )
+            time.sleep(WORKER_RESTART_DELAY)
+            self._start_worker(worker.index)
+            return
+
+        logger.error(
+            f"Worker {worker.index} failed to start "
+            f"(exit code {worker.process.exitcode})"
+        )
+        with self._lock:
+            if any(w.process.is_alive() for w in self._workers.values()):
+                return
+            self._failed = True
+            # Wakes up whoever waits for a worker, to find out there is none
+            self._update_ready()
+        if self.on_failure is not None:
+            self.on_failure()
+
+    def _update_ready(self) -> None:
+        # Requests wait until every worker of the first start is up (or has
+        # failed): routed to the early ones, chats would move again as soon
+        # as the rest is ready
+        if self._failed or (self._ring.nodes() and not self._booting):
+            self._ready.set()
+        else:
+            self._ready.clear()
+
+    async def _wait_ready(self) -> None:
+        if not self._ready.is_set():
+            await asyncio.to_thread(self._ready.wait)
+        if self._failed:
+            raise RuntimeError("No chatbot worker could be started")
+
+    async def _route(self, user_id: str | None) -> _Worker:
+        while True:
+            await self._wait_ready()
+            key = user_id if user_id is not None else ""
+            with self._lock:
+                index = self._ring.get(key)
+                if index is None:
+                    # The last ready worker just exited
+                    continue
+                worker = self._workers[index]
+                previous = self._owners.get(key)
+                self._owners[key] = index
+                previous_worker = (
+                    self._workers.get(previous) if previous != index else None
+                )
+
+            # A chat has one home at a time: the worker it moved away from
+            # drops its copy, so moving back later never finds a stale one
+            if previous_worker is not None and previous_worker.ready:
+                try:
+                    previous_worker.send("call", None, "history.forget", (user_id,))
+                except OSError:
+                    pass
+            return worker
+
+    async def _call(self, worker: _Worker, name: str, *args: Any) -> Any:
+        result: Any = None
+        async for _, result in self._exchange(worker, "call", name, args):
+            pass
+        return result
+
+    async def _exchange(
+        self, worker: _Worker, kind: str, *payload: Any
+    ) -> AsyncIterator[Tuple[str, Any]]:
+        # Yields ("token", text) as the worker streams, then ("done", result);
+        # an error reply is raised
+        request_id = next(self._request_ids)
+        pending = _PendingRequest(worker, asyncio.get_running_loop())
+        with self._lock:
+            self._pending[request_id] = pending
+            worker.in_flight += 1
+        try:
+            worker.send(kind, request_id, *payload)
+            while True:
+                reply, value = await pending.queue.get()
+                if reply == "error":
+                    raise RuntimeError(value)
+                yield reply, value
+                if reply == "done":
+                    return
+        except OSError as e:
+            raise RuntimeError(f"worker {worker.index} is gone: {e}")
+        finally:
+            with self._lock:
+                del self._pending[request_id]
+                worker.in_flight -= 1
+
+
+def _serve(
+    index: int, workers: int, config: ChatbotConfig, connection: Connection
+) -> None:
+    # Entry point of a worker process
+    import torch
+
+    from chat import Chatbot
+
+    if (
+        config.device in ["", "cuda"]
+        and not config.cpu_quantization
+        and torch.cuda.is_available()
+        and torch.cuda.device_count() > 1
+    ):
+        config = replace(config, device=f"cuda:{index % torch.cuda.device_count()}")
+    if (
+        config.device == "cpu"
+        or config.cpu_quantization
+        or not torch.cuda.is_available()
+    ):
+        # Replicas sharing the CPU would otherwise each start a thread per core
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+        if config.cpu_io_cores and hasattr(os, "sched_getaffinity"):
+            # Each worker gets cores of its own, Chatbot splits those into
+            # I/O and compute ones
+            pin_process(share_cores(sorted(os.sched_getaffinity(0)), index, workers))
+
+    send_lock = threading.Lock()
+
+    def send(*message: Any) -> None:
+        with send_lock:
+            connection.send(message)
+
+    try:
+        chatbot = Chatbot(config)
+    except BaseException:
+        logger.exception(f"Worker {index} failed to load the chatbot")
+        return
+
+    send("ready")
+    threading.Thread(
+        target=_report_load, args=(chatbot, send), name="load-report", daemon=True
+    ).start()
+
+    while True:
+        try:
+            kind, *payload = connection.recv()
+        except (EOFError, OSError):
+            # The front end is gone
+            break
+        if kind == "stop":
+            break
+
+        if kind == "generate":
+            threading.Thread(
+                target=_generate, args=(chatbot, send, *payload), daemon=True
+            ).start()
+        elif kind == "call":
+            # Run in order, on this thread: they are quick, and a /clear must
+            # not overtake the message sent before it
+            request_id, name, args = payload
+            try:
+                result = invoke(chatbot, name, *args)
+            except Exception as e:
+                if request_id is not None:
+                    send("error", request_id, str(e))
+                continue
+            if request_id is not None:
+                send("done", request_id, result)
+
+    chatbot.close()
+
+
+def _generate(
+    chatbot: Any, send: Callable[..., None], request_id: int, user_id: str, text: str
+) -> None:
+    try:
+        request = chatbot.submit_request(text, user_id)
+        for chunk in request.streamer:
+            send("token", request_id, chunk)
+        response = chatbot.record_response(user_id, request, request.streamer.text())
+    except Exception as e:
+        send("error", request_id, str(e))
+        return
+    send("done", request_id, response)
+
+
+def _report_load(chatbot: Any, send: Callable[..., None]) -> None:
+    while True:
+        summary = chatbot.metrics.summary()
+        send(
+            "load",
+            {
+                "batch_size": summary["batch_size"]["value"],
+                "queue_depth": summary["queue_depth"]["value"],
+                "requests_in_flight": summary["requests_in_flight"]["value"],
+                "generated_tokens": summary["generated_tokens_total"]["value"],
+            },
+        )
+        time.sleep(LOAD_REPORT_INTERVAL)